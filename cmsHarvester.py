@@ -80,7 +80,6 @@ twiki_url = "https://twiki.cern.ch/twiki/bin/view/CMS/CmsHarvester"
 ##   3) References from GlobalTag.
 ##   4) No reference at all.
 ## - Is this options.evt_type used anywhere?
-## - Combine all these dbs_resolve_xxx into a single call to DBS(?).
 ## - Implement CRAB server use?
 ## - Add implementation of email address of user. (Only necessary for
 ##   CRAB server.)
@@ -94,8 +93,25 @@ import logging
 import optparse
 import datetime
 import copy
+import time
+import hashlib
+import cPickle
+import json
+import threading
+import Queue
+import socket
+import httplib
+import urllib
+import urllib2
+import urlparse
+import BaseHTTPServer
+import SocketServer
+import fcntl
 from inspect import getargspec
 from random import choice
+from random import uniform
+from random import random
+from array import array
 
 
 # These we need to communicate with DBS global DBSAPI
@@ -105,8 +121,12 @@ import DBSAPI.dbsApiException
 # and these we need to parse the DBS output.
 global xml
 global SAXParseException
+global ExpatError
 import xml.sax
 from xml.sax import SAXParseException
+import xml.parsers.expat
+from xml.parsers.expat import ExpatError
+from xml.sax.saxutils import escape, quoteattr
 
 import Configuration.PyReleaseValidation
 from Configuration.PyReleaseValidation.ConfigBuilder import \
@@ -142,6 +162,76 @@ class Error(Exception):
     def __str__(self):
         return repr(self.msg)
 
+###########################################################################
+## Helper function: write_json_atomically.
+###########################################################################
+
+def write_json_atomically(file_name, data, what, indent=None):
+    """Write data to file_name in JSON format.
+
+    The data go into a temporary file first, which is then moved into
+    place, so a crash never leaves a half-written file behind. The
+    name of the temporary file is unique to this process (and
+    thread), so several harvesters writing the same file at the same
+    time don't trip over each other. (The last one wins, though.)
+
+    Raises Error, mentioning what we were trying to write, if
+    anything goes wrong.
+
+    """
+
+    tmp_file_name = "%s.%d.%s.tmp" % \
+                    (file_name, os.getpid(),
+                     threading.currentThread().getName())
+    try:
+        tmp_file = open(tmp_file_name, "w")
+        try:
+            json.dump(data, tmp_file, indent=indent, sort_keys=True)
+        finally:
+            tmp_file.close()
+        os.rename(tmp_file_name, file_name)
+    except (IOError, OSError):
+        try:
+            os.remove(tmp_file_name)
+        except OSError:
+            pass
+        raise Error("ERROR: Could not write %s `%s'" % (what, file_name))
+
+    # End of write_json_atomically.
+
+###########################################################################
+## Helper functions: acquire_file_lock and release_file_lock.
+###########################################################################
+
+def acquire_file_lock(lock_file_name, exclusive=False, what="lock file"):
+    """Get hold of the (fcntl) lock on lock_file_name.
+
+    Returns the (open) lock file, to be handed to release_file_lock()
+    later on.
+
+    """
+
+    try:
+        lock_file = open(lock_file_name, "a")
+    except IOError:
+        raise Error("ERROR: Could not open %s `%s'" % \
+                    (what, lock_file_name))
+    if exclusive:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+    else:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_SH)
+
+    # End of acquire_file_lock.
+    return lock_file
+
+def release_file_lock(lock_file):
+    "Release a lock obtained using acquire_file_lock()."
+
+    fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+    lock_file.close()
+
+    # End of release_file_lock.
+
 ###########################################################################
 ## Helper class: CMSHarvesterHelpFormatter.
 ###########################################################################
@@ -177,6 +267,56 @@ class CMSHarvesterHelpFormatter(optparse.IndentedHelpFormatter):
 
     # End of CMSHarvesterHelpFormatter.
 
+###########################################################################
+## Helper class: DBSStringColumn.
+###########################################################################
+
+class DBSStringColumn(object):
+    """Dictionary-encoded column of strings.
+
+    DBS results tend to repeat the same few site names (and file
+    names, for multi-site files) over and over again. Instead of
+    storing each of them as a separate string object, each distinct
+    value is stored once and the column itself is just an array of
+    indices into the list of distinct values.
+
+    This behaves like a (read-only) list as far as len(), indexing
+    and iteration are concerned.
+
+    """
+
+    def __init__(self):
+        self.values = []
+        self.codes = {}
+        self.column = array("i")
+
+    def append(self, value):
+        try:
+            code = self.codes[value]
+        except KeyError:
+            code = len(self.values)
+            self.codes[value] = code
+            self.values.append(value)
+        self.column.append(code)
+
+    def distinct(self):
+        "Return the list of distinct values in this column."
+
+        return self.values
+
+    def __len__(self):
+        return len(self.column)
+
+    def __getitem__(self, index):
+        return self.values[self.column[index]]
+
+    def __iter__(self):
+        values = self.values
+        for code in self.column:
+            yield values[code]
+
+    # End of DBSStringColumn.
+
 ###########################################################################
 ## Helper class: DBSXMLHandler.
 ###########################################################################
@@ -193,8 +333,18 @@ class DBSXMLHandler(xml.sax.handler.ContentHandler):
     The old approach is handled directly in startElement(), the new
     approach in characters().
 
-    NOTE: All results are returned in the form of string values of
-          course!
+    The results are stored in typed columns: numbers (run numbers and
+    numbers of events) are stored as integers in arrays, strings that
+    are repeated a lot (like site names and file names) are stored in
+    dictionary-encoded columns. All other values are returned as
+    strings. The results can be accessed by column (the results
+    dictionary, or column()) or by row (row() and rows()).
+
+    If a row callback is given, each complete row (a dictionary tag
+    name -> value) is handed to it as soon as it has been parsed,
+    instead of being stored in the results. Together with feeding the
+    DBS output to the parser in pieces this avoids having to keep
+    huge DBS results in memory.
 
     """
 
@@ -212,14 +362,51 @@ class DBSXMLHandler(xml.sax.handler.ContentHandler):
         "file.numevents" : "FILES_NUMBEROFEVENTS",
         "algo.version"   : "APPVERSION_VERSION",
         "site"           : "STORAGEELEMENT_SENAME",
+        "dataset.createdate" : "PROCESSEDDATASET_CREATIONDATE",
+        "block.name"     : "BLOCK_NAME",
+        "file.count"     : "COUNT_FILES",
+        "sum(file.numevents)" : "SUM_FILES_NUMBEROFEVENTS",
+        "max(file.moddate)" : "MAX_FILES_LASTMODIFICATIONDATE",
+        }
+
+    # These are stored as integers, in arrays of this type code.
+    # NOTE: Python 2 arrays do not know about `q'. On 64-bit Linux
+    # (i.e. where we run) `l' is a 64-bit integer as well.
+    integer_columns = {
+        "run"            : "l",
+        "run.number"     : "l",
+        "file.numevents" : "l",
+        "file.count"     : "l",
+        "sum(file.numevents)" : "l",
+        }
+
+    # And these are dictionary-encoded.
+    encoded_columns = ["dataset", "site", "file.name", "block.name"]
+
+    # In the new format the elements are named after what we ask
+    # for. Aggregates don't make valid element names though, so
+    # those are named differently.
+    # NOTE: If DBS does not agree with this naming, we simply don't
+    # find these results.
+    element_names = {
+        "sum(file.numevents)" : "sum_file.numevents",
+        "max(file.moddate)" : "max_file.moddate",
         }
 
-    def __init__(self, tag_names):
+    def __init__(self, tag_names, row_callback=None):
         # This is a list used as stack to keep track of where we are
         # in the element tree.
         self.element_position = []
         self.tag_names = tag_names
+        # Element name -> tag name.
+        self.element_tags = dict([(DBSXMLHandler.element_names.get(i, i), i) \
+                                  for i in tag_names])
         self.results = {}
+        self.row_callback = row_callback
+        self.current_row = {}
+        # For row-by-row results, make sure we keep only one copy of
+        # each of the often repeated strings around.
+        self.interned = {}
 
     def startElement(self, name, attrs):
         self.element_position.append(name)
@@ -233,10 +420,7 @@ class DBSXMLHandler(xml.sax.handler.ContentHandler):
             for name in self.tag_names:
                 key = DBSXMLHandler.mapping[name]
                 value = str(attrs[key])
-                try:
-                    self.results[name].append(value)
-                except KeyError:
-                    self.results[name] = [value]
+                self.add_value(name, value)
 
         #----------
 
@@ -244,12 +428,10 @@ class DBSXMLHandler(xml.sax.handler.ContentHandler):
         assert self.current_element() == name, \
                "closing unopenend element `%s'" % name
 
-        if self.current_element() in self.tag_names:
+        if self.element_tags.has_key(self.current_element()):
             contents = "".join(self.current_value)
-            if self.results.has_key(self.current_element()):
-                self.results[self.current_element()].append(contents)
-            else:
-                self.results[self.current_element()] = [contents]
+            self.add_value(self.element_tags[self.current_element()],
+                           contents)
 
         self.element_position.pop()
 
@@ -258,12 +440,47 @@ class DBSXMLHandler(xml.sax.handler.ContentHandler):
         # gets split into multiple pieces. This method will be called
         # for each of the pieces. This means we have to concatenate
         # everything ourselves.
-        if self.current_element() in self.tag_names:
+        if self.element_tags.has_key(self.current_element()):
             self.current_value.append(content)
 
     def current_element(self):
         return self.element_position[-1]
 
+    def new_column(self, name):
+        "Create an (empty) column of the right type for name."
+
+        if DBSXMLHandler.integer_columns.has_key(name):
+            column = array(DBSXMLHandler.integer_columns[name])
+        elif name in DBSXMLHandler.encoded_columns:
+            column = DBSStringColumn()
+        else:
+            column = []
+
+        # End of new_column.
+        return column
+
+    def add_value(self, name, value):
+        "Store a value, or pass on the row once it is complete."
+
+        value = str(value)
+        if DBSXMLHandler.integer_columns.has_key(name):
+            value = int(value)
+
+        if self.row_callback is None:
+            try:
+                self.results[name].append(value)
+            except KeyError:
+                self.results[name] = self.new_column(name)
+                self.results[name].append(value)
+        else:
+            if name in DBSXMLHandler.encoded_columns:
+                value = self.interned.setdefault(value, value)
+            self.current_row[name] = value
+            if len(self.current_row) == len(self.tag_names):
+                row = self.current_row
+                self.current_row = {}
+                self.row_callback(row)
+
     def check_results_validity(self):
         """Make sure that all results arrays have equal length.
 
@@ -274,6 +491,10 @@ class DBSXMLHandler(xml.sax.handler.ContentHandler):
 
         results_valid = True
 
+        # Any incomplete row left over means something went wrong.
+        if len(self.current_row) > 0:
+            results_valid = False
+
         res_names = self.results.keys()
         if len(res_names) > 1:
             for res_name in res_names[1:]:
@@ -283,867 +504,5275 @@ class DBSXMLHandler(xml.sax.handler.ContentHandler):
 
         return results_valid
 
+    def column(self, name):
+        "Return all values for name (as list-like column)."
+
+        try:
+            column = self.results[name]
+        except KeyError:
+            column = self.new_column(name)
+
+        # End of column.
+        return column
+
+    def num_rows(self):
+        "Return the number of complete rows in the results."
+
+        if len(self.results) < 1:
+            return 0
+
+        # End of num_rows.
+        return min([len(i) for i in self.results.values()])
+
+    def row(self, index):
+        "Return row number index as dictionary tag name -> value."
+
+        return dict([(i, j[index]) for (i, j) in self.results.items()])
+
+    def rows(self):
+        "Iterate over all rows."
+
+        for index in xrange(self.num_rows()):
+            yield self.row(index)
+
     # End of DBSXMLHandler.
 
 ###########################################################################
-## CMSHarvester class.
+## Helper class: DBSFastParser.
 ###########################################################################
 
-class CMSHarvester(object):
-    """Class to perform CMS harvesting.
+class DBSFastParser(DBSXMLHandler):
+    """Fast parser for DBS query results.
 
-    More documentation `obviously' to follow.
+    This gives the same results as the DBSXMLHandler (and can be used
+    the same way afterwards) but instead of going through SAX it sits
+    directly on top of expat. Everything that can be figured out
+    before parsing (which elements and attributes we care about, how
+    to convert each value) is figured out once, up front, and we
+    don't keep track of the full element stack. Both the old
+    (attribute) and the new (element) DBS formats are handled.
+
+    Use feed() to hand over the DBS output (in one go or piece by
+    piece) and close() when done. Parsing problems show up as
+    ExpatError.
 
     """
 
-    ##########
+    def __init__(self, tag_names, row_callback=None):
+        DBSXMLHandler.__init__(self, tag_names, row_callback)
 
-    def __init__(self, cmd_line_opts=None):
-        "Initialize class and process command line options."
+        self.tag_set = frozenset(tag_names)
+        self.attr_keys = [(i, DBSXMLHandler.mapping[i]) for i in tag_names]
+        self.converters = {}
+        for tag_name in tag_names:
+            if DBSXMLHandler.integer_columns.has_key(tag_name):
+                self.converters[tag_name] = int
+            else:
+                self.converters[tag_name] = str
+        self.num_tags = len(tag_names)
 
-        self.version = __version__
+        self.parser = xml.parsers.expat.ParserCreate()
+        self.parser.buffer_text = True
+        # NOTE: Plain strings are all we need, and they are a lot
+        # cheaper than unicode ones.
+        self.parser.returns_unicode = False
+        self.setup_handlers()
 
-        # These are the harvesting types allowed. See the head of this
-        # file for more information.
-        self.harvesting_types = [
-            "RelVal",
-            "RelValFS",
-            "MC",
-            "DQMOffline",
-            ]
+    def setup_handlers(self):
+        """Hook our callbacks up to expat.
 
-        # These are the possible harvesting modes:
-        #   - Single-step: harvesting takes place on-site in a single
-        #   step. For each samples only a single ROOT file containing
-        #   the harvesting results is returned.
-        #   - Single-step-allow-partial: special hack to allow
-        #   harvesting of partial statistics using single-step
-        #   harvesting on spread-out samples.
-        #   - Two-step: harvesting takes place in two steps. The first
-        #   step returns a series of monitoring elenent summaries for
-        #   each sample. The second step then merges these summaries
-        #   locally and does the real harvesting. This second step
-        #   produces the ROOT file containing the harvesting results.
-        self.harvesting_modes = [
-            "single-step",
-            "single-step-allow-partial",
-            "two-step"
-            ]
+        NOTE: These callbacks are closures instead of methods on
+        purpose: they get called millions of times and looking up
+        local variables is a lot cheaper than looking up attributes.
 
-        # It is possible to specify a GlobalTag that will override any
-        # choices (regarding GlobalTags) made by the cmsHarvester.
-        # BUG BUG BUG
-        # For the moment, until I figure out a way to obtain the
-        # GlobalTag with which a given data (!) dataset was created,
-        # it is necessary to specify a GlobalTag for harvesting of
-        # data.
-        # BUG BUG BUG end
-        self.globaltag = None
+        """
 
-        # It's also possible to switch off the use of reference
-        # histograms altogether.
-        self.use_ref_hists = True
+        tag_set = self.tag_set
+        element_tags = self.element_tags
+        attr_keys = self.attr_keys
+        converters = self.converters
+        num_tags = self.num_tags
+        row_callback = self.row_callback
+        results = self.results
+        new_column = self.new_column
+        interned = self.interned
+        encoded = frozenset(DBSXMLHandler.encoded_columns)
+        # The element whose contents we are collecting right now (if
+        # any) and the pieces of contents collected so far.
+        collecting = [None, []]
+
+        if row_callback is None:
+            columns = dict([(i, new_column(i)) for i in tag_set])
+            for (tag_name, column) in columns.items():
+                results[tag_name] = column
+            def add_value(name, value):
+                columns[name].append(converters[name](value))
+        else:
+            row_holder = [self.current_row]
+            def add_value(name, value):
+                value = converters[name](value)
+                if name in encoded:
+                    value = interned.setdefault(value, value)
+                row = row_holder[0]
+                row[name] = value
+                if len(row) == num_tags:
+                    row_holder[0] = self.current_row = {}
+                    row_callback(row)
+
+        def start_element(name, attrs):
+            if name in element_tags:
+                collecting[0] = name
+                collecting[1] = []
+            elif name == "result":
+                # This is to catch results from DBS 2.0.5 and earlier.
+                for (tag_name, key) in attr_keys:
+                    add_value(tag_name, attrs[key])
+
+        def end_element(name):
+            if name == collecting[0]:
+                add_value(element_tags[name], "".join(collecting[1]))
+                collecting[0] = None
+
+        def characters(content):
+            if not collecting[0] is None:
+                collecting[1].append(content)
+
+        self.parser.StartElementHandler = start_element
+        self.parser.EndElementHandler = end_element
+        self.parser.CharacterDataHandler = characters
+
+        # End of setup_handlers.
+
+    def feed(self, data):
+        self.parser.Parse(data, False)
+
+    def close(self):
+        self.parser.Parse("", True)
+        # Just like the DBSXMLHandler we only return columns for
+        # which we actually found something.
+        for tag_name in self.results.keys():
+            if len(self.results[tag_name]) < 1:
+                del self.results[tag_name]
+
+    # End of DBSFastParser.
 
-        # The database name and account are hard-coded. They are not
-        # likely to change before the end-of-life of this tool. But of
-        # course there is a way to override this from the command
-        # line. One can even override the Frontier connection used for
-        # the GlobalTag and for the reference histograms
-        # independently. Please only use this for testing purposes.
-        self.frontier_connection_name = {}
-        self.frontier_connection_name["globaltag"] = "frontier://" \
-                                                     "FrontierProd/"
-        self.frontier_connection_name["refhists"] = "frontier://" \
-                                                    "FrontierProd/"
-        self.frontier_connection_overridden = {}
-        for key in self.frontier_connection_name.keys():
-            self.frontier_connection_overridden[key] = False
+###########################################################################
+## Helper class: DBSParserBenchmark.
+###########################################################################
 
-        # This contains information specific to each of the harvesting
-        # types. Used to create the harvesting configuration. It is
-        # filled by setup_harvesting_info().
-        self.harvesting_info = None
+class DBSParserBenchmark(object):
+    """Microbenchmarks for the DBS result parsers.
 
-        ###
+    Parses synthetic (file-level) DBS results of a given number of
+    rows, in both the old and the new DBS XML format, with both the
+    DBSXMLHandler (through SAX) and the DBSFastParser. The results
+    are fed to the parsers in pieces (like when streaming) and handed
+    over row by row, so even very large benchmarks do not need much
+    memory.
 
-        # These are default `unused' values that will be filled in
-        # depending on the command line options.
+    """
 
-        # The type of harvesting we're doing. See
-        # self.harvesting_types for allowed types.
-        self.harvesting_type = None
+    tag_names = ["run.number", "site", "file.name", "file.numevents"]
 
-        # The harvesting mode, popularly known as single-step
-        # vs. two-step. The thing to remember at this point is that
-        # single-step is only possible for samples located completely
-        # at a single site (i.e. SE).
-        self.harvesting_mode = None
-        # BUG BUG BUG
-        # Default temporarily set to two-step until we can get staged
-        # jobs working with CRAB.
-        self.harvesting_mode_default = "single-step"
-        # BUG BUG BUG end
+    # Number of rows per piece of XML fed to the parser.
+    rows_per_chunk = 10000
 
-        # The input method: are we reading a dataset name (or regexp)
-        # directly from the command line or are we reading a file
-        # containing a list of dataset specifications. Actually we
-        # keep one of each for both datasets and runs.
-        self.input_method = {}
-        self.input_method["datasets"] = {}
-        self.input_method["datasets"]["use"] = None
-        self.input_method["datasets"]["ignore"] = None
-        self.input_method["runs"] = {}
-        self.input_method["runs"]["use"] = None
-        self.input_method["runs"]["ignore"] = None
-        self.input_method["runs"]["ignore"] = None
-        # The name of whatever input we're using.
-        self.input_name = {}
-        self.input_name["datasets"] = {}
-        self.input_name["datasets"]["use"] = None
-        self.input_name["datasets"]["ignore"] = None
-        self.input_name["runs"] = {}
-        self.input_name["runs"]["use"] = None
-        self.input_name["runs"]["ignore"] = None
+    def synthetic_response(self, num_rows, old_format):
+        """Generate a synthetic DBS result, piece by piece.
 
-	self.Jsonlumi = False
-	self.Jsonfilename = "YourJSON.txt"
-     	self.Jsonrunfilename = "YourJSON.txt"
-	self.todofile = "YourToDofile.txt"
+        """
 
-        # If this is true, we're running in `force mode'. In this case
-        # the sanity checks are performed but failure will not halt
-        # everything.
-        self.force_running = None
+        if old_format:
+            yield "<?xml version='1.0' standalone='yes'?>\n<dbs>\n"
+            row_format = "<result RUNS_RUNNUMBER='%d' " \
+                         "STORAGEELEMENT_SENAME='%s' " \
+                         "FILES_LOGICALFILENAME='%s' " \
+                         "FILES_NUMBEROFEVENTS='%d'/>\n"
+        else:
+            yield "<?xml version='1.0' standalone='yes'?>\n" \
+                  "<ddresponse>\n<results>\n"
+            row_format = "<row>\n" \
+                         "<run.number>%d</run.number>\n" \
+                         "<site>%s</site>\n" \
+                         "<file.name>%s</file.name>\n" \
+                         "<file.numevents>%d</file.numevents>\n" \
+                         "</row>\n"
+
+        sites = ["srm-cms.cern.ch", "cmssrm.fnal.gov",
+                 "srm.ciemat.es", "storm-fe-cms.cr.cnaf.infn.it"]
+        for chunk_start in xrange(0, num_rows,
+                                  DBSParserBenchmark.rows_per_chunk):
+            chunk_end = min(num_rows,
+                            chunk_start + DBSParserBenchmark.rows_per_chunk)
+            rows = []
+            for index in xrange(chunk_start, chunk_end):
+                # Files at two sites each, about a hundred files per
+                # run.
+                file_name = "/store/data/Run/RECO/v1/%09d/%08d.root" % \
+                            (index / 200, index / 2)
+                rows.append(row_format % (100000 + index / 200,
+                                          sites[index % len(sites)],
+                                          file_name,
+                                          index % 1000))
+            yield "".join(rows)
+
+        if old_format:
+            yield "</dbs>\n"
+        else:
+            yield "</results>\n</ddresponse>\n"
 
-        # The base path of the output dir in CASTOR.
-        self.castor_base_dir = None
-        self.castor_base_dir_default = "/castor/cern.ch/" \
-                                       "cms/store/temp/" \
-                                       "dqm/offline/harvesting_output/"
+        # End of synthetic_response.
 
-        # The name of the file to be used for book keeping: which
-        # datasets, runs, etc. we have already processed.
-        self.book_keeping_file_name = None
-        self.book_keeping_file_name_default = "harvesting_accounting.txt"
+    def parse_sax(self, chunks, row_callback):
+        handler = DBSXMLHandler(DBSParserBenchmark.tag_names, row_callback)
+        parser = xml.sax.make_parser()
+        parser.setContentHandler(handler)
+        parse_time = 0.
+        for chunk in chunks:
+            time_start = time.time()
+            parser.feed(chunk)
+            parse_time += time.time() - time_start
+        time_start = time.time()
+        parser.close()
+        parse_time += time.time() - time_start
+
+        # End of parse_sax.
+        return parse_time
+
+    def parse_fast(self, chunks, row_callback):
+        parser = DBSFastParser(DBSParserBenchmark.tag_names, row_callback)
+        parse_time = 0.
+        for chunk in chunks:
+            time_start = time.time()
+            parser.feed(chunk)
+            parse_time += time.time() - time_start
+        time_start = time.time()
+        parser.close()
+        parse_time += time.time() - time_start
+
+        # End of parse_fast.
+        return parse_time
+
+    def run(self, num_rows_list, parser_names=None):
+        """Run all benchmarks.
+
+        Returns a list of (parser name, format, number of rows,
+        parse time in seconds) tuples.
 
-        # The dataset name to reference histogram name mapping is read
-        # from a text file. The name of this file is kept in the
-        # following variable.
-        self.ref_hist_mappings_file_name = None
-        # And this is the default value.
-        self.ref_hist_mappings_file_name_default = "harvesting_ref_hist_mappings.txt"
+        """
 
-        # Hmmm, hard-coded prefix of the CERN CASTOR area. This is the
-        # only supported CASTOR area.
-        # NOTE: Make sure this one starts with a `/'.
-        self.castor_prefix = "/castor/cern.ch"
+        parsers = [("sax", self.parse_sax), ("fast", self.parse_fast)]
+        if not parser_names is None:
+            parsers = [i for i in parsers if i[0] in parser_names]
 
-        # Normally the central harvesting should be done using the
-        # `t1access' grid role. To be able to run without T1 access
-        # the --no-t1access flag can be used. This variable keeps
-        # track of that special mode.
-        self.non_t1access = False
-	self.caf_access = False
-        self.saveByLumiSection = False
-        self.crab_submission = False
-        self.nr_max_sites = 1
+        results = []
+        for num_rows in num_rows_list:
+            for old_format in [True, False]:
+                if old_format:
+                    format_name = "old"
+                else:
+                    format_name = "new"
+                for (parser_name, parse) in parsers:
+                    row_count = [0]
+                    def count_row(row):
+                        row_count[0] += 1
+                    chunks = self.synthetic_response(num_rows, old_format)
+                    parse_time = parse(chunks, count_row)
+                    # DEBUG DEBUG DEBUG
+                    assert row_count[0] == num_rows
+                    # DEBUG DEBUG DEBUG end
+                    results.append((parser_name, format_name,
+                                    num_rows, parse_time))
 
-	self.preferred_site = "no preference"
+        # End of run.
+        return results
 
-        # This will become the list of datasets and runs to consider
-        self.datasets_to_use = {}
-        # and this will become the list of datasets and runs to skip.
-        self.datasets_to_ignore = {}
-        # This, in turn, will hold all book keeping information.
-        self.book_keeping_information = {}
-        # And this is where the dataset name to reference histogram
-        # name mapping is stored.
-        self.ref_hist_mappings = {}
+    # End of DBSParserBenchmark.
 
-        # We're now also allowing run selection. This means we also
-        # have to keep list of runs requested and vetoed by the user.
-        self.runs_to_use = {}
-        self.runs_to_ignore = {}
+###########################################################################
+## Helper class: DBSReplayServer.
+###########################################################################
 
-        # Cache for CMSSW version availability at different sites.
-        self.sites_and_versions_cache = {}
+class DBSReplayRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Handles requests to the DBSReplayServer.
 
-        # Cache for checked GlobalTags.
-        self.globaltag_check_cache = []
+    Only the executeQuery API call is supported, both as GET and as
+    POST request.
 
-        # Global flag to see if there were any jobs for which we could
-        # not find a matching site.
-        self.all_sites_found = True
+    """
 
-        # Helper string centrally defined.
-        self.no_matching_site_found_str = "no_matching_site_found"
+    def do_GET(self):
+        params = urlparse.parse_qs(urlparse.urlparse(self.path)[4])
+        self.handle_params(params)
 
-        # Store command line options for later use.
-        if cmd_line_opts is None:
-            cmd_line_opts = sys.argv[1:]
-        self.cmd_line_opts = cmd_line_opts
+    def do_POST(self):
+        length = int(self.headers.getheader("content-length", 0))
+        params = urlparse.parse_qs(self.rfile.read(length))
+        self.handle_params(params)
 
-        # Set up the logger.
-        log_handler = logging.StreamHandler()
-        # This is the default log formatter, the debug option switches
-        # on some more information.
-        log_formatter = logging.Formatter("%(message)s")
-        log_handler.setFormatter(log_formatter)
-        logger = logging.getLogger()
-        logger.name = "main"
-        logger.addHandler(log_handler)
+    def handle_params(self, params):
+        api_call = params.get("api", ["executeQuery"])[0]
+        query = params.get("query", [""])[0]
+        replay = self.server.replay
+
+        if replay.latency > 0.:
+            time.sleep(replay.latency)
+
+        if api_call != "executeQuery":
+            self.send_dbs_error("Unsupported API call `%s'" % api_call)
+        elif random() < replay.failure_rate:
+            self.send_dbs_error("Simulated DBS failure")
+        else:
+            response = replay.response(query)
+            self.send_response(200)
+            self.send_header("Content-Type", "text/xml")
+            self.send_header("Content-Length", str(len(response)))
+            self.send_header("dbs-status-code", "100")
+            self.end_headers()
+            self.wfile.write(response)
+
+    def send_dbs_error(self, msg):
+        self.send_response(500)
+        self.send_header("Content-Type", "text/plain")
+        self.send_header("dbs-status-code", "400")
+        self.send_header("dbs-status-message", msg)
+        self.end_headers()
+        self.wfile.write(msg)
+
+    def log_message(self, format, *args):
+        # Keep quiet. We've got our own logging.
+        pass
+
+    # End of DBSReplayRequestHandler.
+
+class DBSReplayHTTPServer(SocketServer.ThreadingMixIn,
+                          BaseHTTPServer.HTTPServer):
+    "HTTP server for the DBSReplayServer, one thread per request."
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+class DBSReplayServer(object):
+    """Local stand-in for the DBS server.
+
+    This serves DBS query results from a directory of fixtures
+    (i.e. query/response pairs recorded from the real DBS server, see
+    write_fixture()). Queries for which there is no fixture get a
+    synthetic answer. This is enough to run (and benchmark) the
+    harvester without access to the real DBS.
+
+    The results can be served in either the old (attribute) or the
+    new (element) DBS XML format, and each request can be made to
+    take a certain time and/or to fail every so often.
+
+    """
+
+    # Used to make up results.
+    synthetic_values = {
+        "algo.version"   : "CMSSW_3_5_6",
+        "datatype.type"  : "data",
+        "dataset.tag"    : "GR_R_35X_V7A::All",
+        "dataset.createdate" : "1270000000",
+        }
+    synthetic_sites = ["srm-cms.cern.ch", "cmssrm.fnal.gov",
+                       "srm.ciemat.es", "storm-fe-cms.cr.cnaf.infn.it"]
+    # Number of datasets to match a wildcarded dataset name.
+    synthetic_num_datasets = 3
+
+    def __init__(self, fixture_dir=None, old_format=False, latency=0.,
+                 failure_rate=0., num_rows=1000):
+        self.fixture_dir = fixture_dir
+        self.old_format = old_format
+        self.latency = latency
+        self.failure_rate = failure_rate
+        # Number of rows for synthetic run- or file-level results.
+        self.num_rows = num_rows
+        self.server = None
+        self.thread = None
+        self.url = None
+
+    def start(self):
+        "Start serving (on a free port on localhost) in the background."
+
+        self.server = DBSReplayHTTPServer(("127.0.0.1", 0),
+                                          DBSReplayRequestHandler)
+        self.server.replay = self
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.setDaemon(True)
+        self.thread.start()
+        self.url = "http://127.0.0.1:%d/cms_dbs_replay/servlet/DBSServlet" % \
+                   self.server.server_address[1]
+
+        # End of start.
+
+    def stop(self):
+        "Stop serving."
+
+        if not self.server is None:
+            self.server.shutdown()
+            self.server = None
+
+        # End of stop.
+
+    def fixture_path(fixture_dir, query):
+        "Name of the fixture file for this query."
+
+        query = " ".join(query.split())
+        file_name = "%s.dbs.json" % hashlib.md5(query).hexdigest()
+
+        # End of fixture_path.
+        return os.path.join(fixture_dir, file_name)
+
+    fixture_path = staticmethod(fixture_path)
+
+    def write_fixture(fixture_dir, query, response):
+        """Store a query/response pair as fixture.
+
+        NOTE: This writes to a temporary file first, so readers never
+        see half-written fixtures.
+
+        """
+
+        path = DBSReplayServer.fixture_path(fixture_dir, query)
+        tmp_path = "%s.tmp.%d.%d" % (path, os.getpid(),
+                                     threading.currentThread().ident)
+        fixture = {"query" : " ".join(query.split()),
+                   "response" : response}
+        try:
+            fixture_file = open(tmp_path, "w")
+            try:
+                json.dump(fixture, fixture_file, indent=1)
+            finally:
+                fixture_file.close()
+            os.rename(tmp_path, path)
+        except (IOError, OSError):
+            raise Error("ERROR: Could not write DBS fixture `%s'" % path)
+
+        # End of write_fixture.
+
+    write_fixture = staticmethod(write_fixture)
+
+    def response(self, query):
+        "Return the DBS output for a query."
+
+        if not self.fixture_dir is None:
+            path = DBSReplayServer.fixture_path(self.fixture_dir, query)
+            if os.path.exists(path):
+                fixture_file = open(path, "r")
+                try:
+                    fixture = json.load(fixture_file)
+                finally:
+                    fixture_file.close()
+                return fixture["response"].encode("utf-8")
+
+        # End of response.
+        return self.synthetic_response(query)
+
+    def synthetic_response(self, query):
+        """Make up a plausible answer to a DBS query.
+
+        The only thing we really have to get right is the list of
+        things to `find'. Beyond that we only make sure that the
+        results are consistent with what the harvester expects
+        (e.g. a single CMSSW version per dataset, each file always
+        with the same number of events).
+
+        """
+
+        query = " ".join(query.split())
+        match = re.match("find (.*?) where (.*)$", query)
+        if match is None:
+            tag_names = []
+            condition = ""
+        else:
+            tag_names = [i.strip() for i in match.group(1).split(",")]
+            condition = match.group(2)
+
+        match = re.search("dataset (=|like) ([^ ]+)", condition)
+        if match is None:
+            dataset_names = ["/Synthetic/Replay-v1/RECO"]
+        elif match.group(1) == "=":
+            dataset_names = [match.group(2)]
+        else:
+            dataset_names = [match.group(2).replace("*", "Replay%d" % i) \
+                             for i in xrange(DBSReplayServer. \
+                                             synthetic_num_datasets)]
+        # Runs are numbered from here on, with a hundred rows (i.e. 50
+        # files, each at two sites) per run and five runs per block.
+        run_first = 100000
+        run_min = None
+        match = re.search("run > ([0-9]+)", condition)
+        if not match is None:
+            run_min = int(match.group(1)) + 1
+        run_max = None
+        match = re.search("run >= ([0-9]+)", condition)
+        if not match is None:
+            run_min = max(run_min, int(match.group(1)))
+        match = re.search("run < ([0-9]+)", condition)
+        if not match is None:
+            run_max = int(match.group(1))
+
+        # Things that are counted (or summed, or maximised) per group
+        # of rows instead of being listed row by row.
+        aggregates = {
+            "file.count" : lambda value, row: value + 1,
+            "sum(file.numevents)" : lambda value, row: \
+                                    value + row["file.numevents"],
+            "max(file.moddate)" : lambda value, row: \
+                                  max(value, row["file.moddate"]),
+            }
+
+        tag_set = set(tag_names)
+        if len(tag_set - set(["dataset"] + \
+                             DBSReplayServer.synthetic_values.keys())) > 0:
+            num_rows = self.num_rows
+        elif "dataset" in tag_set:
+            num_rows = len(dataset_names)
+        else:
+            num_rows = 1
+
+        # Make up all rows at file level first, and then select (or
+        # count) only what was asked for. Just like DBS we only
+        # return distinct rows.
+        rows = []
+        groups = {}
+        for index in xrange(num_rows):
+            dataset_name = dataset_names[index % len(dataset_names)]
+            run_number = run_first + index / 100
+            if (not run_min is None and run_number < run_min) or \
+               (not run_max is None and run_number >= run_max):
+                continue
+            row_full = {
+                "dataset" : dataset_name,
+                "run" : run_number,
+                "run.number" : run_number,
+                "block.name" : "%s#%05d" % (dataset_name, run_number / 5),
+                "site" : DBSReplayServer.synthetic_sites \
+                         [index % len(DBSReplayServer.synthetic_sites)],
+                "file.name" : "/store/data/Replay/RECO/v1/%09d/%08d.root" % \
+                              (run_number, index / 2),
+                "file.numevents" : 1000 + (index / 2) % 1000,
+                "file.moddate" : 1250000000 + run_number,
+                }
+            key = tuple([row_full.get(i, None) for i in tag_names \
+                         if not aggregates.has_key(i)])
+            try:
+                row = groups[key]
+            except KeyError:
+                row = {}
+                for tag_name in tag_names:
+                    if aggregates.has_key(tag_name):
+                        row[tag_name] = 0
+                    elif row_full.has_key(tag_name):
+                        row[tag_name] = row_full[tag_name]
+                    else:
+                        row[tag_name] = DBSReplayServer.synthetic_values. \
+                                        get(tag_name, "")
+                groups[key] = row
+                rows.append(row)
+            for (tag_name, aggregate) in aggregates.items():
+                if row.has_key(tag_name):
+                    row[tag_name] = aggregate(row[tag_name], row_full)
+
+        for row in rows:
+            for tag_name in tag_names:
+                row[tag_name] = str(row[tag_name])
+
+        # End of synthetic_response.
+        return self.format_response(tag_names, rows)
+
+    def format_response(self, tag_names, rows):
+        "Turn rows into DBS output in the old or new format."
+
+        pieces = ["<?xml version='1.0' standalone='yes'?>\n"]
+        if self.old_format:
+            pieces.append("<dbs>\n")
+            for row in rows:
+                attrs = ["%s=%s" % (DBSXMLHandler.mapping[i],
+                                    quoteattr(row[i])) \
+                         for i in tag_names]
+                pieces.append("<result %s/>\n" % " ".join(attrs))
+            pieces.append("</dbs>\n")
+        else:
+            pieces.append("<ddresponse>\n<results>\n")
+            for row in rows:
+                pieces.append("<row>\n")
+                for tag_name in tag_names:
+                    element_name = DBSXMLHandler.element_names. \
+                                   get(tag_name, tag_name)
+                    pieces.append("<%s>%s</%s>\n" % \
+                                  (element_name, escape(row[tag_name]),
+                                   element_name))
+                pieces.append("</row>\n")
+            pieces.append("</results>\n</ddresponse>\n")
+
+        # End of format_response.
+        return "".join(pieces)
+
+    # End of DBSReplayServer.
+
+###########################################################################
+## Helper class: WorkerPool.
+###########################################################################
+
+class WorkerPool(object):
+    """Small bounded pool of worker threads.
+
+    Used to overlap the many blocking DBS round trips we do. The
+    results of map() are returned in the order in which the arguments
+    were given, independent of the order in which the workers finish
+    them. This way the caller can merge everything exactly as a serial
+    loop would have done.
+
+    NOTE: If any of the calls raises an exception, the first one (in
+    argument order) is re-raised in the calling thread after all
+    calls have finished.
+
+    NOTE: With a single worker no threads are started at all and
+    everything runs in the calling thread. The same holds for pools
+    used from within one of the workers of another pool, so nesting
+    pools does not multiply the number of threads.
+
+    """
+
+    # Tells whether the current thread is one of our workers.
+    local = threading.local()
+
+    def __init__(self, num_workers):
+        self.num_workers = max(int(num_workers), 1)
+
+    def map(self, func, args_list):
+        """Call func(args) for each args in args_list.
+
+        Returns the list of results, in the order of args_list.
+
+        """
+
+        args_list = list(args_list)
+
+        results = [None] * len(args_list)
+        for (index, result) in self.imap_unordered(func, args_list):
+            results[index] = result
+
+        # End of map.
+        return results
+
+    def imap_unordered(self, func, args_list):
+        """Call func(args) for each args in args_list.
+
+        This is a generator yielding (index, result) pairs as soon as
+        each of the calls finishes, where index is the position in
+        args_list. Use this to process results while the rest is still
+        being worked on.
+
+        """
+
+        args_list = list(args_list)
+
+        if self.num_workers == 1 or len(args_list) < 2 or \
+               getattr(WorkerPool.local, "in_worker", False):
+            for (index, args) in enumerate(args_list):
+                yield (index, func(args))
+            return
+
+        tasks = Queue.Queue()
+        for (index, args) in enumerate(args_list):
+            tasks.put((index, args))
+        done = Queue.Queue()
+
+        def worker():
+            WorkerPool.local.in_worker = True
+            while True:
+                try:
+                    (index, args) = tasks.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    done.put((index, True, func(args)))
+                except:
+                    done.put((index, False, sys.exc_info()))
+
+        num_threads = min(self.num_workers, len(args_list))
+        for i in xrange(num_threads):
+            thread = threading.Thread(target=worker)
+            # Don't let a stuck DBS call keep us alive after a CTRL-C.
+            thread.setDaemon(True)
+            thread.start()
+
+        failures = {}
+        num_left = len(args_list)
+        while num_left > 0:
+            # NOTE: Waiting with a timeout keeps us interruptible.
+            try:
+                (index, success, value) = done.get(True, 1.)
+            except Queue.Empty:
+                continue
+            num_left -= 1
+            if success:
+                yield (index, value)
+            else:
+                failures[index] = value
+
+        if len(failures) > 0:
+            (exc_type, exc_value, exc_traceback) = \
+                       failures[min(failures.keys())]
+            raise exc_type, exc_value, exc_traceback
+
+        # End of imap_unordered.
+
+    # End of WorkerPool.
+
+###########################################################################
+## Helper class: DBSQueryCache.
+###########################################################################
+
+class DBSQueryCache(object):
+    """Persistent on-disk cache of DBS query results.
+
+    Each cached response is stored in its own file in the cache
+    directory, keyed by a hash of the normalised query string. Entries
+    expire after a time-to-live that depends on the kind of query:
+    the CMSSW version or GlobalTag of a dataset is not going to
+    change, the list of files and sites of a dataset may change any
+    time there is a transfer.
+
+    The total size of the cache is bounded. When it grows too large
+    the least recently used entries are removed. The modification
+    time of the entry files is used to keep track of the last use.
+
+    NOTE: Entries are written to a temporary file and then moved into
+    place, so concurrent harvesters can share a cache directory.
+
+    """
+
+    # Time-to-live (in seconds) for the different classes of
+    # queries. The query class is the list of things we `find'.
+    ttls = {
+        "dataset"        : 3600,
+        "run"            : 6 * 3600,
+        "algo.version"   : 7 * 24 * 3600,
+        "dataset.tag"    : 7 * 24 * 3600,
+        "datatype.type"  : 7 * 24 * 3600,
+        "run.number,site,file.name,file.numevents" : 6 * 3600,
+        "dataset,algo.version,datatype.type,run" : 6 * 3600,
+        "dataset,algo.version,datatype.type,dataset.tag,run" : 6 * 3600,
+        # NOTE: The whole point of these (the run fingerprints and the
+        # incremental discovery of new datasets and runs) is to find
+        # out whether anything changed, so never use cached ones.
+        "run,file.count,sum(file.numevents),max(file.moddate)" : 0,
+        "dataset,dataset.createdate" : 0,
+        "dataset,run" : 0,
+        }
+    ttl_default = 3600
+
+    # Default maximum size of the cache (in bytes).
+    max_size_default = 1024 * 1024 * 1024
+
+    # When the cache grows too large it is trimmed down to this
+    # fraction of the maximum size, so we don't have to do that again
+    # for the next entry.
+    evict_fraction = 0.9
+
+    def __init__(self, cache_dir, refresh=False, max_size=None):
+        self.cache_dir = cache_dir
+        self.refresh = refresh
+        if max_size is None:
+            max_size = DBSQueryCache.max_size_default
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.num_hits = 0
+        self.num_misses = 0
+        # Our idea of the total size of the cache (None if we did not
+        # look yet). This saves us from looking at all entries each
+        # time something is added.
+        # NOTE: Other harvesters sharing the cache directory make this
+        # a lower limit. Every time we evict entries it is corrected.
+        self.size = None
+
+        if not os.path.isdir(self.cache_dir):
+            try:
+                os.makedirs(self.cache_dir)
+            except OSError:
+                # Maybe someone else just created it.
+                if not os.path.isdir(self.cache_dir):
+                    raise Error("ERROR: Could not create DBS cache " \
+                                "directory `%s'" % self.cache_dir)
+
+    def normalize_query(self, query):
+        "Normalise white space so equivalent queries share an entry."
+
+        return " ".join(query.split())
+
+    def query_class(self, query):
+        """Figure out the class of a query.
+
+        This is the (comma-separated) list of things asked for in the
+        `find' part of the query.
+
+        """
+
+        query = self.normalize_query(query)
+        match = re.match("find (.*?) where ", query)
+        if match is None:
+            return None
+        # End of query_class.
+        return match.group(1).replace(" ", "")
+
+    def ttl(self, query):
+        return DBSQueryCache.ttls.get(self.query_class(query),
+                                      DBSQueryCache.ttl_default)
+
+    def entry_path(self, query):
+        key = hashlib.md5(self.normalize_query(query)).hexdigest()
+        return os.path.join(self.cache_dir, "%s.dbs" % key)
+
+    def get(self, query):
+        """Return the cached result for this query, or None.
+
+        """
+
+        result = None
+        if not self.refresh:
+            entry_path = self.entry_path(query)
+            try:
+                entry_file = open(entry_path, "rb")
+                try:
+                    entry = cPickle.load(entry_file)
+                finally:
+                    entry_file.close()
+                if entry["query"] == self.normalize_query(query) and \
+                       (time.time() - entry["created"]) < self.ttl(query):
+                    result = entry["result"]
+                    # Mark this entry as recently used.
+                    os.utime(entry_path, None)
+            except (IOError, OSError, EOFError, KeyError,
+                    cPickle.UnpicklingError):
+                # Either not there, corrupt, or removed under our
+                # feet. Treat all of these as a miss.
+                result = None
+
+        self.lock.acquire()
+        try:
+            if result is None:
+                self.num_misses += 1
+            else:
+                self.num_hits += 1
+        finally:
+            self.lock.release()
+
+        # End of get.
+        return result
+
+    def put(self, query, result):
+        """Store the result for this query in the cache.
+
+        NOTE: Failure to write to the cache is not fatal.
+
+        """
+
+        entry = {
+            "query" : self.normalize_query(query),
+            "created" : time.time(),
+            "result" : result,
+            }
+        entry_path = self.entry_path(query)
+        tmp_path = "%s.%d.%s.tmp" % \
+                   (entry_path, os.getpid(), threading.currentThread().getName())
+        try:
+            tmp_file = open(tmp_path, "wb")
+            try:
+                cPickle.dump(entry, tmp_file, cPickle.HIGHEST_PROTOCOL)
+                size_new = tmp_file.tell()
+            finally:
+                tmp_file.close()
+            try:
+                size_old = os.path.getsize(entry_path)
+            except OSError:
+                size_old = 0
+            os.rename(tmp_path, entry_path)
+        except (IOError, OSError):
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            return
+
+        self.lock.acquire()
+        try:
+            if not self.size is None:
+                self.size += size_new - size_old
+            do_evict = (self.size is None or self.size > self.max_size)
+        finally:
+            self.lock.release()
+        if do_evict:
+            self.evict()
+
+        # End of put.
+
+    def evict(self):
+        """Remove least recently used entries until the cache fits
+        (with some room to spare, see evict_fraction).
+
+        """
+
+        self.lock.acquire()
+        try:
+            entries = []
+            total_size = 0
+            for file_name in os.listdir(self.cache_dir):
+                if not file_name.endswith(".dbs"):
+                    continue
+                path = os.path.join(self.cache_dir, file_name)
+                try:
+                    stat_info = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat_info.st_mtime, stat_info.st_size, path))
+                total_size += stat_info.st_size
+            entries.sort()
+            size_target = self.max_size
+            if total_size > self.max_size:
+                size_target = self.max_size * DBSQueryCache.evict_fraction
+            while total_size > size_target and len(entries) > 0:
+                (mtime, size, path) = entries.pop(0)
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                total_size -= size
+            self.size = total_size
+        finally:
+            self.lock.release()
+
+        # End of evict.
+
+    # End of DBSQueryCache.
+
+###########################################################################
+## Helper class: DBSClient.
+###########################################################################
+
+class DBSClient(object):
+    """Pool of DBS API instances with retries and a circuit breaker.
+
+    API instances (and with them their connections to the DBS server)
+    are handed out to whichever thread needs one and are reused
+    afterwards. At most pool_size instances exist at any time.
+
+    Queries failing with one of the retry_exceptions are retried, up
+    to max_retries times, after a jittered exponential backoff. An
+    instance that failed is thrown away, since its connection may be
+    in a bad state. Exceptions listed in fatal_exceptions (e.g. bad
+    queries) are never retried.
+
+    After breaker_threshold consecutive failures the circuit breaker
+    opens: for the next breaker_cooldown seconds all queries fail
+    right away instead of waiting for a server that is known to be
+    in trouble. After that a single query is let through to see if
+    things are better. If it succeeds the breaker closes again.
+
+    """
+
+    # The DBS API version we claim to speak when streaming, if we
+    # cannot get it from the DBS API.
+    api_version_default = "DBS_2_0_9"
+
+    def __init__(self, api_factory, pool_size=1, max_retries=3,
+                 retry_exceptions=(), fatal_exceptions=(), api=None,
+                 logger=None, url=None, api_version=None):
+        self.api_factory = api_factory
+        self.pool_size = pool_size
+        self.max_retries = max_retries
+        self.retry_exceptions = retry_exceptions
+        self.fatal_exceptions = fatal_exceptions
         self.logger = logger
-        # The default output mode is quite verbose.
-        self.set_output_level("NORMAL")
 
-        #logger.debug("Initialized successfully")
+        # Backoff (in seconds) before the first retry, and the maximum
+        # backoff ever.
+        self.backoff_base = 1.
+        self.backoff_max = 60.
+        # Number of consecutive failures that opens the circuit
+        # breaker, and the time (in seconds) it stays open.
+        self.breaker_threshold = 5
+        self.breaker_cooldown = 300.
+
+        self.lock = threading.Lock()
+        self.idle = Queue.Queue()
+        self.num_apis = 0
+        if not api is None:
+            self.num_apis = 1
+            self.idle.put(api)
+
+        self.num_failures = 0
+        self.breaker_open_until = None
+        self.breaker_probing = False
+
+        self.num_queries = 0
+        self.num_retries = 0
+
+        # For streaming we talk to the DBS server directly.
+        self.url = url
+        if api_version is None:
+            api_version = DBSClient.api_version_default
+        self.api_version = api_version
+        self.streaming = not url is None
+        # Streams do not use our API instances, so they need their
+        # own limit.
+        self.stream_slots = threading.Semaphore(pool_size)
+        self.stream_chunk_size = 1024 * 1024
+        self.stream_timeout = 600.
+
+    def log(self, level, msg):
+        "Log a message, if we have a logger."
+
+        if not self.logger is None:
+            getattr(self.logger, level)(msg)
+
+    def acquire(self):
+        """Get an API instance from the pool.
+
+        If there is no idle instance and the pool is not full yet a
+        new one is created. Otherwise we wait for someone to return
+        theirs.
 
-        # End of __init__.
+        """
+
+        while True:
+            try:
+                return self.idle.get_nowait()
+            except Queue.Empty:
+                pass
+            self.lock.acquire()
+            try:
+                create = (self.num_apis < self.pool_size)
+                if create:
+                    self.num_apis += 1
+            finally:
+                self.lock.release()
+            if create:
+                try:
+                    api = self.api_factory()
+                except:
+                    self.discard()
+                    raise
+                return api
+            try:
+                # NOTE: Wait in small steps to stay interruptible.
+                return self.idle.get(True, 1.)
+            except Queue.Empty:
+                pass
+
+        # End of acquire.
+
+    def release(self, api):
+        "Return an API instance to the pool."
+
+        self.idle.put(api)
+
+        # End of release.
+
+    def discard(self):
+        "Forget about an API instance that went bad."
+
+        self.lock.acquire()
+        try:
+            self.num_apis -= 1
+        finally:
+            self.lock.release()
+
+        # End of discard.
+
+    def check_breaker(self):
+        """Fail right away if the circuit breaker is open.
+
+        """
+
+        self.lock.acquire()
+        try:
+            if self.breaker_open_until is None:
+                return
+            if self.breaker_probing or \
+                   time.time() < self.breaker_open_until:
+                raise Error("ERROR: DBS circuit breaker is open " \
+                            "(%d consecutive failures)" % \
+                            self.num_failures)
+            # Half-open: let this one through to see if DBS is
+            # feeling better.
+            self.breaker_probing = True
+        finally:
+            self.lock.release()
+
+        # End of check_breaker.
+
+    def record_success(self):
+        "Close the circuit breaker after a successful query."
+
+        self.lock.acquire()
+        try:
+            if not self.breaker_open_until is None:
+                self.log("info", "DBS seems to be fine again " \
+                         "--> closing circuit breaker")
+            self.num_failures = 0
+            self.breaker_open_until = None
+            self.breaker_probing = False
+        finally:
+            self.lock.release()
+
+        # End of record_success.
+
+    def record_failure(self):
+        "Count a failure and open the circuit breaker if needed."
+
+        self.lock.acquire()
+        try:
+            self.num_failures += 1
+            if self.breaker_probing or \
+                   (self.breaker_open_until is None and \
+                    self.num_failures >= self.breaker_threshold):
+                self.log("warning", "DBS failed %d time(s) in a row " \
+                         "--> opening circuit breaker for %d seconds" % \
+                         (self.num_failures, self.breaker_cooldown))
+                self.breaker_open_until = time.time() + \
+                                          self.breaker_cooldown
+            self.breaker_probing = False
+        finally:
+            self.lock.release()
+
+        # End of record_failure.
+
+    def end_probe(self):
+        """Finish a half-open probe that ended in neither success nor
+        failure (e.g. a bad query).
+
+        Otherwise the circuit breaker would keep refusing all further
+        queries.
+
+        """
+
+        self.lock.acquire()
+        try:
+            self.breaker_probing = False
+        finally:
+            self.lock.release()
+
+        # End of end_probe.
+
+    def backoff(self, attempt):
+        """Time to wait before retry number attempt (counting from
+        zero).
+
+        NOTE: This uses `full jitter' so threads that failed at the
+        same time do not all come back at the same time.
+
+        """
+
+        backoff = min(self.backoff_max, self.backoff_base * (2 ** attempt))
+
+        # End of backoff.
+        return uniform(0., backoff)
+
+    def execute(self, query):
+        """Execute a DBS query and return the raw XML result.
+
+        Raises Error if the query could not be executed, even after
+        retrying.
+
+        """
+
+        self.lock.acquire()
+        try:
+            self.num_queries += 1
+        finally:
+            self.lock.release()
+
+        attempt = 0
+        while True:
+            self.check_breaker()
+            api = None
+            try:
+                api = self.acquire()
+                result = api.executeQuery(query)
+            except self.fatal_exceptions, err:
+                if not api is None:
+                    self.release(api)
+                self.end_probe()
+                raise Error("ERROR: DBS query `%s' failed: %s" % \
+                            (query, err))
+            except self.retry_exceptions, err:
+                if not api is None:
+                    self.discard()
+                self.record_failure()
+                if attempt >= self.max_retries:
+                    raise Error("ERROR: DBS query `%s' failed " \
+                                "after %d attempt(s): %s" % \
+                                (query, attempt + 1, err))
+                delay = self.backoff(attempt)
+                attempt += 1
+                self.lock.acquire()
+                try:
+                    self.num_retries += 1
+                finally:
+                    self.lock.release()
+                self.log("warning", "DBS query failed (%s), " \
+                         "retry %d of %d in %.1f seconds" % \
+                         (err, attempt, self.max_retries, delay))
+                time.sleep(delay)
+            except:
+                if not api is None:
+                    self.release(api)
+                self.end_probe()
+                raise
+            else:
+                self.release(api)
+                self.record_success()
+                return result
+
+        # End of execute.
+
+    def stream(self, query, consumer):
+        """Execute a DBS query, handing the raw XML result to the
+        consumer piece by piece as it arrives.
+
+        This talks to the DBS server directly instead of going through
+        the DBS API, which always reads the complete result into
+        memory.
+
+        Returns False if nothing was received (and nothing was handed
+        to the consumer). In that case the caller should fall back to
+        execute(), which takes care of retrying. Raises Error if the
+        transfer broke off half-way.
+
+        """
+
+        if not self.streaming:
+            return False
+
+        self.check_breaker()
+
+        self.stream_slots.acquire()
+        try:
+            streamed = self.stream_query(query, consumer)
+        finally:
+            self.stream_slots.release()
+            # NOTE: If nothing came of this execute() will want to
+            # probe again.
+            self.end_probe()
+
+        # End of stream.
+        return streamed
+
+    def stream_query(self, query, consumer):
+        "This is where stream() does the actual work."
+
+        data = urllib.urlencode({"apiversion" : self.api_version,
+                                 "api" : "executeQuery",
+                                 "query" : query})
+        try:
+            response = urllib2.urlopen(self.url, data, self.stream_timeout)
+        except urllib2.HTTPError, err:
+            # The server does not like us talking to it like
+            # this. Don't try again.
+            self.log("debug", "Could not stream DBS query (%s) " \
+                     "--> switching off streaming" % err)
+            self.streaming = False
+            return False
+        except (urllib2.URLError, socket.error,
+                httplib.HTTPException), err:
+            self.log("debug", "Could not stream DBS query (%s)" % err)
+            return False
+
+        num_chunks = 0
+        try:
+            # NOTE: This is how the DBS server tells us about
+            # problems.
+            status_code = response.info().getheader("dbs-status-code")
+            if not status_code in (None, "100"):
+                self.log("debug", "DBS returned status code %s " \
+                         "--> switching off streaming" % status_code)
+                self.streaming = False
+                return False
+            self.lock.acquire()
+            try:
+                self.num_queries += 1
+            finally:
+                self.lock.release()
+            try:
+                while True:
+                    chunk = response.read(self.stream_chunk_size)
+                    if len(chunk) < 1:
+                        break
+                    num_chunks += 1
+                    consumer(chunk)
+            except (socket.error, httplib.HTTPException), err:
+                if num_chunks < 1:
+                    self.log("debug", "Could not stream DBS query " \
+                             "(%s)" % err)
+                    return False
+                self.record_failure()
+                raise Error("ERROR: DBS query `%s' broke off: %s" % \
+                            (query, err))
+        finally:
+            response.close()
+
+        self.record_success()
+
+        # End of stream_query.
+        return True
+
+    # End of DBSClient.
+
+###########################################################################
+## Helper class: DBSQueryPlanner.
+###########################################################################
+
+class DBSQueryPlanner(object):
+    """Combine per-dataset, per-attribute DBS lookups into few queries.
+
+    Instead of asking DBS separately for the runs, the CMSSW version,
+    the data type and the GlobalTag of each dataset, we ask for all of
+    them at once in a single multi-column query. On top of that, if a
+    lot of the datasets we need came from the same wildcarded dataset
+    name, we ask once for the whole wildcard and split the rows back
+    out per dataset afterwards.
+
+    The planner is given the wildcard patterns we already resolved
+    (mapping each pattern to the datasets it matched). A pattern is
+    only used if it covers at least two of the datasets we need and
+    if at least half of what it matches is actually needed. All
+    datasets not covered by any of these patterns get their own
+    (exact-match) query.
+
+    """
+
+    def __init__(self, dataset_patterns=None, run_marks=None):
+        if dataset_patterns is None:
+            dataset_patterns = {}
+        self.dataset_patterns = dataset_patterns
+        # For incremental running: for each dataset only runs after
+        # this one are of interest.
+        if run_marks is None:
+            run_marks = {}
+        self.run_marks = run_marks
+
+    def create_query(self, dataset_spec, attributes):
+        """Create the DBS query for all attributes of dataset_spec.
+
+        """
+
+        if dataset_spec.find("*") > -1:
+            operator = "like"
+        else:
+            operator = "="
+        dbs_query = "find %s where dataset %s %s " \
+                    "and dataset.status = VALID" % \
+                    (", ".join(["dataset"] + attributes),
+                     operator, dataset_spec)
+        if self.run_marks.has_key(dataset_spec):
+            dbs_query += " and run > %d" % self.run_marks[dataset_spec]
+
+        # End of create_query.
+        return dbs_query
+
+    def plan(self, dataset_names, attributes):
+        """Plan the queries to obtain attributes for dataset_names.
+
+        Returns a list of (query, tag names, datasets) tuples. Each
+        dataset appears in exactly one of these.
+
+        """
+
+        needed = set(dataset_names)
+        # Datasets for which we only want the newest runs always get
+        # their own query.
+        needed_any_run = needed - set(self.run_marks.keys())
+
+        candidates = []
+        patterns = self.dataset_patterns.keys()
+        patterns.sort()
+        for pattern in patterns:
+            if pattern.find("*") < 0:
+                continue
+            matches = set(self.dataset_patterns[pattern])
+            useful = matches & needed_any_run
+            if len(useful) < 2 or (2 * len(useful)) < len(matches):
+                continue
+            candidates.append((pattern, matches))
+
+        plans = []
+        tag_names = ["dataset"] + attributes
+        uncovered = set(needed_any_run)
+        while len(candidates) > 0:
+            # Greedy: take the pattern covering most of what is left.
+            (num_covered, index) = max([(len(matches & uncovered), -i) \
+                                        for (i, (pattern, matches)) \
+                                        in enumerate(candidates)])
+            if num_covered < 2:
+                break
+            (pattern, matches) = candidates.pop(-index)
+            covered = matches & uncovered
+            uncovered -= covered
+            covered = list(covered)
+            covered.sort()
+            plans.append((self.create_query(pattern, attributes),
+                          tag_names, covered))
+
+        uncovered = list(uncovered | (needed - needed_any_run))
+        uncovered.sort()
+        for dataset_name in uncovered:
+            plans.append((self.create_query(dataset_name, attributes),
+                          tag_names, [dataset_name]))
+
+        # End of plan.
+        return plans
+
+    def split(self, plans, results):
+        """Split the query results back out per dataset.
+
+        Takes the plans and, for each of them, the parsed DBS results
+        (i.e. the DBSXMLHandler results dictionary). Returns a
+        dictionary mapping each dataset name to a dictionary of
+        attribute name -> list of values (one entry per row).
+
+        NOTE: Datasets for which DBS returned no rows at all do not
+        appear in the output.
+
+        """
+
+        per_dataset = {}
+        for ((dbs_query, tag_names, dataset_names), result) in \
+                zip(plans, results):
+            wanted = set(dataset_names)
+            if not result.has_key("dataset"):
+                continue
+            for (index, dataset_name) in enumerate(result["dataset"]):
+                if not dataset_name in wanted:
+                    continue
+                if not per_dataset.has_key(dataset_name):
+                    per_dataset[dataset_name] = dict([(i, []) \
+                                                      for i in tag_names \
+                                                      if i != "dataset"])
+                for tag_name in tag_names:
+                    if tag_name != "dataset":
+                        per_dataset[dataset_name][tag_name]. \
+                                    append(result[tag_name][index])
+
+        # End of split.
+        return per_dataset
+
+    def run_ranges(runs, runs_selected, chunk_size=0):
+        """Cover the selected runs with as few run ranges as possible.
+
+        Takes the (sorted) list of all runs of a dataset and the set
+        of runs we are interested in. Returns a list of conditions to
+        add to a DBS query, each restricting it to a range of
+        consecutive selected runs. If chunk_size is given, no range
+        covers more than that many runs.
+
+        """
+
+        conditions = []
+        index = 0
+        while index < len(runs):
+            if not runs[index] in runs_selected:
+                index += 1
+                continue
+            index_end = index + 1
+            while index_end < len(runs) and \
+                      runs[index_end] in runs_selected and \
+                      (chunk_size < 1 or index_end - index < chunk_size):
+                index_end += 1
+            condition = ""
+            if index > 0:
+                condition += " and run >= %d" % runs[index]
+            if index_end < len(runs):
+                condition += " and run < %d" % runs[index_end]
+            conditions.append(condition)
+            index = index_end
+
+        # End of run_ranges.
+        return conditions
+
+    run_ranges = staticmethod(run_ranges)
+
+    # End of DBSQueryPlanner.
+
+###########################################################################
+## Helper class: IncrementalState.
+###########################################################################
+
+class IncrementalState(object):
+    """High-water marks for incremental dataset discovery.
+
+    Keeps track of the most recent dataset creation date we have seen
+    and, for each dataset, of the highest run number we have seen. On
+    the next run we then only have to ask DBS for datasets created
+    after that date and for runs after those run numbers.
+
+    The state is stored as a (JSON) dictionary in a small file.
+
+    """
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.createdate_mark = None
+        self.last_runs = {}
+
+    def createdate_key(self, createdate):
+        """Sort key for creation dates.
+
+        NOTE: DBS returns these as strings. Compare numerically if
+        possible, otherwise as strings.
+
+        """
+
+        try:
+            key = (0, float(createdate), createdate)
+        except ValueError:
+            key = (1, 0., createdate)
+
+        # End of createdate_key.
+        return key
+
+    def load(self):
+        """Load the state from file.
+
+        A missing file simply means we start from scratch.
+
+        """
+
+        if not os.path.exists(self.file_name):
+            return
+        try:
+            state_file = open(self.file_name, "r")
+            try:
+                state = json.load(state_file)
+            finally:
+                state_file.close()
+        except (IOError, ValueError):
+            raise Error("ERROR: Could not read incremental state " \
+                        "file `%s'" % self.file_name)
+        createdate_mark = state.get("createdate_mark", None)
+        if not createdate_mark is None:
+            createdate_mark = str(createdate_mark)
+            if self.createdate_key(createdate_mark)[0] != 0:
+                raise Error("ERROR: Invalid dataset creation date mark " \
+                            "`%s' in incremental state file `%s'" % \
+                            (createdate_mark, self.file_name))
+        self.createdate_mark = createdate_mark
+        self.last_runs = dict([(str(i), int(j)) for (i, j) \
+                               in state.get("last_runs", {}).items()])
+
+        # End of load.
+
+    def save(self):
+        """Save the state to file.
+
+        """
+
+        state = {
+            "createdate_mark" : self.createdate_mark,
+            "last_runs" : self.last_runs,
+            }
+        write_json_atomically(self.file_name, state,
+                              "incremental state file", indent=1)
+
+        # End of save.
+
+    def update_createdate_mark(self, createdates):
+        """Move the creation date mark past all createdates given.
+
+        NOTE: The mark ends up in DBS queries, so anything that does
+        not look like a number is ignored.
+
+        """
+
+        candidates = [i for i in createdates \
+                      if self.createdate_key(i)[0] == 0]
+        if not self.createdate_mark is None:
+            candidates.append(self.createdate_mark)
+        if len(candidates) > 0:
+            self.createdate_mark = max(candidates, key=self.createdate_key)
+
+        # End of update_createdate_mark.
+
+    def update_last_run(self, dataset_name, runs):
+        "Move the run mark for this dataset past all runs given."
+
+        runs = list(runs)
+        if self.last_runs.has_key(dataset_name):
+            runs.append(self.last_runs[dataset_name])
+        if len(runs) > 0:
+            self.last_runs[dataset_name] = max(runs)
+
+        # End of update_last_run.
+
+    # End of IncrementalState.
+
+###########################################################################
+## Helper class: SingleFlight.
+###########################################################################
+
+class SingleFlight(object):
+    """Make sure the same question is only asked once.
+
+    The first caller asking for a given key does the actual work. Any
+    other callers asking for the same key, either at the same time or
+    later on, wait for and share that same result. Failures are not
+    remembered: the next caller for that key tries again.
+
+    NOTE: All callers get the very same result object, so they should
+    not modify it.
+
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.num_calls = 0
+        self.num_shared = 0
+
+    def do(self, key, func, *args):
+        "Return func(*args), unless someone already asked for key."
+
+        self.lock.acquire()
+        try:
+            call = self.calls.get(key, None)
+            leader = call is None
+            if leader:
+                call = {"done" : threading.Event(),
+                        "result" : None,
+                        "exc_info" : None}
+                self.calls[key] = call
+                self.num_calls += 1
+            else:
+                self.num_shared += 1
+        finally:
+            self.lock.release()
+
+        if leader:
+            try:
+                call["result"] = func(*args)
+            except:
+                call["exc_info"] = sys.exc_info()
+                self.lock.acquire()
+                try:
+                    del self.calls[key]
+                finally:
+                    self.lock.release()
+            call["done"].set()
+        else:
+            # NOTE: Wait in small steps to stay interruptible.
+            while not call["done"].isSet():
+                call["done"].wait(1.)
+
+        if not call["exc_info"] is None:
+            (exc_type, exc_value, exc_traceback) = call["exc_info"]
+            raise exc_type, exc_value, exc_traceback
+
+        # End of do.
+        return call["result"]
+
+    # End of SingleFlight.
+
+###########################################################################
+## Helper class: DBSTelemetry.
+###########################################################################
+
+class DBSTelemetry(object):
+    """Keeps track of what all our DBS queries cost.
+
+    For each query we record the query template (i.e. the query with
+    the dataset name and numbers taken out), the dataset, where the
+    result came from (DBS, the DBS cache or streamed from DBS), the
+    latency, the size of the response, the time it took to parse the
+    response and the number of rows in it.
+
+    """
+
+    # Upper edges (in seconds) of the latency histogram bins.
+    histogram_edges = [.1, .3, 1., 3., 10., 30., 100.]
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.records = []
+
+    def query_template(self, query):
+        "Strip the specifics from a query."
+
+        template = " ".join(query.split())
+        template = re.sub("dataset (=|like) [^ ]+", "dataset \\1 ?",
+                          template)
+        template = re.sub("([=<>] )[0-9]+", "\\1?", template)
+
+        # End of query_template.
+        return template
+
+    def query_dataset(self, query):
+        "Figure out the dataset (name or pattern) a query is about."
+
+        match = re.search("dataset (=|like) ([^ ]+)", query)
+        if match is None:
+            dataset = None
+        else:
+            dataset = match.group(2)
+
+        # End of query_dataset.
+        return dataset
+
+    def record(self, query, source, latency, num_bytes, parse_time,
+               num_rows):
+        "Record the cost of a single query."
+
+        record = {
+            "template" : self.query_template(query),
+            "dataset" : self.query_dataset(query),
+            "query" : " ".join(query.split()),
+            "source" : source,
+            "latency" : latency,
+            "bytes" : num_bytes,
+            "parse_time" : parse_time,
+            "rows" : num_rows,
+            }
+        self.lock.acquire()
+        try:
+            self.records.append(record)
+        finally:
+            self.lock.release()
+
+        # End of record.
+
+    def totals(self):
+        """Sum everything up per query template.
+
+        Returns a list of (template, totals dictionary) pairs, most
+        expensive templates first.
+
+        """
+
+        totals = {}
+        for record in self.records:
+            try:
+                total = totals[record["template"]]
+            except KeyError:
+                total = {"count" : 0, "latency" : 0., "bytes" : 0,
+                         "parse_time" : 0., "rows" : 0}
+                totals[record["template"]] = total
+            total["count"] += 1
+            for key in ["latency", "bytes", "parse_time", "rows"]:
+                total[key] += record[key]
+
+        totals = totals.items()
+        totals.sort(key=lambda i: i[1]["latency"] + i[1]["parse_time"],
+                    reverse=True)
+
+        # End of totals.
+        return totals
+
+    def slowest(self, num):
+        "The num slowest queries."
+
+        records = list(self.records)
+        records.sort(key=lambda i: i["latency"] + i["parse_time"],
+                     reverse=True)
+
+        # End of slowest.
+        return records[:num]
+
+    def histogram(self):
+        """Latency histogram.
+
+        Returns a list of (bin label, number of queries) pairs.
+
+        """
+
+        edges = DBSTelemetry.histogram_edges
+        counts = [0] * (len(edges) + 1)
+        for record in self.records:
+            index = 0
+            while index < len(edges) and record["latency"] >= edges[index]:
+                index += 1
+            counts[index] += 1
+
+        labels = []
+        for (index, edge) in enumerate(edges):
+            labels.append("< %gs" % edge)
+        labels.append(">= %gs" % edges[-1])
+
+        # End of histogram.
+        return zip(labels, counts)
+
+    def summary(self, num_slowest=10):
+        """Format a human readable summary.
+
+        Returns a list of lines.
+
+        """
+
+        lines = []
+        num_queries = len(self.records)
+        total_latency = sum([i["latency"] for i in self.records])
+        total_bytes = sum([i["bytes"] for i in self.records])
+        total_parse_time = sum([i["parse_time"] for i in self.records])
+        total_rows = sum([i["rows"] for i in self.records])
+        lines.append("DBS telemetry: %d quer(y/ies), %.1f s waiting, " \
+                     "%.1f MB, %.1f s parsing, %d row(s)" % \
+                     (num_queries, total_latency,
+                      total_bytes / (1024. * 1024.),
+                      total_parse_time, total_rows))
+
+        lines.append("  Totals per query type:")
+        for (template, total) in self.totals():
+            lines.append("    %5d x %8.2f s %9.1f MB %8.2f s %9d row(s): %s" % \
+                         (total["count"], total["latency"],
+                          total["bytes"] / (1024. * 1024.),
+                          total["parse_time"], total["rows"], template))
+
+        lines.append("  Slowest queries:")
+        for record in self.slowest(num_slowest):
+            lines.append("    %8.2f s + %6.2f s (%s, %d row(s)): %s" % \
+                         (record["latency"], record["parse_time"],
+                          record["source"], record["rows"],
+                          record["query"]))
+
+        lines.append("  Latency histogram:")
+        for (label, count) in self.histogram():
+            lines.append("    %-8s: %d" % (label, count))
+
+        # End of summary.
+        return lines
+
+    def write_json(self, file_name):
+        "Write all records (plus a summary) to a JSON file."
+
+        data = {
+            "queries" : self.records,
+            "totals" : dict(self.totals()),
+            "histogram" : self.histogram(),
+            }
+        try:
+            json_file = open(file_name, "w")
+            try:
+                json.dump(data, json_file, indent=1)
+            finally:
+                json_file.close()
+        except IOError:
+            raise Error("ERROR: Could not write DBS telemetry " \
+                        "file `%s'" % file_name)
+
+        # End of write_json.
+
+    # End of DBSTelemetry.
+
+###########################################################################
+## Helper class: RunSpreadIndex.
+###########################################################################
+
+class RunSpreadIndex(object):
+    """Figures out where the events in each run of a dataset are.
+
+    Takes the per-run file catalog built from DBS (run number -> file
+    name -> (number of events, list of sites)) and inverts it: for
+    each run and each site the number of files and events at that
+    site. From that it derives, for each run, the number of events at
+    each site, and whether the run is `mirrored' (i.e. at least one
+    site has a complete copy, which is the case if it has as many
+    files as the run) or spread-out.
+
+    All of this takes a single pass over the files, instead of a
+    pass over all files for each site.
+
+    """
+
+    def __init__(self, files_info=None):
+        self.files_info = files_info
+
+    def catalog(self, counts=None):
+        """Build the number-of-events catalog.
+
+        Returns a dictionary run number -> dictionary with the number
+        of events at each site (only for the sites that will be
+        considered), at all sites combined (`all_sites') and the
+        `mirrored' flag (None if the run is at less than two sites).
+
+        The counts per run and site can also be given directly (in
+        the format returned by site_counts()) instead of being
+        derived from the file catalog.
+
+        """
+
+        if counts is None:
+            counts = self.site_counts()
+
+        catalog = {}
+        for (run_number, (num_files, num_events,
+                          site_files, site_events)) in counts.iteritems():
+            catalog[run_number] = self.classify(num_files, num_events,
+                                                site_files, site_events)
+
+        # End of catalog.
+        return catalog
+
+    def classify(self, num_files, num_events, site_files, site_events):
+        """Decide on mirrored or spread-out for a single run.
+
+        The rule is that we're dealing with a spread-out run unless
+        we can find at least one site containing exactly the full
+        list of files for this run that DBS knows about. In that case
+        we only use the site(s) with complete copies.
+
+        """
+
+        site_names = site_files.keys()
+
+        # NOTE: The term `mirrored' does not have the usual meaning
+        # here. It basically means that we can apply single-step
+        # harvesting.
+        mirrored = None
+        if len(site_names) > 1:
+            sites_with_complete_copies = [i for i in site_names \
+                                          if site_files[i] == num_files]
+            mirrored = (len(sites_with_complete_copies) > 0)
+            if mirrored:
+                site_names = sites_with_complete_copies
+
+        result = {"all_sites" : num_events, "mirrored" : mirrored}
+        for site_name in site_names:
+            result[site_name] = site_events[site_name]
+
+        # End of classify.
+        return result
+
+    def site_counts(self):
+        """Count files and events per run and site.
+
+        Returns a dictionary run number -> (number of files, number
+        of events, site -> number of files, site -> number of
+        events).
+
+        """
+
+        counts = {}
+        for (run_number, files) in self.files_info.iteritems():
+            num_events = 0
+            site_files = {}
+            site_events = {}
+            for (nevents, site_names) in files.itervalues():
+                num_events += nevents
+                # NOTE: The same file can be listed more than once
+                # for a given site.
+                for site_name in set(site_names):
+                    try:
+                        site_files[site_name] += 1
+                        site_events[site_name] += nevents
+                    except KeyError:
+                        site_files[site_name] = 1
+                        site_events[site_name] = nevents
+            counts[run_number] = (len(files), num_events,
+                                  site_files, site_events)
+
+        # End of site_counts.
+        return counts
+
+    # End of RunSpreadIndex.
+
+###########################################################################
+## Helper class: SpreadCatalogCache.
+###########################################################################
+
+class SpreadCatalogCache(object):
+    """Per-run spread catalogs kept from one harvester run to the next.
+
+    Figuring out which sites have (how many of) the events in each
+    run means listing all files of a dataset. For datasets that did
+    not change since last time that is a waste. So for each dataset
+    we store the per-run catalog (see RunSpreadIndex.catalog())
+    together with a fingerprint of each run: the number of files,
+    the number of events and the last modification date of its files.
+    Asking DBS for these fingerprints takes a single (cheap) summary
+    query, and only the runs with a different fingerprint then have
+    to be looked at again.
+
+    NOTE: The fingerprint does not change when a block is transferred
+    to (or deleted from) a site. Therefore entries are only trusted
+    for a limited time (like the site information in the
+    DBSQueryCache).
+
+    The cache is stored as a (JSON) dictionary in a file.
+
+    """
+
+    # Maximum age (in seconds) of the entries.
+    max_age = 6 * 3600
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        # Dataset name -> run number -> (fingerprint, catalog, time
+        # stored).
+        self.datasets = {}
+        self.lock = threading.Lock()
+
+    def load(self):
+        """Load the cache from file.
+
+        A missing file simply means we start from scratch.
+
+        """
+
+        if not os.path.exists(self.file_name):
+            return
+        try:
+            cache_file = open(self.file_name, "r")
+            try:
+                cache = json.load(cache_file)
+            finally:
+                cache_file.close()
+        except (IOError, ValueError):
+            raise Error("ERROR: Could not read spread catalog cache " \
+                        "file `%s'" % self.file_name)
+
+        # NOTE: JSON only knows about string keys (and unicode).
+        datasets = {}
+        for (dataset_name, runs) in cache.items():
+            entries = {}
+            for (run_number, entry) in runs.items():
+                (fingerprint, info) = entry[:2]
+                # NOTE: Entries without time stamp are considered
+                # expired.
+                time_stored = 0.
+                if len(entry) > 2:
+                    time_stored = float(entry[2])
+                (num_files, num_events, moddate) = fingerprint
+                catalog = {}
+                for (key, value) in info.items():
+                    if isinstance(value, basestring):
+                        value = str(value)
+                    catalog[str(key)] = value
+                entries[int(run_number)] = ((int(num_files),
+                                             int(num_events),
+                                             str(moddate)),
+                                            catalog,
+                                            time_stored)
+            datasets[str(dataset_name)] = entries
+        self.datasets = datasets
+
+        # End of load.
+
+    def save(self):
+        """Save the cache to file.
+
+        """
+
+        self.lock.acquire()
+        try:
+            cache = {}
+            for (dataset_name, entries) in self.datasets.items():
+                cache[dataset_name] = dict([(str(i), j) for (i, j) \
+                                            in entries.items()])
+        finally:
+            self.lock.release()
+        write_json_atomically(self.file_name, cache,
+                              "spread catalog cache file")
+
+        # End of save.
+
+    def lookup(self, dataset_name, fingerprints):
+        """Split the runs into cached and changed ones.
+
+        Returns the catalog for all runs whose fingerprint did not
+        change (and whose entries did not expire), and the list of all
+        other runs.
+
+        """
+
+        time_min = time.time() - SpreadCatalogCache.max_age
+        self.lock.acquire()
+        try:
+            entries = self.datasets.get(dataset_name, {})
+            catalog = {}
+            runs_changed = []
+            for (run_number, fingerprint) in fingerprints.iteritems():
+                entry = entries.get(run_number, None)
+                if not entry is None and entry[0] == fingerprint and \
+                       entry[2] >= time_min:
+                    # NOTE: Hand out copies. The catalog is modified
+                    # later on.
+                    catalog[run_number] = dict(entry[1])
+                else:
+                    runs_changed.append(run_number)
+        finally:
+            self.lock.release()
+        runs_changed.sort()
+
+        # End of lookup.
+        return (catalog, runs_changed)
+
+    def update(self, dataset_name, fingerprints, catalog, run_mark=None):
+        """Store the catalog for all runs fingerprinted this time.
+
+        Runs that disappeared from the dataset are forgotten. (Except
+        for runs at or before the run mark, which we did not ask
+        about at all.)
+
+        """
+
+        time_stored = time.time()
+        self.lock.acquire()
+        try:
+            entries = self.datasets.get(dataset_name, {})
+            for run_number in entries.keys():
+                if not fingerprints.has_key(run_number) and \
+                       (run_mark is None or run_number > run_mark):
+                    del entries[run_number]
+            for (run_number, fingerprint) in fingerprints.iteritems():
+                if catalog.has_key(run_number):
+                    entries[run_number] = (fingerprint,
+                                           dict(catalog[run_number]),
+                                           time_stored)
+            self.datasets[dataset_name] = entries
+        finally:
+            self.lock.release()
+
+        # End of update.
+
+    # End of SpreadCatalogCache.
+
+###########################################################################
+## Helper class: SiteCapabilityIndex.
+###########################################################################
+
+class SiteCapabilityIndex(object):
+    """Which CMSSW versions are available close to which SE.
+
+    Instead of asking the grid information system about each (SE,
+    CMSSW version) pair separately (which is very slow), we ask once
+    for all production CEs together with their close SEs and their
+    published software tags. From that we build a mapping SE -> CE
+    -> set of tags, which answers all further questions from memory.
+
+    The index can be stored in a (JSON) snapshot file, so it does not
+    have to be rebuilt each time.
+
+    """
+
+    # The bulk version of the query used in pick_a_site().
+    lcg_info_cmd = "lcg-info --list-ce " \
+                   "--query 'CEStatus=Production' " \
+                   "--attrs 'CloseSE,Tag'"
+
+    # Only tags with this prefix are of interest.
+    tag_prefix = "VO-cms-"
+
+    # Snapshots older than this (in seconds) are not used.
+    snapshot_max_age = 24 * 3600
+
+    def __init__(self):
+        # SE name -> CE name -> set of tags.
+        self.ses = {}
+        self.created = time.time()
+
+    def parse_lcg_info(self, output):
+        """Build the index from the output of lcg_info_cmd.
+
+        The output looks like this, with one block per CE. Attributes
+        with more than one value either have them separated by commas
+        or continued on the following lines.
+
+          - CE: ce.example.org:2119/jobmanager-lcgpbs-cms
+            - CloseSE             se.example.org
+            - Tag                 VO-cms-CMSSW_3_3_0
+                                  VO-cms-CMSSW_3_3_1
+
+        """
+
+        ses = {}
+        ces = []
+
+        def add_ce(ce_info):
+            if ce_info is None:
+                return
+            (ce_name, attrs) = ce_info
+            tags = set([i for i in attrs.get("Tag", []) \
+                        if i.startswith(SiteCapabilityIndex.tag_prefix)])
+            for se_name in attrs.get("CloseSE", []):
+                if not ses.has_key(se_name):
+                    ses[se_name] = {}
+                if not ses[se_name].has_key(ce_name):
+                    ses[se_name][ce_name] = set()
+                ses[se_name][ce_name].update(tags)
+
+        ce_info = None
+        attr_values = None
+        for line in output.splitlines():
+            match = re.match("^\s*- CE:\s*(\S+)", line)
+            if not match is None:
+                add_ce(ce_info)
+                ce_info = (match.group(1), {})
+                attr_values = None
+                continue
+            if ce_info is None or len(line.strip()) < 1:
+                continue
+            match = re.match("^\s*- (\S+)\s*(.*)$", line)
+            if not match is None:
+                attr_values = ce_info[1].setdefault(match.group(1), [])
+                value = match.group(2)
+            elif not attr_values is None:
+                value = line
+            else:
+                continue
+            attr_values.extend([i for i in re.split("[\s,]+", value) \
+                                if len(i) > 0])
+        add_ce(ce_info)
+
+        self.ses = ses
+        self.created = time.time()
+
+        # End of parse_lcg_info.
+
+    def build(self):
+        """Build the index from a bulk information system query.
+
+        """
+
+        (status, output) = commands.getstatusoutput(SiteCapabilityIndex. \
+                                                    lcg_info_cmd)
+        if status != 0:
+            raise Error("ERROR: Could not obtain site information " \
+                        "using `%s'" % SiteCapabilityIndex.lcg_info_cmd)
+        self.parse_lcg_info(output)
+
+        # End of build.
+
+    def load(self, file_name):
+        """Load the index from a snapshot file.
+
+        Returns False if there is no (usable) snapshot.
+
+        """
+
+        if not os.path.exists(file_name):
+            return False
+        try:
+            snapshot_file = open(file_name, "r")
+            try:
+                snapshot = json.load(snapshot_file)
+            finally:
+                snapshot_file.close()
+        except (IOError, ValueError):
+            return False
+        created = snapshot.get("created", 0)
+        if time.time() - created > SiteCapabilityIndex.snapshot_max_age:
+            return False
+
+        ses = {}
+        for (se_name, ces) in snapshot.get("ses", {}).items():
+            ses[str(se_name)] = dict([(str(i), set([str(k) for k in j])) \
+                                      for (i, j) in ces.items()])
+        self.ses = ses
+        self.created = created
+
+        # End of load.
+        return True
+
+    def save(self, file_name):
+        """Save the index to a snapshot file.
+
+        """
+
+        ses = {}
+        for (se_name, ces) in self.ses.items():
+            ses[se_name] = dict([(i, list(j)) for (i, j) in ces.items()])
+        snapshot = {
+            "created" : self.created,
+            "ses" : ses,
+            }
+        write_json_atomically(file_name, snapshot,
+                              "site information snapshot")
+
+        # End of save.
+
+    def ces(self, se_name, cmssw_version):
+        "All production CEs close to this SE that have this version."
+
+        tag = "%s%s" % (SiteCapabilityIndex.tag_prefix, cmssw_version)
+        ces = [i for (i, j) in self.ses.get(se_name, {}).items() \
+               if tag in j]
+
+        # End of ces.
+        return ces
+
+    def has_version(self, se_name, cmssw_version):
+        "Is this CMSSW version available close to this SE?"
+
+        return len(self.ces(se_name, cmssw_version)) > 0
+
+    # End of SiteCapabilityIndex.
+
+###########################################################################
+## Helper class: SiteVersionCache.
+###########################################################################
+
+class SiteVersionCache(object):
+    """Persistent cache of which CMSSW versions are at which sites.
+
+    Remembers, from one harvester run to the next, the answers to the
+    question whether a given CMSSW version is available at a given
+    site. Positive answers (a version is not going to disappear any
+    time soon) are kept longer than negative ones (a version may be
+    installed any time).
+
+    The cache is stored as a (JSON) dictionary in a file. Several
+    harvesters can share the same file: all access is protected by a
+    lock on a separate lock file, and when saving we merge our new
+    answers with whatever the others stored in the meantime.
+
+    """
+
+    # Time-to-live (in seconds) for positive and negative answers.
+    ttl_positive = 7 * 24 * 3600
+    ttl_negative = 6 * 3600
+
+    def __init__(self, file_name, refresh=False):
+        self.file_name = file_name
+        self.lock_file_name = "%s.lock" % file_name
+        self.refresh = refresh
+        # (SE name, CMSSW version) -> (available, time stamp) for
+        # everything we found out ourselves.
+        self.updates = {}
+
+    def lock(self, exclusive=False):
+        "Get hold of the lock. Returns the (open) lock file."
+
+        # End of lock.
+        return acquire_file_lock(self.lock_file_name, exclusive,
+                                 "site version cache lock file")
+
+    def unlock(self, lock_file):
+        "Release the lock again."
+
+        release_file_lock(lock_file)
+
+        # End of unlock.
+
+    def ttl(self, available):
+        if available:
+            return SiteVersionCache.ttl_positive
+        return SiteVersionCache.ttl_negative
+
+    def read(self):
+        """Read all entries from file.
+
+        NOTE: The caller should hold the lock.
+
+        """
+
+        entries = {}
+        if not os.path.exists(self.file_name):
+            return entries
+        try:
+            cache_file = open(self.file_name, "r")
+            try:
+                cache = json.load(cache_file)
+            finally:
+                cache_file.close()
+        except (IOError, ValueError):
+            raise Error("ERROR: Could not read site version cache " \
+                        "file `%s'" % self.file_name)
+        for (se_name, versions) in cache.items():
+            for (cmssw_version, (available, time_stamp)) in versions.items():
+                entries[(str(se_name), str(cmssw_version))] = \
+                                       (bool(available), time_stamp)
+
+        # End of read.
+        return entries
+
+    def load(self):
+        """Load all answers that have not expired yet.
+
+        Returns a dictionary SE name -> CMSSW version -> available
+        (i.e. in the format of sites_and_versions_cache).
+
+        """
+
+        sites_and_versions = {}
+        if self.refresh:
+            return sites_and_versions
+
+        lock_file = self.lock()
+        try:
+            entries = self.read()
+        finally:
+            self.unlock(lock_file)
+
+        now = time.time()
+        for ((se_name, cmssw_version), (available, time_stamp)) in \
+                entries.items():
+            if now - time_stamp < self.ttl(available):
+                if not sites_and_versions.has_key(se_name):
+                    sites_and_versions[se_name] = {}
+                sites_and_versions[se_name][cmssw_version] = available
+
+        # End of load.
+        return sites_and_versions
+
+    def put(self, se_name, cmssw_version, available):
+        "Remember a new answer."
+
+        self.updates[(se_name, cmssw_version)] = (available, time.time())
+
+        # End of put.
+
+    def save(self):
+        """Merge our new answers into the cache file.
+
+        Expired entries are dropped while we're at it.
+
+        """
+
+        if len(self.updates) < 1:
+            return
+
+        lock_file = self.lock(exclusive=True)
+        try:
+            try:
+                entries = self.read()
+            except Error:
+                # A corrupt cache is simply replaced.
+                entries = {}
+            for (key, (available, time_stamp)) in self.updates.items():
+                if not entries.has_key(key) or \
+                       entries[key][1] < time_stamp:
+                    entries[key] = (available, time_stamp)
+
+            now = time.time()
+            cache = {}
+            for ((se_name, cmssw_version), (available, time_stamp)) in \
+                    entries.items():
+                if now - time_stamp < self.ttl(available):
+                    if not cache.has_key(se_name):
+                        cache[se_name] = {}
+                    cache[se_name][cmssw_version] = [available, time_stamp]
+
+            write_json_atomically(self.file_name, cache,
+                                  "site version cache file", indent=1)
+        finally:
+            self.unlock(lock_file)
+        self.updates = {}
+
+        # End of save.
+
+    # End of SiteVersionCache.
+
+###########################################################################
+## Helper class: SiteScheduler.
+###########################################################################
+
+class SiteScheduler(object):
+    """Spread harvesting jobs over sites as evenly as possible.
+
+    Each job has an expected load (e.g. its number of events), the
+    number of sites it should run at, and its candidate sites. The
+    candidates come in groups in order of preference (e.g. first the
+    T1 sites, then all others): a site from a later group is only
+    used if there is none left in the earlier ones.
+
+    All jobs are placed at once, largest first, each at the candidate
+    site with the smallest load so far (relative to the capacity
+    weight of that site). This `longest processing time first' rule
+    keeps the maximum load of any site close to the smallest possible
+    one, whereas picking sites at random tends to pile up jobs at a
+    few sites.
+
+    """
+
+    def __init__(self, weights=None):
+        # Site name -> relative capacity (one if not given).
+        if weights is None:
+            weights = {}
+        self.weights = weights
+        # Site name -> load placed at that site so far.
+        self.loads = {}
+
+    def weight(self, site_name):
+        return self.weights.get(site_name, 1.)
+
+    def relative_load(self, site_name, load=0):
+        "Load of this site (relative to its weight), with load added."
+
+        return (self.loads.get(site_name, 0) + load) / \
+               float(self.weight(site_name))
+
+    def assign(self, jobs):
+        """Decide where each job will run.
+
+        Takes a list of jobs, each given as (key, load, number of
+        sites, list of groups of candidate sites). Returns a
+        dictionary key -> list of chosen sites.
+
+        """
+
+        jobs = list(jobs)
+        # NOTE: Sorting on the keys as well keeps things
+        # reproducible.
+        jobs.sort(key=lambda job: (-job[1], job[0]))
+
+        plan = {}
+        for (key, load, num_sites, site_groups) in jobs:
+            site_names = []
+            while len(site_names) < num_sites:
+                candidates = []
+                for site_group in site_groups:
+                    candidates = [i for i in site_group \
+                                  if not i in site_names]
+                    if len(candidates) > 0:
+                        break
+                if len(candidates) < 1:
+                    break
+                site_name = min(candidates,
+                                key=lambda i: (self.relative_load(i, load),
+                                               candidates.index(i)))
+                site_names.append(site_name)
+                self.loads[site_name] = self.loads.get(site_name, 0) + load
+            plan[key] = site_names
+
+        # End of assign.
+        return plan
+
+    # End of SiteScheduler.
+
+###########################################################################
+## Helper class: HedgeManifest.
+###########################################################################
+
+class HedgeManifest(object):
+    """Keeps track of runs submitted to more than one site.
+
+    For each hedged run we store where its output should end up and
+    the names of the multicrab blocks (i.e. the CRAB tasks) that were
+    created for it. Once the output of one of them has arrived, the
+    others can be killed. See CMSHarvester.reap_hedges().
+
+    The manifest is stored as a (JSON) list in a file. Both new
+    submissions and the reaping add to the same file, so all access
+    is protected by a lock on a separate lock file and when saving we
+    merge our entries with whatever the others stored in the
+    meantime. Entries for runs whose output arrived are kept for a
+    while (so the merging does not bring them back), and then
+    dropped.
+
+    """
+
+    # Time (in seconds) to keep entries for runs whose output arrived.
+    max_age_done = 7 * 24 * 3600
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.lock_file_name = "%s.lock" % file_name
+        self.entries = []
+
+    def add(self, dataset_name, run_number, output_dir, output_file_name,
+            block_name, site_name):
+        "Add a block (i.e. a submission) for this run."
+
+        for entry in self.entries:
+            if entry["dataset"] == dataset_name and \
+                   entry["run"] == run_number:
+                break
+        else:
+            entry = {
+                "dataset" : dataset_name,
+                "run" : run_number,
+                "output_dir" : output_dir,
+                "output_file" : output_file_name,
+                "blocks" : [],
+                "done" : False,
+                }
+            self.entries.append(entry)
+        entry["blocks"].append({"name" : block_name, "site" : site_name})
+
+        # End of add.
+
+    def pending(self):
+        "All entries for which we have not seen any output yet."
+
+        return [i for i in self.entries if not i["done"]]
+
+    def mark_done(self, entry):
+        "The output for this entry has arrived."
+
+        entry["done"] = True
+        entry["time_done"] = time.time()
+
+        # End of mark_done.
+
+    def read(self):
+        """Read all entries from file.
+
+        NOTE: The caller should hold the lock.
+
+        """
+
+        if not os.path.exists(self.file_name):
+            return []
+        try:
+            manifest_file = open(self.file_name, "r")
+            try:
+                entries = json.load(manifest_file)
+            finally:
+                manifest_file.close()
+        except (IOError, ValueError):
+            raise Error("ERROR: Could not read hedge manifest `%s'" % \
+                        self.file_name)
+
+        # End of read.
+        return entries
+
+    def load(self):
+        """Load the manifest from file.
+
+        A missing file simply means there is nothing to do.
+
+        """
+
+        lock_file = acquire_file_lock(self.lock_file_name, False,
+                                      "hedge manifest lock file")
+        try:
+            self.entries = self.read()
+        finally:
+            release_file_lock(lock_file)
+
+        # End of load.
+
+    def save(self):
+        """Merge our entries into the manifest file.
+
+        Entries are matched by dataset and run. Their blocks are
+        combined, and once either side has seen the output of a run it
+        stays done.
+
+        """
+
+        lock_file = acquire_file_lock(self.lock_file_name, True,
+                                      "hedge manifest lock file")
+        try:
+            merged = {}
+            keys = []
+            for entry in self.read() + self.entries:
+                key = (entry["dataset"], entry["run"])
+                if not merged.has_key(key):
+                    merged[key] = dict(entry)
+                    merged[key]["blocks"] = list(entry["blocks"])
+                    keys.append(key)
+                    continue
+                entry_merged = merged[key]
+                block_names = [i["name"] for i in entry_merged["blocks"]]
+                for block in entry["blocks"]:
+                    if not block["name"] in block_names:
+                        entry_merged["blocks"].append(block)
+                if entry["done"] and not entry_merged["done"]:
+                    entry_merged["done"] = True
+                    entry_merged["time_done"] = entry.get("time_done", 0.)
+
+            time_min = time.time() - HedgeManifest.max_age_done
+            self.entries = [merged[i] for i in keys \
+                            if not merged[i]["done"] or \
+                            merged[i].get("time_done", 0.) >= time_min]
+            write_json_atomically(self.file_name, self.entries,
+                                  "hedge manifest", indent=1)
+        finally:
+            release_file_lock(lock_file)
+
+        # End of save.
+
+    # End of HedgeManifest.
+
+###########################################################################
+## Helper class: SiteHistory.
+###########################################################################
+
+class SiteHistory(object):
+    """How well did harvesting jobs do at each site so far.
+
+    For each site we keep running averages of the time jobs spend
+    waiting in the queue, of their run time, and of the fraction of
+    jobs that failed. From that we estimate the time it takes to get
+    the output of a job submitted to that site, which is used to
+    prefer fast sites over slow ones.
+
+    The numbers come from the jobs we submitted ourselves: all jobs
+    are added when the multicrab configuration is written, and then
+    followed (using CRAB and by looking for their output) until they
+    are done. See CMSHarvester.update_site_history().
+
+    NOTE: All times are only as precise as the interval between
+    updates.
+
+    The history is stored as a (JSON) dictionary in a file, which is
+    shared by the harvesters adding jobs and the one following
+    them. All access is protected by a lock on a separate lock file,
+    and all changes are made to what is in the file at that moment.
+
+    """
+
+    # Weight of a new observation in the running averages.
+    smoothing = 0.2
+
+    # Never assume a site is worse than this at delivering (i.e. the
+    # smallest success rate we use).
+    success_rate_min = 0.1
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.lock_file_name = "%s.lock" % file_name
+        # Site name -> name of average -> value.
+        self.sites = {}
+        # Job name -> information on jobs that are not done yet.
+        self.jobs = {}
+        # The jobs we added ourselves (and did not save yet).
+        self.new_jobs = {}
+
+    def lock(self, exclusive=False):
+        "Get hold of the lock. Returns the (open) lock file."
+
+        # End of lock.
+        return acquire_file_lock(self.lock_file_name, exclusive,
+                                 "site history lock file")
+
+    def unlock(self, lock_file):
+        "Release the lock again."
+
+        release_file_lock(lock_file)
+
+        # End of unlock.
+
+    def read(self):
+        """Read the history from file.
+
+        Returns a tuple (sites, jobs). A missing file simply means we
+        start from scratch.
+
+        NOTE: The caller should hold the lock.
+
+        """
+
+        if not os.path.exists(self.file_name):
+            return ({}, {})
+        try:
+            history_file = open(self.file_name, "r")
+            try:
+                history = json.load(history_file)
+            finally:
+                history_file.close()
+        except (IOError, ValueError):
+            raise Error("ERROR: Could not read site history " \
+                        "file `%s'" % self.file_name)
+        sites = dict([(str(i), j) for (i, j) in \
+                      history.get("sites", {}).items()])
+        jobs = dict([(str(i), j) for (i, j) in \
+                     history.get("jobs", {}).items()])
+
+        # End of read.
+        return (sites, jobs)
+
+    def write(self):
+        """Write the history to file.
+
+        NOTE: The caller should hold the (exclusive) lock.
+
+        """
+
+        history = {
+            "sites" : self.sites,
+            "jobs" : self.jobs,
+            }
+        write_json_atomically(self.file_name, history,
+                              "site history file", indent=1)
+
+        # End of write.
+
+    def load(self):
+        "Load the history from file."
+
+        lock_file = self.lock()
+        try:
+            (self.sites, self.jobs) = self.read()
+        finally:
+            self.unlock(lock_file)
+
+        # End of load.
+
+    def save(self):
+        """Add the jobs we started following to the history file.
+
+        Whatever else is in the file (e.g. updates made while we were
+        busy) is kept.
+
+        """
+
+        if len(self.new_jobs) < 1:
+            return
+
+        lock_file = self.lock(exclusive=True)
+        try:
+            try:
+                (sites, jobs) = self.read()
+            except Error:
+                # A corrupt history is simply replaced.
+                (sites, jobs) = ({}, {})
+            jobs.update(self.new_jobs)
+            self.sites = sites
+            self.jobs = jobs
+            self.write()
+            self.new_jobs = {}
+        finally:
+            self.unlock(lock_file)
+
+        # End of save.
+
+    def update(self, observations):
+        """Apply what we found out about the jobs to the history file.
+
+        Each observation is a tuple (job name, event, time stamp),
+        with event one of `started', `done', `failed' and
+        `forgotten'. The file is re-read under the lock, so jobs added
+        in the meantime are kept, and observations of jobs that are no
+        longer in the file are ignored.
+
+        """
+
+        lock_file = self.lock(exclusive=True)
+        try:
+            (self.sites, self.jobs) = self.read()
+            for (job_name, event, time_stamp) in observations:
+                if not self.jobs.has_key(job_name):
+                    continue
+                if event == "started":
+                    self.record_start(job_name, time_stamp)
+                elif event == "done":
+                    self.record_done(job_name, finished=time_stamp)
+                elif event == "failed":
+                    self.record_done(job_name, failed=True,
+                                     finished=time_stamp)
+                else:
+                    self.forget_job(job_name)
+            self.write()
+        finally:
+            self.unlock(lock_file)
+
+        # End of update.
+
+    def update_average(self, site_name, name, value):
+        "Add an observation to one of the averages of a site."
+
+        if not self.sites.has_key(site_name):
+            self.sites[site_name] = {}
+        averages = self.sites[site_name]
+        if averages.has_key(name):
+            averages[name] += SiteHistory.smoothing * \
+                              (value - averages[name])
+        else:
+            averages[name] = float(value)
+
+        # End of update_average.
+
+    def add_job(self, job_name, site_name, output_dir, output_file_name,
+                submitted=None):
+        "Start following a (newly submitted) job."
+
+        if submitted is None:
+            submitted = time.time()
+        job = {
+            "site" : site_name,
+            "output_dir" : output_dir,
+            "output_file" : output_file_name,
+            "submitted" : submitted,
+            "started" : None,
+            }
+        self.jobs[job_name] = job
+        self.new_jobs[job_name] = job
+
+        # End of add_job.
+
+    def record_start(self, job_name, started=None):
+        "The job has started running."
+
+        job = self.jobs[job_name]
+        if not job["started"] is None:
+            return
+        if started is None:
+            started = time.time()
+        job["started"] = started
+        self.update_average(job["site"], "queue_wait",
+                            started - job["submitted"])
+
+        # End of record_start.
+
+    def record_done(self, job_name, failed=False, finished=None):
+        """The job is done, one way or another.
+
+        If we never saw a successful job running, all its time is
+        counted as waiting time.
+
+        """
+
+        if finished is None:
+            finished = time.time()
+        if failed:
+            self.update_average(self.jobs[job_name]["site"],
+                                "failure_rate", 1.)
+        else:
+            self.record_start(job_name, finished)
+            job = self.jobs[job_name]
+            self.update_average(job["site"], "failure_rate", 0.)
+            self.update_average(job["site"], "runtime",
+                                finished - job["started"])
+        del self.jobs[job_name]
+
+        # End of record_done.
+
+    def forget_job(self, job_name):
+        "Stop following a job without drawing any conclusions."
+
+        if self.jobs.has_key(job_name):
+            del self.jobs[job_name]
+
+        # End of forget_job.
+
+    def expected_completion(self, site_name):
+        """Expected time until the output of a job at this site is in.
+
+        This is the waiting time plus the run time, corrected for the
+        jobs that fail (and have to be resubmitted). Returns None for
+        sites we don't know anything about.
+
+        """
+
+        averages = self.sites.get(site_name, {})
+        if not averages.has_key("queue_wait") and \
+               not averages.has_key("runtime"):
+            return None
+        success_rate = max(1. - averages.get("failure_rate", 0.),
+                           SiteHistory.success_rate_min)
+        expected_completion = (averages.get("queue_wait", 0.) + \
+                               averages.get("runtime", 0.)) / success_rate
+
+        # End of expected_completion.
+        return expected_completion
+
+    def rank(self, site_names):
+        """Sort sites by their expected completion time.
+
+        Sites we know nothing about are assumed to be average.
+        Returns a list of (expected completion time, site name),
+        fastest first. The expected completion time is None if we
+        don't know anything about any of the sites.
+
+        """
+
+        expected = dict([(i, self.expected_completion(i)) \
+                         for i in site_names])
+        known = [i for i in expected.values() if not i is None]
+        default = None
+        if len(known) > 0:
+            default = sum(known) / len(known)
+        ranking = []
+        for site_name in site_names:
+            expected_completion = expected[site_name]
+            if expected_completion is None:
+                expected_completion = default
+            ranking.append((expected_completion, site_name))
+        ranking.sort()
+
+        # End of rank.
+        return ranking
+
+    def speed_factors(self, site_names):
+        """How fast each site is compared to the others.
+
+        This is the average expected completion time (see rank())
+        divided by that of the site, so faster sites have larger
+        factors. If we don't know anything about any of the sites all
+        factors are one.
+
+        """
+
+        ranking = self.rank(site_names)
+        if len(ranking) < 1 or ranking[0][0] is None:
+            return dict([(i, 1.) for i in site_names])
+        average = sum([i for (i, j) in ranking]) / len(ranking)
+        speed_factors = {}
+        for (expected_completion, site_name) in ranking:
+            # NOTE: Better safe than sorry.
+            speed_factors[site_name] = max(average, 1.) / \
+                                       max(expected_completion, 1.)
+
+        # End of speed_factors.
+        return speed_factors
+
+    # End of SiteHistory.
+
+###########################################################################
+## Helper class: StorageBackend.
+###########################################################################
+
+class StorageBackend(object):
+    """Interface to the storage system holding the output area.
+
+    All operations work on many paths at once, so that setting up
+    (or checking) thousands of output directories costs a few calls
+    instead of thousands of separate commands.
+
+    The status of a path is described by a tuple (is_dir,
+    permissions, size), with the permissions as three-digit octal
+    string (e.g. `775').
+
+    The storage-specific parts are implemented in the derived
+    classes: CastorStorageBackend, EOSStorageBackend and
+    LocalStorageBackend. Each of these provides:
+    - stat_many(paths): the status of all paths, as a dictionary
+      path -> status (None for paths that do not exist),
+    - mkdir_many(paths, permissions="775"): create all directories
+      (including their parents),
+    - chmod_many(permissions): change permissions, given as a
+      dictionary path -> permissions,
+    - list_many(paths): the contents of all directories, as a
+      dictionary path -> list of names (None for directories that
+      could not be listed, e.g. because they don't exist),
+    - list_tree(path): everything below path (recursively), as a
+      dictionary path -> status.
+    All of these raise Error if something goes wrong.
+
+    """
+
+    # This many paths go into a single command.
+    chunk_size = 100
+
+    name = None
+
+    def chunks(self, paths):
+        "Split paths into pieces of at most chunk_size."
+
+        paths = list(paths)
+        return [paths[i:i + StorageBackend.chunk_size] \
+                for i in xrange(0, len(paths), StorageBackend.chunk_size)]
+
+    def run_batch(self, cmd_template, paths):
+        """Run a command for each path, using a single shell per chunk.
+
+        For storage commands that only take a single path. Returns a
+        dictionary path -> (exit status, output).
+
+        """
+
+        results = {}
+        for chunk in self.chunks(paths):
+            pieces = []
+            for (index, path) in enumerate(chunk):
+                pieces.append("echo '@@@ begin %d'; %s 2>&1; " \
+                              "echo \"@@@ end %d $?\"" % \
+                              (index, cmd_template % path, index))
+            (status, output) = commands.getstatusoutput("; ".join(pieces))
+            lines = []
+            for line in output.split("\n"):
+                match = re.match("^@@@ (begin|end) ([0-9]+)(?: ([0-9]+))?$",
+                                 line)
+                if match is None:
+                    lines.append(line)
+                elif match.group(1) == "begin":
+                    lines = []
+                else:
+                    results[chunk[int(match.group(2))]] = \
+                                 (int(match.group(3)), "\n".join(lines))
+            for path in chunk:
+                if not results.has_key(path):
+                    raise Error("ERROR: Could not run `%s'" % \
+                                (cmd_template % path))
+
+        # End of run_batch.
+        return results
+
+    def parse_mode(mode):
+        """Turn a mode string (e.g. `drwxrwxr-x') into (is_dir,
+        permissions).
+
+        """
+
+        permissions = []
+        for index in (1, 4, 7):
+            bits = mode[index:index + 3]
+            value = 0
+            if bits[0] == "r":
+                value += 4
+            if bits[1] == "w":
+                value += 2
+            if bits[2] in "xst":
+                value += 1
+            permissions.append(str(value))
+
+        # End of parse_mode.
+        return (mode.startswith("d"), "".join(permissions))
+
+    parse_mode = staticmethod(parse_mode)
+
+    def parse_long_listing(line):
+        """Parse a line of `ls -l'-style output.
+
+        Returns (name, is_dir, permissions, size), or None if this is
+        not such a line.
+
+        """
+
+        match = re.match("^([-dlDm][-rwxsStT]{9})\S*\s+\d+\s+\S+\s+\S+\s+" \
+                         "(\d+)\s+\w{3}\s+\d+\s+[\d:]+\s+(.*)$", line)
+        if match is None:
+            return None
+        (is_dir, permissions) = StorageBackend.parse_mode(match.group(1))
+
+        # End of parse_long_listing.
+        return (match.group(3), is_dir, permissions, int(match.group(2)))
+
+    parse_long_listing = staticmethod(parse_long_listing)
+
+    def for_path(path, name="auto"):
+        """Create the storage backend for this path.
+
+        In `auto' mode this is decided based on the path: CASTOR for
+        /castor/ and EOS for /eos/. For all other paths we also
+        assume CASTOR, since that is what we always did.
+
+        """
+
+        if name == "auto":
+            if path.startswith("/eos/"):
+                name = "eos"
+            else:
+                name = "castor"
+        backend_classes = {
+            "castor" : CastorStorageBackend,
+            "eos" : EOSStorageBackend,
+            "local" : LocalStorageBackend,
+            }
+
+        # End of for_path.
+        return backend_classes[name]()
+
+    for_path = staticmethod(for_path)
+
+    # End of StorageBackend.
+
+###########################################################################
+
+class CastorStorageBackend(StorageBackend):
+    """CERN CASTOR, using the name server commands.
+
+    These (unlike the rf* commands) take many paths at once.
+
+    """
+
+    name = "castor"
+
+    def stat_many(self, paths):
+
+        stats = dict([(i, None) for i in paths])
+        for chunk in self.chunks(stats.keys()):
+            # NOTE: This fails (but still lists the others) if any of
+            # the paths does not exist.
+            cmd = "nsls -ld %s" % " ".join(chunk)
+            (status, output) = commands.getstatusoutput(cmd)
+            for line in output.split("\n"):
+                entry = StorageBackend.parse_long_listing(line)
+                if not entry is None and stats.has_key(entry[0]):
+                    stats[entry[0]] = entry[1:]
+
+        # End of stat_many.
+        return stats
+
+    def mkdir_many(self, paths, permissions="775"):
+
+        for chunk in self.chunks(paths):
+            cmd = "nsmkdir -m %s -p %s" % (permissions, " ".join(chunk))
+            (status, output) = commands.getstatusoutput(cmd)
+            if status != 0:
+                raise Error("ERROR: Could not create director(y/ies): " \
+                            "%s" % output)
+
+        # End of mkdir_many.
+
+    def chmod_many(self, permissions):
+
+        paths_by_permissions = {}
+        for (path, permissions_new) in permissions.items():
+            paths_by_permissions.setdefault(permissions_new, []).append(path)
+        for (permissions_new, paths) in paths_by_permissions.items():
+            for chunk in self.chunks(paths):
+                cmd = "nschmod %s %s" % (permissions_new, " ".join(chunk))
+                (status, output) = commands.getstatusoutput(cmd)
+                if status != 0:
+                    raise Error("ERROR: Could not change permissions " \
+                                "to %s: %s" % (permissions_new, output))
+
+        # End of chmod_many.
+
+    def list_many(self, paths):
+
+        listings = {}
+        for (path, (status, output)) in \
+                self.run_batch("nsls %s", paths).items():
+            if status != 0:
+                listings[path] = None
+            else:
+                listings[path] = [i for i in output.split("\n") \
+                                  if len(i.strip()) > 0]
+
+        # End of list_many.
+        return listings
+
+    def list_tree(self, path):
+
+        cmd = "nsls -lR %s" % path
+        (status, output) = commands.getstatusoutput(cmd)
+        if status != 0:
+            raise Error("ERROR: Could not list `%s': %s" % (path, output))
+
+        # The output consists of a header line (the name of the
+        # directory, followed by a colon) for each directory,
+        # followed by the long listing of its contents.
+        tree = {}
+        dir_name = path
+        for line in output.split("\n"):
+            entry = StorageBackend.parse_long_listing(line)
+            if entry is None:
+                if line.startswith("/") and line.endswith(":"):
+                    dir_name = line[:-1]
+                continue
+            tree[os.path.join(dir_name, entry[0])] = entry[1:]
+
+        # End of list_tree.
+        return tree
+
+    # End of CastorStorageBackend.
+
+###########################################################################
+
+class EOSStorageBackend(StorageBackend):
+    """CERN EOS, using the eos command line client.
+
+    NOTE: The eos client only takes a single path at a time, so most
+    of these are done using run_batch(). The status of paths is
+    obtained by listing their parent directories.
+
+    """
+
+    name = "eos"
+
+    def stat_many(self, paths):
+
+        stats = dict([(i, None) for i in paths])
+        parents = set([os.path.dirname(i) for i in paths])
+        for (parent, (status, output)) in \
+                self.run_batch("eos ls -l %s", parents).items():
+            if status != 0:
+                continue
+            for line in output.split("\n"):
+                entry = StorageBackend.parse_long_listing(line)
+                if entry is None:
+                    continue
+                path = os.path.join(parent, entry[0])
+                if stats.has_key(path):
+                    stats[path] = entry[1:]
+
+        # End of stat_many.
+        return stats
+
+    def mkdir_many(self, paths, permissions="775"):
+
+        for (path, (status, output)) in \
+                self.run_batch("eos mkdir -p %s", paths).items():
+            if status != 0:
+                raise Error("ERROR: Could not create directory " \
+                            "`%s': %s" % (path, output))
+        self.chmod_many(dict([(i, permissions) for i in paths]))
+
+        # End of mkdir_many.
+
+    def chmod_many(self, permissions):
+
+        paths_by_permissions = {}
+        for (path, permissions_new) in permissions.items():
+            paths_by_permissions.setdefault(permissions_new, []).append(path)
+        for (permissions_new, paths) in paths_by_permissions.items():
+            for (path, (status, output)) in \
+                    self.run_batch("eos chmod %s %%s" % permissions_new,
+                                   paths).items():
+                if status != 0:
+                    raise Error("ERROR: Could not change permissions " \
+                                "of `%s' to %s: %s" % \
+                                (path, permissions_new, output))
+
+        # End of chmod_many.
+
+    def list_many(self, paths):
+
+        listings = {}
+        for (path, (status, output)) in \
+                self.run_batch("eos ls %s", paths).items():
+            if status != 0:
+                listings[path] = None
+            else:
+                listings[path] = [i for i in output.split("\n") \
+                                  if len(i.strip()) > 0]
+
+        # End of list_many.
+        return listings
+
+    def list_tree(self, path):
+
+        tree = {}
+        cmd = "eos find -d %s" % path
+        (status, output) = commands.getstatusoutput(cmd)
+        if status != 0:
+            raise Error("ERROR: Could not list `%s': %s" % (path, output))
+        for line in output.split("\n"):
+            line = line.strip()
+            if line.startswith("/"):
+                tree[os.path.normpath(line)] = (True, None, 0)
+        cmd = "eos find -f --size %s" % path
+        (status, output) = commands.getstatusoutput(cmd)
+        if status != 0:
+            raise Error("ERROR: Could not list `%s': %s" % (path, output))
+        for line in output.split("\n"):
+            match = re.match("^path=(\S+)\s+size=(\d+)", line.strip())
+            if not match is None:
+                tree[match.group(1)] = (False, None, int(match.group(2)))
+        if tree.has_key(os.path.normpath(path)):
+            del tree[os.path.normpath(path)]
+
+        # End of list_tree.
+        return tree
+
+    # End of EOSStorageBackend.
+
+###########################################################################
+
+class LocalStorageBackend(StorageBackend):
+    "A local (or mounted) POSIX file system."
+
+    name = "local"
+
+    def stat_info(self, stat_result):
+        "Turn the result of os.stat() into our status tuple."
+
+        return ((stat_result.st_mode & 0170000) == 0040000,
+                "%03o" % (stat_result.st_mode & 0777),
+                stat_result.st_size)
+
+    def stat_many(self, paths):
+
+        stats = {}
+        for path in paths:
+            try:
+                stats[path] = self.stat_info(os.stat(path))
+            except OSError:
+                stats[path] = None
+
+        # End of stat_many.
+        return stats
+
+    def mkdir_many(self, paths, permissions="775"):
+
+        for path in paths:
+            try:
+                if not os.path.isdir(path):
+                    os.makedirs(path)
+                os.chmod(path, int(permissions, 8))
+            except OSError, err:
+                raise Error("ERROR: Could not create directory " \
+                            "`%s': %s" % (path, err))
+
+        # End of mkdir_many.
+
+    def chmod_many(self, permissions):
+
+        for (path, permissions_new) in permissions.items():
+            try:
+                os.chmod(path, int(permissions_new, 8))
+            except OSError, err:
+                raise Error("ERROR: Could not change permissions " \
+                            "of `%s' to %s: %s" % \
+                            (path, permissions_new, err))
+
+        # End of chmod_many.
+
+    def list_many(self, paths):
+
+        listings = {}
+        for path in paths:
+            try:
+                listings[path] = os.listdir(path)
+            except OSError:
+                listings[path] = None
+
+        # End of list_many.
+        return listings
+
+    def list_tree(self, path):
+
+        tree = {}
+        for (dir_path, dir_names, file_names) in os.walk(path):
+            for name in dir_names + file_names:
+                full_path = os.path.join(dir_path, name)
+                try:
+                    tree[full_path] = self.stat_info(os.stat(full_path))
+                except OSError:
+                    # Gone in the meantime.
+                    pass
+
+        # End of list_tree.
+        return tree
+
+    # End of LocalStorageBackend.
+
+###########################################################################
+
+class CachingStorageBackend(StorageBackend):
+    """Remembers what another storage backend told us.
+
+    During a single run the same output directories are stat-ed and
+    listed over and over again: when setting up the output area, when
+    checking that the directories are empty, when planning the
+    multicrab jobs, etc. This wrapper keeps the results of
+    stat_many(), list_many() and list_tree() for the lifetime of the
+    process, so only the first look at a path costs a round trip to
+    the storage system.
+
+    Our own changes go through the wrapper (write-through): they are
+    passed on to the real backend, after which mkdir_many() forgets
+    all it knows about the paths and their parents and chmod_many()
+    forgets the status of the paths.
+
+    NOTE: Changes made by others (e.g. grid jobs copying back their
+    output) are not noticed.
+
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.name = backend.name
+        self.lock = threading.Lock()
+        # Bumped for every change, so we never store results that
+        # were fetched before a change but arrive after it.
+        self.generation = 0
+        self.stats = {}
+        self.listings = {}
+        self.trees = {}
+        self.num_hits = 0
+        self.num_misses = 0
+
+    def lookup(self, cache, paths, fetch):
+        """Look up paths in cache, fetch()-ing whatever is missing.
+
+        """
+
+        results = {}
+        missing = []
+        self.lock.acquire()
+        try:
+            for path in paths:
+                if cache.has_key(path):
+                    results[path] = cache[path]
+                elif not path in missing:
+                    missing.append(path)
+            self.num_hits += len(results)
+            self.num_misses += len(missing)
+            generation = self.generation
+        finally:
+            self.lock.release()
+
+        if len(missing) > 0:
+            fetched = fetch(missing)
+            self.lock.acquire()
+            try:
+                if self.generation == generation:
+                    cache.update(fetched)
+            finally:
+                self.lock.release()
+            results.update(fetched)
+
+        # End of lookup.
+        return results
+
+    def forget(self, paths, stats_only=False):
+        """Forget what we know about paths.
+
+        Unless stats_only is set this includes the parents of the
+        paths (which may have been created, or got new entries).
+
+        """
+
+        self.lock.acquire()
+        try:
+            self.generation += 1
+            for path in paths:
+                forget_paths = [path, os.path.normpath(path)]
+                if not stats_only:
+                    parent_path = os.path.dirname(forget_paths[-1])
+                    while parent_path != forget_paths[-1]:
+                        forget_paths.append(parent_path)
+                        parent_path = os.path.dirname(parent_path)
+                for forget_path in forget_paths:
+                    self.stats.pop(forget_path, None)
+                    if not stats_only:
+                        self.listings.pop(forget_path, None)
+                # Any tree containing this path is out of date too.
+                for tree_path in self.trees.keys():
+                    tree_path_norm = os.path.normpath(tree_path)
+                    if forget_paths[1] == tree_path_norm or \
+                           forget_paths[1].startswith(tree_path_norm + "/"):
+                        del self.trees[tree_path]
+        finally:
+            self.lock.release()
+
+        # End of forget.
+
+    def stat_many(self, paths):
+
+        # End of stat_many.
+        return self.lookup(self.stats, paths, self.backend.stat_many)
+
+    def mkdir_many(self, paths, permissions="775"):
+
+        try:
+            self.backend.mkdir_many(paths, permissions)
+        finally:
+            # Even if this failed some of the paths may have been
+            # created.
+            self.forget(paths)
+
+        # End of mkdir_many.
+
+    def chmod_many(self, permissions):
+
+        try:
+            self.backend.chmod_many(permissions)
+        finally:
+            self.forget(permissions.keys(), stats_only=True)
+
+        # End of chmod_many.
+
+    def list_many(self, paths):
+
+        # End of list_many.
+        return self.lookup(self.listings, paths, self.backend.list_many)
+
+    def list_tree(self, path):
+
+        generation = self.generation
+        trees = self.lookup(self.trees, [path],
+                            lambda paths: dict([(i, self.backend.list_tree(i)) \
+                                                for i in paths]))
+        tree = trees[path]
+
+        # The tree also tells us the status of everything in it, and
+        # what is in each of the directories.
+        # NOTE: Not all backends list the permissions (see
+        # EOSStorageBackend.list_tree()). Those entries are not good
+        # enough to stand in for stat_many() results.
+        stats = {}
+        listings = {path : []}
+        for (tree_path, tree_stat) in tree.iteritems():
+            if not tree_stat[1] is None:
+                stats[tree_path] = tree_stat
+            if tree_stat[0]:
+                listings.setdefault(tree_path, [])
+            (parent_path, name) = os.path.split(tree_path)
+            listings.setdefault(parent_path, []).append(name)
+        self.lock.acquire()
+        try:
+            if self.generation == generation:
+                self.stats.update(stats)
+                self.listings.update(listings)
+        finally:
+            self.lock.release()
+
+        # End of list_tree.
+        return tree
+
+    # End of CachingStorageBackend.
+
+###########################################################################
+## Helper class: OutputDirPlanner.
+###########################################################################
+
+class OutputDirPlanner(object):
+    """Create (and fix the permissions of) many directories at once.
+
+    All directories that need looking after are collected in a single
+    prefix tree, so that parent directories shared by many output
+    directories are only looked at once. The tree is then handled
+    level by level, from the top down: all paths at a given depth are
+    stat-ed together, the missing ones are created together and the
+    ones with insufficient permissions are fixed together. The chunks
+    of each level are handed to the storage backend in parallel.
+
+    NOTE: Permissions are never `downgraded', only raised to (at
+    least) the target permissions.
+
+    """
+
+    def __init__(self, storage, num_workers=1):
+        self.storage = storage
+        self.pool = WorkerPool(num_workers)
+        # Path -> target permissions.
+        self.nodes = {}
+
+    def add(self, path, permissions_target="775"):
+        """Add a path to the tree.
+
+        NOTE: The parents of the path are not added. Whatever parents
+        are not in the tree are not touched (except for being created
+        if they don't exist yet).
+
+        """
+
+        self.nodes[os.path.normpath(path)] = permissions_target
+
+        # End of add.
+
+    def levels(self):
+        """Return the paths in the tree grouped by depth.
+
+        The result is a list of (sorted) lists of paths, top level
+        first.
+
+        """
+
+        paths_by_depth = {}
+        for path in self.nodes.iterkeys():
+            depth = len([i for i in path.split(os.sep) if len(i) > 0])
+            paths_by_depth.setdefault(depth, []).append(path)
+
+        depths = paths_by_depth.keys()
+        depths.sort()
+        levels = []
+        for depth in depths:
+            paths = paths_by_depth[depth]
+            paths.sort()
+            levels.append(paths)
+
+        # End of levels.
+        return levels
+
+    def map_chunks(self, func, paths):
+        "Call func() for all chunks of paths, in parallel."
+
+        # End of map_chunks.
+        return self.pool.map(func, self.storage.chunks(paths))
+
+    def stat_level(self, paths):
+        "Get the status of all paths, see StorageBackend.stat_many()."
+
+        stats = {}
+        for chunk_stats in self.map_chunks(self.storage.stat_many, paths):
+            stats.update(chunk_stats)
+
+        # End of stat_level.
+        return stats
+
+    def upgrade_permissions(permissions, permissions_target):
+        """Combine permissions such that none of them are lost.
+
+        E.g. 751 and 775 become 775, 700 and 775 become 775 and 777
+        and 775 stay 777.
+
+        """
+
+        permissions_new = []
+        for (i, j) in zip(permissions, permissions_target):
+            permissions_new.append(str(max(int(i), int(j))))
+
+        # End of upgrade_permissions.
+        return "".join(permissions_new)
+
+    upgrade_permissions = staticmethod(upgrade_permissions)
+
+    def run(self):
+        """Create all missing directories and fix all permissions.
+
+        Returns a tuple (number of directories created, number of
+        permissions changed). Raises Error in case anything goes
+        wrong.
+
+        """
+
+        num_created = 0
+        num_changed = 0
+        for paths in self.levels():
+
+            # First find out what is there already.
+            stats = self.stat_level(paths)
+
+            # Create whatever is missing.
+            missing = [i for i in paths if stats[i] is None]
+            if len(missing) > 0:
+                missing_by_permissions = {}
+                for path in missing:
+                    missing_by_permissions.setdefault(self.nodes[path],
+                                                      []).append(path)
+                for (permissions, missing_paths) in \
+                        missing_by_permissions.items():
+                    self.map_chunks(lambda chunk: \
+                                    self.storage.mkdir_many(chunk,
+                                                            permissions),
+                                    missing_paths)
+                num_created += len(missing)
+                stats.update(self.stat_level(missing))
+
+            # If we did not get the permissions the first time around,
+            # try once more.
+            unknown = [i for i in paths \
+                       if not stats[i] is None and stats[i][1] is None]
+            if len(unknown) > 0:
+                stats.update(self.stat_level(unknown))
+
+            # Now check that these all look like directories.
+            for path in paths:
+                if stats[path] is None or stats[path][1] is None:
+                    raise Error("Could not obtain permissions for " \
+                                "directory `%s'" % path)
+                if not stats[path][0]:
+                    raise Error("Path `%s' is not a directory(?)" % path)
+
+            # And fix the permissions where necessary.
+            changes = {}
+            for path in paths:
+                permissions = stats[path][1]
+                permissions_new = self.upgrade_permissions(permissions,
+                                                           self.nodes[path])
+                if permissions_new != permissions:
+                    changes[path] = permissions_new
+            if len(changes) > 0:
+                self.map_chunks(lambda chunk: \
+                                self.storage.chmod_many(dict([(i, changes[i]) \
+                                                              for i in chunk])),
+                                changes.keys())
+                num_changed += len(changes)
+
+        # End of run.
+        return (num_created, num_changed)
+
+    # End of OutputDirPlanner.
+
+###########################################################################
+## Helper class: HarvestedOutputIndex.
+###########################################################################
+
+class HarvestedOutputIndex(object):
+    """The output that already exists for the runs of a dataset.
+
+    Built from a single recursive listing (see
+    StorageBackend.list_tree()) of the common output path of a
+    dataset. Below that path each run has its own directory,
+    run_<run number>/, and every file in (or below) such a run
+    directory counts as output of that run.
+
+    """
+
+    def __init__(self, castor_path_common, tree):
+        self.castor_path_common = os.path.normpath(castor_path_common)
+        # Run number -> dictionary path -> size.
+        self.outputs = {}
+
+        regexp = re.compile("^run_([0-9]+)/")
+        prefix = self.castor_path_common + "/"
+        for (path, (is_dir, permissions, size)) in tree.iteritems():
+            path = os.path.normpath(path)
+            if is_dir or not path.startswith(prefix):
+                continue
+            match = regexp.match(path[len(prefix):])
+            if match is None:
+                continue
+            run = int(match.group(1))
+            self.outputs.setdefault(run, {})[path] = size
+
+    def has_output(self, run):
+        "Is there any output for this run?"
+
+        return self.outputs.has_key(run)
+
+    def run_outputs(self, run):
+        """The output of this run.
+
+        Returns a dictionary path -> size (empty if there is no
+        output).
+
+        """
+
+        return self.outputs.get(run, {})
+
+    def output_size(self, run):
+        "The total size of the output of this run."
+
+        return sum(self.run_outputs(run).values())
+
+    # End of HarvestedOutputIndex.
+
+###########################################################################
+## CMSHarvester class.
+###########################################################################
+
+class CMSHarvester(object):
+    """Class to perform CMS harvesting.
+
+    More documentation `obviously' to follow.
+
+    """
+
+    ##########
+
+    def __init__(self, cmd_line_opts=None):
+        "Initialize class and process command line options."
+
+        self.version = __version__
+
+        # These are the harvesting types allowed. See the head of this
+        # file for more information.
+        self.harvesting_types = [
+            "RelVal",
+            "RelValFS",
+            "MC",
+            "DQMOffline",
+            ]
+
+        # These are the possible harvesting modes:
+        #   - Single-step: harvesting takes place on-site in a single
+        #   step. For each samples only a single ROOT file containing
+        #   the harvesting results is returned.
+        #   - Single-step-allow-partial: special hack to allow
+        #   harvesting of partial statistics using single-step
+        #   harvesting on spread-out samples.
+        #   - Two-step: harvesting takes place in two steps. The first
+        #   step returns a series of monitoring elenent summaries for
+        #   each sample. The second step then merges these summaries
+        #   locally and does the real harvesting. This second step
+        #   produces the ROOT file containing the harvesting results.
+        self.harvesting_modes = [
+            "single-step",
+            "single-step-allow-partial",
+            "two-step"
+            ]
+
+        # It is possible to specify a GlobalTag that will override any
+        # choices (regarding GlobalTags) made by the cmsHarvester.
+        # BUG BUG BUG
+        # For the moment, until I figure out a way to obtain the
+        # GlobalTag with which a given data (!) dataset was created,
+        # it is necessary to specify a GlobalTag for harvesting of
+        # data.
+        # BUG BUG BUG end
+        self.globaltag = None
+
+        # It's also possible to switch off the use of reference
+        # histograms altogether.
+        self.use_ref_hists = True
+
+        # The database name and account are hard-coded. They are not
+        # likely to change before the end-of-life of this tool. But of
+        # course there is a way to override this from the command
+        # line. One can even override the Frontier connection used for
+        # the GlobalTag and for the reference histograms
+        # independently. Please only use this for testing purposes.
+        self.frontier_connection_name = {}
+        self.frontier_connection_name["globaltag"] = "frontier://" \
+                                                     "FrontierProd/"
+        self.frontier_connection_name["refhists"] = "frontier://" \
+                                                    "FrontierProd/"
+        self.frontier_connection_overridden = {}
+        for key in self.frontier_connection_name.keys():
+            self.frontier_connection_overridden[key] = False
+
+        # This contains information specific to each of the harvesting
+        # types. Used to create the harvesting configuration. It is
+        # filled by setup_harvesting_info().
+        self.harvesting_info = None
+
+        ###
+
+        # These are default `unused' values that will be filled in
+        # depending on the command line options.
+
+        # The type of harvesting we're doing. See
+        # self.harvesting_types for allowed types.
+        self.harvesting_type = None
+
+        # The harvesting mode, popularly known as single-step
+        # vs. two-step. The thing to remember at this point is that
+        # single-step is only possible for samples located completely
+        # at a single site (i.e. SE).
+        self.harvesting_mode = None
+        # BUG BUG BUG
+        # Default temporarily set to two-step until we can get staged
+        # jobs working with CRAB.
+        self.harvesting_mode_default = "single-step"
+        # BUG BUG BUG end
+
+        # The input method: are we reading a dataset name (or regexp)
+        # directly from the command line or are we reading a file
+        # containing a list of dataset specifications. Actually we
+        # keep one of each for both datasets and runs.
+        self.input_method = {}
+        self.input_method["datasets"] = {}
+        self.input_method["datasets"]["use"] = None
+        self.input_method["datasets"]["ignore"] = None
+        self.input_method["runs"] = {}
+        self.input_method["runs"]["use"] = None
+        self.input_method["runs"]["ignore"] = None
+        self.input_method["runs"]["ignore"] = None
+        # The name of whatever input we're using.
+        self.input_name = {}
+        self.input_name["datasets"] = {}
+        self.input_name["datasets"]["use"] = None
+        self.input_name["datasets"]["ignore"] = None
+        self.input_name["runs"] = {}
+        self.input_name["runs"]["use"] = None
+        self.input_name["runs"]["ignore"] = None
+
+	self.Jsonlumi = False
+	self.Jsonfilename = "YourJSON.txt"
+     	self.Jsonrunfilename = "YourJSON.txt"
+	self.todofile = "YourToDofile.txt"
+
+        # If this is true, we're running in `force mode'. In this case
+        # the sanity checks are performed but failure will not halt
+        # everything.
+        self.force_running = None
+
+        # The base path of the output dir in CASTOR.
+        self.castor_base_dir = None
+        self.castor_base_dir_default = "/castor/cern.ch/" \
+                                       "cms/store/temp/" \
+                                       "dqm/offline/harvesting_output/"
+
+        # The name of the file to be used for book keeping: which
+        # datasets, runs, etc. we have already processed.
+        self.book_keeping_file_name = None
+        self.book_keeping_file_name_default = "harvesting_accounting.txt"
+
+        # The dataset name to reference histogram name mapping is read
+        # from a text file. The name of this file is kept in the
+        # following variable.
+        self.ref_hist_mappings_file_name = None
+        # And this is the default value.
+        self.ref_hist_mappings_file_name_default = "harvesting_ref_hist_mappings.txt"
+
+        # Hmmm, hard-coded prefix of the CERN CASTOR area. This is the
+        # only supported CASTOR area.
+        # NOTE: Make sure this one starts with a `/'.
+        self.castor_prefix = "/castor/cern.ch"
+
+        # How to talk to the storage system holding the output area
+        # (see StorageBackend).
+        self.storage_backend_name = "auto"
+        self.storage = None
+        # The number of storage commands we allow to run at the same
+        # time when setting up the output area.
+        self.storage_workers = 4
+        # The output area paths we already checked (and if necessary
+        # created/fixed).
+        self.castor_path_checks_cache = set()
+        # Dataset name -> HarvestedOutputIndex.
+        self.harvested_outputs = {}
+
+        # Normally the central harvesting should be done using the
+        # `t1access' grid role. To be able to run without T1 access
+        # the --no-t1access flag can be used. This variable keeps
+        # track of that special mode.
+        self.non_t1access = False
+	self.caf_access = False
+        self.saveByLumiSection = False
+        self.crab_submission = False
+        self.nr_max_sites = 1
+
+        # The number of DBS queries we allow to be in flight at the
+        # same time.
+        self.dbs_workers = 4
+        # File-level DBS queries are split up into pieces of this many
+        # runs (zero means no splitting).
+        self.dbs_spread_chunk_runs = 50
+        # The spread of datasets over sites can be determined from
+        # file-level or from block-level information.
+        self.spread_mode = "file"
+        # The spread of datasets can be remembered from one run to the
+        # next in this file.
+        self.spread_cache_file_name = None
+        self.spread_cache = None
+
+        # Number of times to retry a failing DBS query.
+        self.dbs_retries = 3
+        self.dbs_client = None
+        # Identical DBS queries are only sent (and parsed) once.
+        self.dbs_single_flight = SingleFlight()
+
+        # This keeps track of what all our DBS queries cost. A JSON
+        # version of the final report can be written to this file.
+        self.dbs_telemetry = DBSTelemetry()
+        self.dbs_telemetry_file_name = None
+
+        # The DBS server to talk to. By default this is the global
+        # production DBS.
+        self.dbs_url = None
+        # Query/response pairs can be recorded into this directory,
+        self.dbs_record_dir = None
+        # to be replayed later by a local stand-in for DBS.
+        self.dbs_replay_dir = None
+        self.dbs_replay_old_format = False
+        self.dbs_replay_latency = 0.
+        self.dbs_replay_failure_rate = 0.
+        self.dbs_replay_server = None
+
+        # DBS query results can be cached on disk in this directory,
+        # and that cache can be ignored (i.e. refreshed) if needed.
+        self.dbs_cache_dir = None
+        self.dbs_cache_refresh = False
+        self.dbs_cache = None
+
+        # For incremental running we keep track of what we have
+        # already seen in this file.
+        self.incremental_state_file_name = None
+        self.incremental_state = None
+        # The creation dates of the datasets found in incremental
+        # mode.
+        self.dataset_createdates = {}
+
+	self.preferred_site = "no preference"
+        # Relative capacities of the sites (see SiteScheduler).
+        self.site_weights = {}
+        # Hedging: runs available at several complete sites can be
+        # submitted to up to this many sites, with at most this many
+        # extra submissions in total. The hedged submissions are
+        # listed in the manifest.
+        self.hedge_sites = 1
+        self.hedge_budget = 0
+        self.hedge_manifest_file_name = "harvesting_hedges.json"
+        self.hedged_runs = {}
+        self.hedge_manifest = None
+        # The performance history of the sites, used to prefer fast
+        # sites over slow ones.
+        self.site_history_file_name = None
+        self.site_history = None
+        # All multicrab blocks (i.e. jobs) we created, with their
+        # sites and output locations.
+        self.multicrab_blocks = []
+
+        # This will become the list of datasets and runs to consider
+        self.datasets_to_use = {}
+        # and this will become the list of datasets and runs to skip.
+        self.datasets_to_ignore = {}
+        # This, in turn, will hold all book keeping information.
+        self.book_keeping_information = {}
+        # And this is where the dataset name to reference histogram
+        # name mapping is stored.
+        self.ref_hist_mappings = {}
+
+        # We're now also allowing run selection. This means we also
+        # have to keep list of runs requested and vetoed by the user.
+        self.runs_to_use = {}
+        self.runs_to_ignore = {}
+
+        # This keeps track of which (wildcarded) dataset names
+        # resolved to which datasets. Used to combine DBS queries for
+        # many datasets into a few.
+        self.dataset_patterns = {}
+
+        # Cache for CMSSW version availability at different sites.
+        self.sites_and_versions_cache = {}
+        # The index of which CMSSW versions are available at which
+        # sites (built once, when needed), and the snapshot file it
+        # can be kept in.
+        self.site_index = None
+        self.site_index_tried = False
+        self.site_info_snapshot_file_name = None
+        # The sites_and_versions_cache can be kept on disk as well.
+        self.site_version_cache_file_name = None
+        self.site_version_cache_refresh = False
+        self.site_version_cache = None
+
+        # Cache for checked GlobalTags.
+        self.globaltag_check_cache = []
+
+        # Global flag to see if there were any jobs for which we could
+        # not find a matching site.
+        self.all_sites_found = True
+
+        # Helper string centrally defined.
+        self.no_matching_site_found_str = "no_matching_site_found"
+
+        # Store command line options for later use.
+        if cmd_line_opts is None:
+            cmd_line_opts = sys.argv[1:]
+        self.cmd_line_opts = cmd_line_opts
+
+        # Set up the logger.
+        log_handler = logging.StreamHandler()
+        # This is the default log formatter, the debug option switches
+        # on some more information.
+        log_formatter = logging.Formatter("%(message)s")
+        log_handler.setFormatter(log_formatter)
+        logger = logging.getLogger()
+        logger.name = "main"
+        logger.addHandler(log_handler)
+        self.logger = logger
+        # The default output mode is quite verbose.
+        self.set_output_level("NORMAL")
+
+        #logger.debug("Initialized successfully")
+
+        # End of __init__.
+
+    ##########
+
+    def report_dbs_telemetry(self):
+        """Summarise what all our DBS queries cost.
+
+        """
+
+        if len(self.dbs_telemetry.records) < 1:
+            return
+
+        for line in self.dbs_telemetry.summary():
+            self.logger.info(line)
+
+        if not self.dbs_telemetry_file_name is None:
+            try:
+                self.dbs_telemetry.write_json(self.dbs_telemetry_file_name)
+            except Error, err:
+                self.logger.warning(err.msg)
+
+        # End of report_dbs_telemetry.
+
+    ##########
+
+    def cleanup(self):
+        "Clean up after ourselves."
+
+        # NOTE: This is the safe replacement of __del__.
+
+        #self.logger.debug("All done -> shutting down")
+        logging.shutdown()
+
+        # End of cleanup.
+
+    ##########
+
+    def time_stamp(self):
+        "Create a timestamp to use in the created config files."
+
+        time_now = datetime.datetime.utcnow()
+        # We don't care about the microseconds.
+        time_now = time_now.replace(microsecond = 0)
+        time_stamp = "%sUTC" % datetime.datetime.isoformat(time_now)
+
+        # End of time_stamp.
+        return time_stamp
+
+    ##########
+
+    def ident_string(self):
+        "Spit out an identification string for cmsHarvester.py."
+
+        ident_str = "`cmsHarvester.py " \
+                    "version %s': cmsHarvester.py %s" % \
+                    (__version__,
+                     reduce(lambda x, y: x+' '+y, sys.argv[1:]))
+
+        return ident_str
+
+    ##########
+
+    def format_conditions_string(self, globaltag):
+        """Create the conditions string needed for `cmsDriver'.
+
+        Just glueing the FrontierConditions bit in front of it really.
+
+        """
+
+        # Not very robust but okay. The idea is that if the user
+        # specified (since this cannot happen with GlobalTags coming
+        # from DBS) something containing `conditions', they probably
+        # know what they're doing and we should not muck things up. In
+        # all other cases we just assume we only received the
+        # GlobalTag part and we built the usual conditions string from
+        # that .
+        if globaltag.lower().find("conditions") > -1:
+            conditions_string = globaltag
+        else:
+            conditions_string = "FrontierConditions_GlobalTag,%s" % \
+                                globaltag
+
+        # End of format_conditions_string.
+        return conditions_string
+
+    ##########
+
+    def db_account_name_cms_cond_globaltag(self):
+        """Return the database account name used to store the GlobalTag.
+
+        The name of the database account depends (albeit weakly) on
+        the CMSSW release version.
+
+        """
+
+        # This never changed, unlike the cms_cond_31X_DQM_SUMMARY ->
+        # cms_cond_34X_DQM transition.
+        account_name = "CMS_COND_31X_GLOBALTAG"
+
+        # End of db_account_name_cms_cond_globaltag.
+        return account_name
+
+    ##########
+
+    def db_account_name_cms_cond_dqm_summary(self):
+        """See db_account_name_cms_cond_globaltag."""
+
+        account_name = None
+        version = self.cmssw_version[6:11]
+        if version < "3_4_0":
+            account_name = "CMS_COND_31X_DQM_SUMMARY"
+        else:
+            account_name = "CMS_COND_34X"
+
+        # End of db_account_name_cms_cond_dqm_summary.
+        return account_name
+
+    ##########
+
+    def config_file_header(self):
+        "Create a nice header to be used to mark the generated files."
+
+        tmp = []
+
+        time_stamp = self.time_stamp()
+        ident_str = self.ident_string()
+        tmp.append("# %s" % time_stamp)
+        tmp.append("# WARNING: This file was created automatically!")
+        tmp.append("")
+        tmp.append("# Created by %s" % ident_str)
+
+        header = "\n".join(tmp)
+
+        # End of config_file_header.
+        return header
+
+    ##########
+
+    def set_output_level(self, output_level):
+        """Adjust the level of output generated.
+
+        Choices are:
+          - normal  : default level of output
+          - quiet   : less output than the default
+          - verbose : some additional information
+          - debug   : lots more information, may be overwhelming
+
+        NOTE: The debug option is a bit special in the sense that it
+              also modifies the output format.
+
+        """
+
+        # NOTE: These levels are hooked up to the ones used in the
+        #       logging module.
+        output_levels = {
+            "NORMAL"  : logging.INFO,
+            "QUIET"   : logging.WARNING,
+            "VERBOSE" : logging.INFO,
+            "DEBUG"   : logging.DEBUG
+            }
+
+        output_level = output_level.upper()
+
+        try:
+            # Update the logger.
+            self.log_level = output_levels[output_level]
+            self.logger.setLevel(self.log_level)
+        except KeyError:
+            # Show a complaint
+            self.logger.fatal("Unknown output level `%s'" % ouput_level)
+            # and re-raise an exception.
+            raise Exception
+
+        # End of set_output_level.
+
+    ##########
+
+    def option_handler_debug(self, option, opt_str, value, parser):
+        """Switch to debug mode.
+
+        This both increases the amount of output generated, as well as
+        changes the format used (more detailed information is given).
+
+        """
+
+        # Switch to a more informative log formatter for debugging.
+        log_formatter_debug = logging.Formatter("[%(levelname)s] " \
+                                                # NOTE: funcName was
+                                                # only implemented
+                                                # starting with python
+                                                # 2.5.
+                                                #"%(funcName)s() " \
+                                                #"@%(filename)s:%(lineno)d " \
+                                                "%(message)s")
+        # Hmmm, not very nice. This assumes there's only a single
+        # handler associated with the current logger.
+        log_handler = self.logger.handlers[0]
+        log_handler.setFormatter(log_formatter_debug)
+        self.set_output_level("DEBUG")
+
+        # End of option_handler_debug.
+
+    ##########
+
+    def option_handler_quiet(self, option, opt_str, value, parser):
+        "Switch to quiet mode: less verbose."
+
+        self.set_output_level("QUIET")
+
+        # End of option_handler_quiet.
+
+    ##########
+
+    def option_handler_force(self, option, opt_str, value, parser):
+        """Switch on `force mode' in which case we don't brake for nobody.
+
+        In so-called `force mode' all sanity checks are performed but
+        we don't halt on failure. Of course this requires some care
+        from the user.
+
+        """
+
+        self.logger.debug("Switching on `force mode'.")
+        self.force_running = True
+
+        # End of option_handler_force.
+
+    ##########
+
+    def option_handler_harvesting_type(self, option, opt_str, value, parser):
+        """Set the harvesting type to be used.
+
+        This checks that no harvesting type is already set, and sets
+        the harvesting type to be used to the one specified. If a
+        harvesting type is already set an exception is thrown. The
+        same happens when an unknown type is specified.
+
+        """
+
+        # Check for (in)valid harvesting types.
+        # NOTE: The matching is done in a bit of a complicated
+        # way. This allows the specification of the type to be
+        # case-insensitive while still ending up with the properly
+        # `cased' version afterwards.
+        value = value.lower()
+        harvesting_types_lowered = [i.lower() for i in self.harvesting_types]
+        try:
+            type_index = harvesting_types_lowered.index(value)
+            # If this works, we now have the index to the `properly
+            # cased' version of the harvesting type.
+        except ValueError:
+            self.logger.fatal("Unknown harvesting type `%s'" % \
+                              value)
+            self.logger.fatal("  possible types are: %s" %
+                              ", ".join(self.harvesting_types))
+            raise Usage("Unknown harvesting type `%s'" % \
+                        value)
+
+        # Check if multiple (by definition conflicting) harvesting
+        # types are being specified.
+        if not self.harvesting_type is None:
+            msg = "Only one harvesting type should be specified"
+            self.logger.fatal(msg)
+            raise Usage(msg)
+        self.harvesting_type = self.harvesting_types[type_index]
+
+        self.logger.info("Harvesting type to be used: `%s'" % \
+                         self.harvesting_type)
+
+        # End of option_handler_harvesting_type.
+
+    ##########
+
+    def option_handler_harvesting_mode(self, option, opt_str, value, parser):
+        """Set the harvesting mode to be used.
+
+        Single-step harvesting can be used for samples that are
+        located completely at a single site (= SE). Otherwise use
+        two-step mode.
+
+        """
+
+        # Check for valid mode.
+        harvesting_mode = value.lower()
+        if not harvesting_mode in self.harvesting_modes:
+            msg = "Unknown harvesting mode `%s'" % harvesting_mode
+            self.logger.fatal(msg)
+            self.logger.fatal("  possible modes are: %s" % \
+                              ", ".join(self.harvesting_modes))
+            raise Usage(msg)
+
+        # Check if we've been given only a single mode, otherwise
+        # complain.
+        if not self.harvesting_mode is None:
+            msg = "Only one harvesting mode should be specified"
+            self.logger.fatal(msg)
+            raise Usage(msg)
+        self.harvesting_mode = harvesting_mode
+
+        self.logger.info("Harvesting mode to be used: `%s'" % \
+                         self.harvesting_mode)
+
+        # End of option_handler_harvesting_mode.
+
+    ##########
+
+    def option_handler_globaltag(self, option, opt_str, value, parser):
+        """Set the GlobalTag to be used, overriding our own choices.
+
+        By default the cmsHarvester will use the GlobalTag with which
+        a given dataset was created also for the harvesting. The
+        --globaltag option is the way to override this behaviour.
+
+        """
+
+        # Make sure that this flag only occurred once.
+        if not self.globaltag is None:
+            msg = "Only one GlobalTag should be specified"
+            self.logger.fatal(msg)
+            raise Usage(msg)
+        self.globaltag = value
+
+        self.logger.info("GlobalTag to be used: `%s'" % \
+                         self.globaltag)
+
+        # End of option_handler_globaltag.
+
+    ##########
+
+    def option_handler_no_ref_hists(self, option, opt_str, value, parser):
+        "Switch use of all reference histograms off."
+
+        self.use_ref_hists = False
+
+        self.logger.warning("Switching off all use of reference histograms")
+
+        # End of option_handler_no_ref_hists.
+        
+     ##########
+
+    def option_handler_frontier_connection(self, option, opt_str,
+                                           value, parser):
+        """Override the default Frontier connection string.
+
+        Please only use this for testing (e.g. when a test payload has
+        been inserted into cms_orc_off instead of cms_orc_on).
+
+        This method gets called for three different command line
+        options:
+        - --frontier-connection,
+        - --frontier-connection-for-globaltag,
+        - --frontier-connection-for-refhists.
+        Appropriate care has to be taken to make sure things are only
+        specified once.
+
+        """
+
+        # Figure out with which command line option we've been called.
+        frontier_type = opt_str.split("-")[-1]
+        if frontier_type == "connection":
+            # Main option: change all connection strings.
+            frontier_types = self.frontier_connection_name.keys()
+        else:
+            frontier_types = [frontier_type]
+
+        # Make sure that each Frontier connection is specified only
+        # once. (Okay, in a bit of a dodgy way...)
+        for connection_name in frontier_types:
+            if self.frontier_connection_overridden[connection_name] == True:
+                msg = "Please specify either:\n" \
+                      "  `--frontier-connection' to change the " \
+                      "Frontier connection used for everything, or\n" \
+                      "either one or both of\n" \
+                      "  `--frontier-connection-for-globaltag' to " \
+                      "change the Frontier connection used for the " \
+                      "GlobalTag and\n" \
+                      "  `--frontier-connection-for-refhists' to change " \
+                      "the Frontier connection used for the " \
+                      "reference histograms."
+                self.logger.fatal(msg)
+                raise Usage(msg)
+
+        frontier_prefix = "frontier://"
+        if not value.startswith(frontier_prefix):
+            msg = "Expecting Frontier connections to start with " \
+                  "`%s'. You specified `%s'." % \
+                  (frontier_prefix, value)
+            self.logger.fatal(msg)
+            raise Usage(msg)
+        # We also kind of expect this to be either FrontierPrep or
+        # FrontierProd (but this is just a warning).
+        if value.find("FrontierProd") < 0 and \
+               value.find("FrontierProd") < 0:
+            msg = "Expecting Frontier connections to contain either " \
+                  "`FrontierProd' or `FrontierPrep'. You specified " \
+                  "`%s'. Are you sure?" % \
+                  value
+            self.logger.warning(msg)
+
+        if not value.endswith("/"):
+            value += "/"
+
+        for connection_name in frontier_types:
+            self.frontier_connection_name[connection_name] = value
+            self.frontier_connection_overridden[connection_name] = True
+
+            frontier_type_str = "unknown"
+            if connection_name == "globaltag":
+                frontier_type_str = "the GlobalTag"
+            elif connection_name == "refhists":
+                frontier_type_str = "the reference histograms"
+
+            self.logger.warning("Overriding default Frontier " \
+                                "connection for %s " \
+                                "with `%s'" % \
+                                (frontier_type_str,
+                                 self.frontier_connection_name[connection_name]))
+
+        # End of option_handler_frontier_connection
+
+    ##########
+
+    def option_handler_input_todofile(self, option, opt_str, value, parser):
+
+        self.todofile = value
+        # End of option_handler_input_todofile.
+
+    ##########
+
+    def option_handler_input_Jsonfile(self, option, opt_str, value, parser):
+
+        self.Jsonfilename = value
+        # End of option_handler_input_Jsonfile.
+
+    ##########
+
+    def option_handler_input_Jsonrunfile(self, option, opt_str, value, parser):
+
+        self.Jsonrunfilename = value
+        # End of option_handler_input_Jsonrunfile.
+
+    ##########
+
+    def option_handler_input_spec(self, option, opt_str, value, parser):
+        """TODO TODO TODO
+        Document this...
+
+        """
+
+        # Figure out if we were called for the `use these' or the
+        # `ignore these' case.
+        if opt_str.lower().find("ignore") > -1:
+            spec_type = "ignore"
+        else:
+            spec_type = "use"
+
+        # Similar: are we being called for datasets or for runs?
+        if opt_str.lower().find("dataset") > -1:
+            select_type = "datasets"
+        else:
+            select_type = "runs"
+
+        if not self.input_method[select_type][spec_type] is None:
+            msg = "Please only specify one input method " \
+                  "(for the `%s' case)" % opt_str
+            self.logger.fatal(msg)
+            raise Usage(msg)
+
+        input_method = opt_str.replace("-", "").replace("ignore", "")
+        self.input_method[select_type][spec_type] = input_method
+        self.input_name[select_type][spec_type] = value
+
+        self.logger.debug("Input method for the `%s' case: %s" % \
+                          (spec_type, input_method))
+
+        # End of option_handler_input_spec
+
+    ##########
+
+    def option_handler_book_keeping_file(self, option, opt_str, value, parser):
+        """Store the name of the file to be used for book keeping.
+
+        The only check done here is that only a single book keeping
+        file is specified.
+
+        """
+
+        file_name = value
+
+        if not self.book_keeping_file_name is None:
+            msg = "Only one book keeping file should be specified"
+            self.logger.fatal(msg)
+            raise Usage(msg)
+        self.book_keeping_file_name = file_name
+
+        self.logger.info("Book keeping file to be used: `%s'" % \
+                         self.book_keeping_file_name)
+
+        # End of option_handler_book_keeping_file.
+
+    ##########
+
+    def option_handler_ref_hist_mapping_file(self, option, opt_str, value, parser):
+        """Store the name of the file for the ref. histogram mapping.
+
+        """
+
+        file_name = value
+
+        if not self.ref_hist_mappings_file_name is None:
+            msg = "Only one reference histogram mapping file " \
+                  "should be specified"
+            self.logger.fatal(msg)
+            raise Usage(msg)
+        self.ref_hist_mappings_file_name = file_name
+
+        self.logger.info("Reference histogram mapping file " \
+                         "to be used: `%s'" % \
+                         self.ref_hist_mappings_file_name)
+
+        # End of option_handler_ref_hist_mapping_file.
+
+    ##########
+
+    # OBSOLETE OBSOLETE OBSOLETE
+
+##    def option_handler_dataset_name(self, option, opt_str, value, parser):
+##        """Specify the name(s) of the dataset(s) to be processed.
+
+##        It is checked to make sure that no dataset name or listfile
+##        names are given yet. If all is well (i.e. we still have a
+##        clean slate) the dataset name is stored for later use,
+##        otherwise a Usage exception is raised.
+
+##        """
+
+##        if not self.input_method is None:
+##            if self.input_method == "dataset":
+##                raise Usage("Please only feed me one dataset specification")
+##            elif self.input_method == "listfile":
+##                raise Usage("Cannot specify both dataset and input list file")
+##            else:
+##                assert False, "Unknown input method `%s'" % self.input_method
+##        self.input_method = "dataset"
+##        self.input_name = value
+##        self.logger.info("Input method used: %s" % self.input_method)
+
+##        # End of option_handler_dataset_name.
+
+##    ##########
+
+##    def option_handler_listfile_name(self, option, opt_str, value, parser):
+##        """Specify the input list file containing datasets to be processed.
+
+##        It is checked to make sure that no dataset name or listfile
+##        names are given yet. If all is well (i.e. we still have a
+##        clean slate) the listfile name is stored for later use,
+##        otherwise a Usage exception is raised.
+
+##        """
+
+##        if not self.input_method is None:
+##            if self.input_method == "listfile":
+##                raise Usage("Please only feed me one list file")
+##            elif self.input_method == "dataset":
+##                raise Usage("Cannot specify both dataset and input list file")
+##            else:
+##                assert False, "Unknown input method `%s'" % self.input_method
+##        self.input_method = "listfile"
+##        self.input_name = value
+##        self.logger.info("Input method used: %s" % self.input_method)
+
+##        # End of option_handler_listfile_name.
+
+    # OBSOLETE OBSOLETE OBSOLETE end
+
+    ##########
+
+    def option_handler_castor_dir(self, option, opt_str, value, parser):
+        """Specify where on CASTOR the output should go.
+
+        At the moment only output to CERN CASTOR is
+        supported. Eventually the harvested results should go into the
+        central place for DQM on CASTOR anyway.
+
+        """
+
+        # Check format of specified CASTOR area.
+        castor_dir = value
+        #castor_dir = castor_dir.lstrip(os.path.sep)
+        castor_prefix = self.castor_prefix
+
+        # Add a leading slash if necessary and clean up the path.
+        castor_dir = os.path.join(os.path.sep, castor_dir)
+        self.castor_base_dir = os.path.normpath(castor_dir)
+
+        self.logger.info("CASTOR (base) area to be used: `%s'" % \
+                         self.castor_base_dir)
+
+        # End of option_handler_castor_dir.
+
+    ##########
+
+    def option_handler_no_t1access(self, option, opt_str, value, parser):
+        """Set the self.no_t1access flag to try and create jobs that
+        run without special `t1access' role.
+
+        """
+
+        self.non_t1access = True
+
+        self.logger.warning("Running in `non-t1access' mode. " \
+                            "Will try to create jobs that run " \
+                            "without special rights but no " \
+                            "further promises...")
+
+        # End of option_handler_no_t1access.
+       
+    ##########
+
+    def option_handler_caf_access(self, option, opt_str, value, parser):
+        """Set the self.caf_access flag to try and create jobs that
+        run on the CAF.
+
+        """
+        self.caf_access = True
+
+        self.logger.warning("Running in `caf_access' mode. " \
+                            "Will try to create jobs that run " \
+                            "on CAF but no" \
+                            "further promises...")
 
-    ##########
+        # End of option_handler_caf_access.
+        
+   ##########
 
-    def cleanup(self):
-        "Clean up after ourselves."
+    def option_handler_saveByLumiSection(self, option, opt_str, value, parser):
+        """Set process.dqmSaver.saveByLumiSectiont=1 in cfg harvesting file
+        """
+        self.saveByLumiSection = True
 
-        # NOTE: This is the safe replacement of __del__.
+        self.logger.warning("waning concerning saveByLumiSection option")
 
-        #self.logger.debug("All done -> shutting down")
-        logging.shutdown()
+        # End of option_handler_saveByLumiSection.
 
-        # End of cleanup.
 
     ##########
 
-    def time_stamp(self):
-        "Create a timestamp to use in the created config files."
+    def option_handler_crab_submission(self, option, opt_str, value, parser):
+        """Crab jobs are not created and
+	"submitted automatically",
+        """
+        self.crab_submission = True
 
-        time_now = datetime.datetime.utcnow()
-        # We don't care about the microseconds.
-        time_now = time_now.replace(microsecond = 0)
-        time_stamp = "%sUTC" % datetime.datetime.isoformat(time_now)
+        # End of option_handler_crab_submission.
+       
+    ##########
 
-        # End of time_stamp.
-        return time_stamp
+    def option_handler_sites(self, option, opt_str, value, parser):
 
-    ##########
+        self.nr_max_sites = value
 
-    def ident_string(self):
-        "Spit out an identification string for cmsHarvester.py."
+    ##########
 
-        ident_str = "`cmsHarvester.py " \
-                    "version %s': cmsHarvester.py %s" % \
-                    (__version__,
-                     reduce(lambda x, y: x+' '+y, sys.argv[1:]))
+    def option_handler_preferred_site(self, option, opt_str, value, parser):
 
-        return ident_str
+        self.preferred_site = value
 
     ##########
 
-    def format_conditions_string(self, globaltag):
-        """Create the conditions string needed for `cmsDriver'.
-
-        Just glueing the FrontierConditions bit in front of it really.
+    def option_handler_storage_backend(self, option, opt_str,
+                                       value, parser):
+        """Choose the storage backend for the output area.
 
         """
 
-        # Not very robust but okay. The idea is that if the user
-        # specified (since this cannot happen with GlobalTags coming
-        # from DBS) something containing `conditions', they probably
-        # know what they're doing and we should not muck things up. In
-        # all other cases we just assume we only received the
-        # GlobalTag part and we built the usual conditions string from
-        # that .
-        if globaltag.lower().find("conditions") > -1:
-            conditions_string = globaltag
-        else:
-            conditions_string = "FrontierConditions_GlobalTag,%s" % \
-                                globaltag
+        if not value in ["auto", "castor", "eos", "local"]:
+            msg = "Unknown storage backend `%s' (should be one of " \
+                  "`auto', `castor', `eos' or `local')" % value
+            self.logger.fatal(msg)
+            raise Usage(msg)
+        self.storage_backend_name = value
 
-        # End of format_conditions_string.
-        return conditions_string
+        self.logger.info("Storage backend to be used: %s" % \
+                         self.storage_backend_name)
 
-    ##########
+        # End of option_handler_storage_backend.
 
-    def db_account_name_cms_cond_globaltag(self):
-        """Return the database account name used to store the GlobalTag.
+    ##########
 
-        The name of the database account depends (albeit weakly) on
-        the CMSSW release version.
+    def option_handler_storage_workers(self, option, opt_str,
+                                       value, parser):
+        """Set the number of storage commands to run concurrently.
 
         """
 
-        # This never changed, unlike the cms_cond_31X_DQM_SUMMARY ->
-        # cms_cond_34X_DQM transition.
-        account_name = "CMS_COND_31X_GLOBALTAG"
-
-        # End of db_account_name_cms_cond_globaltag.
-        return account_name
-
-    ##########
-
-    def db_account_name_cms_cond_dqm_summary(self):
-        """See db_account_name_cms_cond_globaltag."""
+        if value < 1:
+            msg = "The number of storage workers should be at least " \
+                  "one (not %d)" % value
+            self.logger.fatal(msg)
+            raise Usage(msg)
+        self.storage_workers = value
 
-        account_name = None
-        version = self.cmssw_version[6:11]
-        if version < "3_4_0":
-            account_name = "CMS_COND_31X_DQM_SUMMARY"
-        else:
-            account_name = "CMS_COND_34X"
+        self.logger.info("Using %d concurrent storage worker(s)" % \
+                         self.storage_workers)
 
-        # End of db_account_name_cms_cond_dqm_summary.
-        return account_name
+        # End of option_handler_storage_workers.
 
     ##########
 
-    def config_file_header(self):
-        "Create a nice header to be used to mark the generated files."
+    def option_handler_site_history_file(self, option, opt_str,
+                                         value, parser):
+        """Use (and keep) the site performance history in this file.
 
-        tmp = []
+        """
 
-        time_stamp = self.time_stamp()
-        ident_str = self.ident_string()
-        tmp.append("# %s" % time_stamp)
-        tmp.append("# WARNING: This file was created automatically!")
-        tmp.append("")
-        tmp.append("# Created by %s" % ident_str)
+        if not self.site_history_file_name is None:
+            msg = "Only one site history file should be specified"
+            self.logger.fatal(msg)
+            raise Usage(msg)
+        self.site_history_file_name = value
 
-        header = "\n".join(tmp)
+        self.logger.info("Site history file to be used: `%s'" % \
+                         self.site_history_file_name)
 
-        # End of config_file_header.
-        return header
+        # End of option_handler_site_history_file.
 
     ##########
 
-    def set_output_level(self, output_level):
-        """Adjust the level of output generated.
-
-        Choices are:
-          - normal  : default level of output
-          - quiet   : less output than the default
-          - verbose : some additional information
-          - debug   : lots more information, may be overwhelming
+    def option_handler_update_site_history(self, option, opt_str,
+                                           value, parser):
+        """Follow the jobs in the site history file.
 
-        NOTE: The debug option is a bit special in the sense that it
-              also modifies the output format.
+        Updates the site history and quits.
 
         """
 
-        # NOTE: These levels are hooked up to the ones used in the
-        #       logging module.
-        output_levels = {
-            "NORMAL"  : logging.INFO,
-            "QUIET"   : logging.WARNING,
-            "VERBOSE" : logging.INFO,
-            "DEBUG"   : logging.DEBUG
-            }
-
-        output_level = output_level.upper()
-
         try:
-            # Update the logger.
-            self.log_level = output_levels[output_level]
-            self.logger.setLevel(self.log_level)
-        except KeyError:
-            # Show a complaint
-            self.logger.fatal("Unknown output level `%s'" % ouput_level)
-            # and re-raise an exception.
-            raise Exception
+            self.update_site_history(value)
+        except Error, err:
+            self.logger.fatal(err.msg)
+            raise
 
-        # End of set_output_level.
+        # We're done, let's quit.
+        raise SystemExit
 
-    ##########
+        # End of option_handler_update_site_history.
 
-    def option_handler_debug(self, option, opt_str, value, parser):
-        """Switch to debug mode.
+    ##########
 
-        This both increases the amount of output generated, as well as
-        changes the format used (more detailed information is given).
+    def option_handler_hedge_sites(self, option, opt_str, value, parser):
+        """Set the maximum number of sites a hedged run goes to.
 
         """
 
-        # Switch to a more informative log formatter for debugging.
-        log_formatter_debug = logging.Formatter("[%(levelname)s] " \
-                                                # NOTE: funcName was
-                                                # only implemented
-                                                # starting with python
-                                                # 2.5.
-                                                #"%(funcName)s() " \
-                                                #"@%(filename)s:%(lineno)d " \
-                                                "%(message)s")
-        # Hmmm, not very nice. This assumes there's only a single
-        # handler associated with the current logger.
-        log_handler = self.logger.handlers[0]
-        log_handler.setFormatter(log_formatter_debug)
-        self.set_output_level("DEBUG")
+        if value < 1:
+            msg = "The number of hedge sites should be at least one"
+            self.logger.fatal(msg)
+            raise Usage(msg)
+        self.hedge_sites = value
 
-        # End of option_handler_debug.
+        # End of option_handler_hedge_sites.
 
     ##########
 
-    def option_handler_quiet(self, option, opt_str, value, parser):
-        "Switch to quiet mode: less verbose."
+    def option_handler_hedge_budget(self, option, opt_str, value, parser):
+        """Set the maximum number of extra (hedged) submissions.
 
-        self.set_output_level("QUIET")
+        """
 
-        # End of option_handler_quiet.
+        if value < 0:
+            msg = "The hedge budget should not be negative"
+            self.logger.fatal(msg)
+            raise Usage(msg)
+        self.hedge_budget = value
 
-    ##########
+        # End of option_handler_hedge_budget.
 
-    def option_handler_force(self, option, opt_str, value, parser):
-        """Switch on `force mode' in which case we don't brake for nobody.
+    ##########
 
-        In so-called `force mode' all sanity checks are performed but
-        we don't halt on failure. Of course this requires some care
-        from the user.
+    def option_handler_hedge_manifest(self, option, opt_str, value, parser):
+        """Set the name of the hedge manifest file.
 
         """
 
-        self.logger.debug("Switching on `force mode'.")
-        self.force_running = True
+        self.hedge_manifest_file_name = value
 
-        # End of option_handler_force.
+        # End of option_handler_hedge_manifest.
 
     ##########
 
-    def option_handler_harvesting_type(self, option, opt_str, value, parser):
-        """Set the harvesting type to be used.
+    def option_handler_reap_hedges(self, option, opt_str, value, parser):
+        """Kill the remaining tasks of hedged runs that are done.
 
-        This checks that no harvesting type is already set, and sets
-        the harvesting type to be used to the one specified. If a
-        harvesting type is already set an exception is thrown. The
-        same happens when an unknown type is specified.
+        Reads the hedge manifest, does the reaping and quits.
 
         """
 
-        # Check for (in)valid harvesting types.
-        # NOTE: The matching is done in a bit of a complicated
-        # way. This allows the specification of the type to be
-        # case-insensitive while still ending up with the properly
-        # `cased' version afterwards.
-        value = value.lower()
-        harvesting_types_lowered = [i.lower() for i in self.harvesting_types]
         try:
-            type_index = harvesting_types_lowered.index(value)
-            # If this works, we now have the index to the `properly
-            # cased' version of the harvesting type.
-        except ValueError:
-            self.logger.fatal("Unknown harvesting type `%s'" % \
-                              value)
-            self.logger.fatal("  possible types are: %s" %
-                              ", ".join(self.harvesting_types))
-            raise Usage("Unknown harvesting type `%s'" % \
-                        value)
-
-        # Check if multiple (by definition conflicting) harvesting
-        # types are being specified.
-        if not self.harvesting_type is None:
-            msg = "Only one harvesting type should be specified"
-            self.logger.fatal(msg)
-            raise Usage(msg)
-        self.harvesting_type = self.harvesting_types[type_index]
+            self.reap_hedges(value)
+        except Error, err:
+            self.logger.fatal(err.msg)
+            raise
 
-        self.logger.info("Harvesting type to be used: `%s'" % \
-                         self.harvesting_type)
+        # We're done, let's quit.
+        raise SystemExit
 
-        # End of option_handler_harvesting_type.
+        # End of option_handler_reap_hedges.
 
     ##########
 
-    def option_handler_harvesting_mode(self, option, opt_str, value, parser):
-        """Set the harvesting mode to be used.
+    def option_handler_site_weights(self, option, opt_str, value, parser):
+        """Set the relative capacities of sites.
 
-        Single-step harvesting can be used for samples that are
-        located completely at a single site (= SE). Otherwise use
-        two-step mode.
+        The weights are given as a comma-separated list of
+        SITE=WEIGHT pairs.
 
         """
 
-        # Check for valid mode.
-        harvesting_mode = value.lower()
-        if not harvesting_mode in self.harvesting_modes:
-            msg = "Unknown harvesting mode `%s'" % harvesting_mode
-            self.logger.fatal(msg)
-            self.logger.fatal("  possible modes are: %s" % \
-                              ", ".join(self.harvesting_modes))
-            raise Usage(msg)
-
-        # Check if we've been given only a single mode, otherwise
-        # complain.
-        if not self.harvesting_mode is None:
-            msg = "Only one harvesting mode should be specified"
-            self.logger.fatal(msg)
-            raise Usage(msg)
-        self.harvesting_mode = harvesting_mode
+        site_weights = {}
+        for piece in value.split(","):
+            piece = piece.strip()
+            if len(piece) < 1:
+                continue
+            try:
+                (site_name, weight) = piece.split("=")
+                weight = float(weight)
+            except ValueError:
+                msg = "Could not understand site weight `%s' " \
+                      "(should be SITE=WEIGHT)" % piece
+                self.logger.fatal(msg)
+                raise Usage(msg)
+            if weight <= 0.:
+                msg = "Site weights should be positive (not %s)" % piece
+                self.logger.fatal(msg)
+                raise Usage(msg)
+            site_weights[site_name.strip()] = weight
+        self.site_weights = site_weights
 
-        self.logger.info("Harvesting mode to be used: `%s'" % \
-                         self.harvesting_mode)
+        self.logger.info("Site weights to be used: %s" % \
+                         ", ".join(["%s=%.2f" % i for i in \
+                                    site_weights.items()]))
 
-        # End of option_handler_harvesting_mode.
+        # End of option_handler_site_weights.
 
     ##########
 
-    def option_handler_globaltag(self, option, opt_str, value, parser):
-        """Set the GlobalTag to be used, overriding our own choices.
-
-        By default the cmsHarvester will use the GlobalTag with which
-        a given dataset was created also for the harvesting. The
-        --globaltag option is the way to override this behaviour.
+    def option_handler_dbs_workers(self, option, opt_str, value, parser):
+        """Set the number of DBS queries to run concurrently.
 
         """
 
-        # Make sure that this flag only occurred once.
-        if not self.globaltag is None:
-            msg = "Only one GlobalTag should be specified"
+        if value < 1:
+            msg = "The number of DBS workers should be at least one " \
+                  "(not %d)" % value
             self.logger.fatal(msg)
             raise Usage(msg)
-        self.globaltag = value
+        self.dbs_workers = value
 
-        self.logger.info("GlobalTag to be used: `%s'" % \
-                         self.globaltag)
+        self.logger.info("Using %d concurrent DBS worker(s)" % \
+                         self.dbs_workers)
 
-        # End of option_handler_globaltag.
+        # End of option_handler_dbs_workers.
 
     ##########
 
-    def option_handler_no_ref_hists(self, option, opt_str, value, parser):
-        "Switch use of all reference histograms off."
+    def option_handler_dbs_spread_chunk_runs(self, option, opt_str,
+                                             value, parser):
+        """Set the number of runs per piece of file-level DBS query.
 
-        self.use_ref_hists = False
+        """
 
-        self.logger.warning("Switching off all use of reference histograms")
+        if value < 0:
+            msg = "The number of runs per spread query cannot be " \
+                  "negative (not %d)" % value
+            self.logger.fatal(msg)
+            raise Usage(msg)
+        self.dbs_spread_chunk_runs = value
 
-        # End of option_handler_no_ref_hists.
-        
-     ##########
+        if self.dbs_spread_chunk_runs > 0:
+            self.logger.info("Splitting file-level DBS queries into " \
+                             "pieces of %d run(s)" % \
+                             self.dbs_spread_chunk_runs)
+        else:
+            self.logger.info("Not splitting file-level DBS queries")
 
-    def option_handler_frontier_connection(self, option, opt_str,
-                                           value, parser):
-        """Override the default Frontier connection string.
+        # End of option_handler_dbs_spread_chunk_runs.
 
-        Please only use this for testing (e.g. when a test payload has
-        been inserted into cms_orc_off instead of cms_orc_on).
+    ##########
 
-        This method gets called for three different command line
-        options:
-        - --frontier-connection,
-        - --frontier-connection-for-globaltag,
-        - --frontier-connection-for-refhists.
-        Appropriate care has to be taken to make sure things are only
-        specified once.
+    def option_handler_spread_mode(self, option, opt_str, value, parser):
+        """Choose how to determine the spread of datasets over sites.
 
         """
 
-        # Figure out with which command line option we've been called.
-        frontier_type = opt_str.split("-")[-1]
-        if frontier_type == "connection":
-            # Main option: change all connection strings.
-            frontier_types = self.frontier_connection_name.keys()
-        else:
-            frontier_types = [frontier_type]
-
-        # Make sure that each Frontier connection is specified only
-        # once. (Okay, in a bit of a dodgy way...)
-        for connection_name in frontier_types:
-            if self.frontier_connection_overridden[connection_name] == True:
-                msg = "Please specify either:\n" \
-                      "  `--frontier-connection' to change the " \
-                      "Frontier connection used for everything, or\n" \
-                      "either one or both of\n" \
-                      "  `--frontier-connection-for-globaltag' to " \
-                      "change the Frontier connection used for the " \
-                      "GlobalTag and\n" \
-                      "  `--frontier-connection-for-refhists' to change " \
-                      "the Frontier connection used for the " \
-                      "reference histograms."
-                self.logger.fatal(msg)
-                raise Usage(msg)
-
-        frontier_prefix = "frontier://"
-        if not value.startswith(frontier_prefix):
-            msg = "Expecting Frontier connections to start with " \
-                  "`%s'. You specified `%s'." % \
-                  (frontier_prefix, value)
+        if not value in ["file", "block"]:
+            msg = "Unknown spread mode `%s' " \
+                  "(should be `file' or `block')" % value
             self.logger.fatal(msg)
             raise Usage(msg)
-        # We also kind of expect this to be either FrontierPrep or
-        # FrontierProd (but this is just a warning).
-        if value.find("FrontierProd") < 0 and \
-               value.find("FrontierProd") < 0:
-            msg = "Expecting Frontier connections to contain either " \
-                  "`FrontierProd' or `FrontierPrep'. You specified " \
-                  "`%s'. Are you sure?" % \
-                  value
-            self.logger.warning(msg)
+        self.spread_mode = value
 
-        if not value.endswith("/"):
-            value += "/"
+        self.logger.info("Determining dataset spread from %s-level " \
+                         "information" % self.spread_mode)
 
-        for connection_name in frontier_types:
-            self.frontier_connection_name[connection_name] = value
-            self.frontier_connection_overridden[connection_name] = True
+        # End of option_handler_spread_mode.
 
-            frontier_type_str = "unknown"
-            if connection_name == "globaltag":
-                frontier_type_str = "the GlobalTag"
-            elif connection_name == "refhists":
-                frontier_type_str = "the reference histograms"
+    ##########
 
-            self.logger.warning("Overriding default Frontier " \
-                                "connection for %s " \
-                                "with `%s'" % \
-                                (frontier_type_str,
-                                 self.frontier_connection_name[connection_name]))
+    def option_handler_dbs_retries(self, option, opt_str, value, parser):
+        """Set the number of times to retry a failing DBS query.
 
-        # End of option_handler_frontier_connection
+        """
 
-    ##########
+        if value < 0:
+            msg = "The number of DBS retries cannot be negative " \
+                  "(not %d)" % value
+            self.logger.fatal(msg)
+            raise Usage(msg)
+        self.dbs_retries = value
 
-    def option_handler_input_todofile(self, option, opt_str, value, parser):
+        self.logger.info("Retrying failing DBS queries up to %d time(s)" % \
+                         self.dbs_retries)
 
-        self.todofile = value
-        # End of option_handler_input_todofile.
+        # End of option_handler_dbs_retries.
 
     ##########
 
-    def option_handler_input_Jsonfile(self, option, opt_str, value, parser):
-
-        self.Jsonfilename = value
-        # End of option_handler_input_Jsonfile.
+    def option_handler_dbs_cache_dir(self, option, opt_str, value, parser):
+        "Store the name of the directory to cache DBS results in."
 
-    ##########
+        if not self.dbs_cache_dir is None:
+            msg = "Only one DBS cache directory should be specified"
+            self.logger.fatal(msg)
+            raise Usage(msg)
+        self.dbs_cache_dir = value
 
-    def option_handler_input_Jsonrunfile(self, option, opt_str, value, parser):
+        self.logger.info("DBS cache directory to be used: `%s'" % \
+                         self.dbs_cache_dir)
 
-        self.Jsonrunfilename = value
-        # End of option_handler_input_Jsonrunfile.
+        # End of option_handler_dbs_cache_dir.
 
     ##########
 
-    def option_handler_input_spec(self, option, opt_str, value, parser):
-        """TODO TODO TODO
-        Document this...
+    def option_handler_dbs_cache_refresh(self, option, opt_str, value, parser):
+        "Ignore (but update) anything already in the DBS cache."
 
-        """
+        self.dbs_cache_refresh = True
 
-        # Figure out if we were called for the `use these' or the
-        # `ignore these' case.
-        if opt_str.lower().find("ignore") > -1:
-            spec_type = "ignore"
-        else:
-            spec_type = "use"
+        # End of option_handler_dbs_cache_refresh.
 
-        # Similar: are we being called for datasets or for runs?
-        if opt_str.lower().find("dataset") > -1:
-            select_type = "datasets"
-        else:
-            select_type = "runs"
+    ##########
 
-        if not self.input_method[select_type][spec_type] is None:
-            msg = "Please only specify one input method " \
-                  "(for the `%s' case)" % opt_str
+    def option_handler_dbs_url(self, option, opt_str, value, parser):
+        "Store the URL of the DBS server to use."
+
+        if not self.dbs_url is None:
+            msg = "Only one DBS URL should be specified"
             self.logger.fatal(msg)
             raise Usage(msg)
+        self.dbs_url = value
 
-        input_method = opt_str.replace("-", "").replace("ignore", "")
-        self.input_method[select_type][spec_type] = input_method
-        self.input_name[select_type][spec_type] = value
-
-        self.logger.debug("Input method for the `%s' case: %s" % \
-                          (spec_type, input_method))
+        self.logger.info("DBS URL to be used: `%s'" % self.dbs_url)
 
-        # End of option_handler_input_spec
+        # End of option_handler_dbs_url.
 
     ##########
 
-    def option_handler_book_keeping_file(self, option, opt_str, value, parser):
-        """Store the name of the file to be used for book keeping.
+    def option_handler_dbs_telemetry_file(self, option, opt_str,
+                                          value, parser):
+        "Store the name of the file to write DBS telemetry to."
 
-        The only check done here is that only a single book keeping
-        file is specified.
+        if not self.dbs_telemetry_file_name is None:
+            msg = "Only one DBS telemetry file should be specified"
+            self.logger.fatal(msg)
+            raise Usage(msg)
+        self.dbs_telemetry_file_name = value
 
-        """
+        self.logger.info("DBS telemetry will be written to `%s'" % \
+                         self.dbs_telemetry_file_name)
 
-        file_name = value
+        # End of option_handler_dbs_telemetry_file.
 
-        if not self.book_keeping_file_name is None:
-            msg = "Only one book keeping file should be specified"
+    ##########
+
+    def option_handler_dbs_record_dir(self, option, opt_str, value, parser):
+        "Store the name of the directory to record DBS fixtures in."
+
+        if not self.dbs_record_dir is None:
+            msg = "Only one DBS record directory should be specified"
             self.logger.fatal(msg)
             raise Usage(msg)
-        self.book_keeping_file_name = file_name
+        self.dbs_record_dir = value
 
-        self.logger.info("Book keeping file to be used: `%s'" % \
-                         self.book_keeping_file_name)
+        self.logger.info("Recording DBS queries and responses in `%s'" % \
+                         self.dbs_record_dir)
 
-        # End of option_handler_book_keeping_file.
+        # End of option_handler_dbs_record_dir.
 
     ##########
 
-    def option_handler_ref_hist_mapping_file(self, option, opt_str, value, parser):
-        """Store the name of the file for the ref. histogram mapping.
+    def option_handler_dbs_replay(self, option, opt_str, value, parser):
+        """Use a local stand-in for DBS, serving these fixtures.
 
         """
 
-        file_name = value
-
-        if not self.ref_hist_mappings_file_name is None:
-            msg = "Only one reference histogram mapping file " \
-                  "should be specified"
+        if not self.dbs_replay_dir is None:
+            msg = "Only one DBS replay directory should be specified"
             self.logger.fatal(msg)
             raise Usage(msg)
-        self.ref_hist_mappings_file_name = file_name
+        self.dbs_replay_dir = value
 
-        self.logger.info("Reference histogram mapping file " \
-                         "to be used: `%s'" % \
-                         self.ref_hist_mappings_file_name)
+        self.logger.info("Replaying DBS fixtures from `%s'" % \
+                         self.dbs_replay_dir)
 
-        # End of option_handler_ref_hist_mapping_file.
+        # End of option_handler_dbs_replay.
 
     ##########
 
-    # OBSOLETE OBSOLETE OBSOLETE
-
-##    def option_handler_dataset_name(self, option, opt_str, value, parser):
-##        """Specify the name(s) of the dataset(s) to be processed.
-
-##        It is checked to make sure that no dataset name or listfile
-##        names are given yet. If all is well (i.e. we still have a
-##        clean slate) the dataset name is stored for later use,
-##        otherwise a Usage exception is raised.
+    def option_handler_dbs_replay_format(self, option, opt_str,
+                                         value, parser):
+        "Choose the DBS XML format used by the local DBS stand-in."
 
-##        """
+        if not value in ["old", "new"]:
+            msg = "Unknown DBS replay format `%s' " \
+                  "(should be `old' or `new')" % value
+            self.logger.fatal(msg)
+            raise Usage(msg)
+        self.dbs_replay_old_format = (value == "old")
 
-##        if not self.input_method is None:
-##            if self.input_method == "dataset":
-##                raise Usage("Please only feed me one dataset specification")
-##            elif self.input_method == "listfile":
-##                raise Usage("Cannot specify both dataset and input list file")
-##            else:
-##                assert False, "Unknown input method `%s'" % self.input_method
-##        self.input_method = "dataset"
-##        self.input_name = value
-##        self.logger.info("Input method used: %s" % self.input_method)
+        # End of option_handler_dbs_replay_format.
 
-##        # End of option_handler_dataset_name.
+    ##########
 
-##    ##########
+    def option_handler_dbs_replay_latency(self, option, opt_str,
+                                          value, parser):
+        "Set the time each request to the local DBS stand-in takes."
 
-##    def option_handler_listfile_name(self, option, opt_str, value, parser):
-##        """Specify the input list file containing datasets to be processed.
+        if value < 0.:
+            msg = "The DBS replay latency cannot be negative"
+            self.logger.fatal(msg)
+            raise Usage(msg)
+        self.dbs_replay_latency = value
 
-##        It is checked to make sure that no dataset name or listfile
-##        names are given yet. If all is well (i.e. we still have a
-##        clean slate) the listfile name is stored for later use,
-##        otherwise a Usage exception is raised.
+        # End of option_handler_dbs_replay_latency.
 
-##        """
+    ##########
 
-##        if not self.input_method is None:
-##            if self.input_method == "listfile":
-##                raise Usage("Please only feed me one list file")
-##            elif self.input_method == "dataset":
-##                raise Usage("Cannot specify both dataset and input list file")
-##            else:
-##                assert False, "Unknown input method `%s'" % self.input_method
-##        self.input_method = "listfile"
-##        self.input_name = value
-##        self.logger.info("Input method used: %s" % self.input_method)
+    def option_handler_dbs_replay_failure_rate(self, option, opt_str,
+                                               value, parser):
+        "Set the fraction of requests the local DBS stand-in fails."
 
-##        # End of option_handler_listfile_name.
+        if value < 0. or value > 1.:
+            msg = "The DBS replay failure rate should be " \
+                  "between 0 and 1 (not %f)" % value
+            self.logger.fatal(msg)
+            raise Usage(msg)
+        self.dbs_replay_failure_rate = value
 
-    # OBSOLETE OBSOLETE OBSOLETE end
+        # End of option_handler_dbs_replay_failure_rate.
 
     ##########
 
-    def option_handler_castor_dir(self, option, opt_str, value, parser):
-        """Specify where on CASTOR the output should go.
-
-        At the moment only output to CERN CASTOR is
-        supported. Eventually the harvested results should go into the
-        central place for DQM on CASTOR anyway.
+    def option_handler_site_version_cache(self, option, opt_str,
+                                          value, parser):
+        """Keep the CMSSW versions found at sites in this file.
 
         """
 
-        # Check format of specified CASTOR area.
-        castor_dir = value
-        #castor_dir = castor_dir.lstrip(os.path.sep)
-        castor_prefix = self.castor_prefix
-
-        # Add a leading slash if necessary and clean up the path.
-        castor_dir = os.path.join(os.path.sep, castor_dir)
-        self.castor_base_dir = os.path.normpath(castor_dir)
+        if not self.site_version_cache_file_name is None:
+            msg = "Only one site version cache file should be specified"
+            self.logger.fatal(msg)
+            raise Usage(msg)
+        self.site_version_cache_file_name = value
 
-        self.logger.info("CASTOR (base) area to be used: `%s'" % \
-                         self.castor_base_dir)
+        self.logger.info("Site version cache file to be used: `%s'" % \
+                         self.site_version_cache_file_name)
 
-        # End of option_handler_castor_dir.
+        # End of option_handler_site_version_cache.
 
     ##########
 
-    def option_handler_no_t1access(self, option, opt_str, value, parser):
-        """Set the self.no_t1access flag to try and create jobs that
-        run without special `t1access' role.
+    def option_handler_site_version_cache_refresh(self, option, opt_str,
+                                                  value, parser):
+        """Ignore the contents of the site version cache.
 
         """
 
-        self.non_t1access = True
+        self.site_version_cache_refresh = True
 
-        self.logger.warning("Running in `non-t1access' mode. " \
-                            "Will try to create jobs that run " \
-                            "without special rights but no " \
-                            "further promises...")
+        # End of option_handler_site_version_cache_refresh.
 
-        # End of option_handler_no_t1access.
-       
     ##########
 
-    def option_handler_caf_access(self, option, opt_str, value, parser):
-        """Set the self.caf_access flag to try and create jobs that
-        run on the CAF.
+    def option_handler_site_info_snapshot(self, option, opt_str,
+                                          value, parser):
+        """Keep the site information in this snapshot file.
 
         """
-        self.caf_access = True
 
-        self.logger.warning("Running in `caf_access' mode. " \
-                            "Will try to create jobs that run " \
-                            "on CAF but no" \
-                            "further promises...")
+        if not self.site_info_snapshot_file_name is None:
+            msg = "Only one site information snapshot should be specified"
+            self.logger.fatal(msg)
+            raise Usage(msg)
+        self.site_info_snapshot_file_name = value
 
-        # End of option_handler_caf_access.
-        
-   ##########
+        self.logger.info("Site information snapshot to be used: `%s'" % \
+                         self.site_info_snapshot_file_name)
 
-    def option_handler_saveByLumiSection(self, option, opt_str, value, parser):
-        """Set process.dqmSaver.saveByLumiSectiont=1 in cfg harvesting file
-        """
-        self.saveByLumiSection = True
+        # End of option_handler_site_info_snapshot.
 
-        self.logger.warning("waning concerning saveByLumiSection option")
+    ##########
 
-        # End of option_handler_saveByLumiSection.
+    def option_handler_spread_cache_file(self, option, opt_str,
+                                         value, parser):
+        """Keep the spread of datasets over sites in this file.
+
+        """
 
+        if not self.spread_cache_file_name is None:
+            msg = "Only one spread cache file should be specified"
+            self.logger.fatal(msg)
+            raise Usage(msg)
+        self.spread_cache_file_name = value
 
-    ##########
+        self.logger.info("Spread cache file to be used: `%s'" % \
+                         self.spread_cache_file_name)
 
-    def option_handler_crab_submission(self, option, opt_str, value, parser):
-        """Crab jobs are not created and
-	"submitted automatically",
-        """
-        self.crab_submission = True
+        # End of option_handler_spread_cache_file.
 
-        # End of option_handler_crab_submission.
-       
     ##########
 
-    def option_handler_sites(self, option, opt_str, value, parser):
+    def option_handler_incremental_state_file(self, option, opt_str,
+                                              value, parser):
+        """Switch on incremental running using this state file.
 
-        self.nr_max_sites = value
+        """
 
-    ##########
+        if not self.incremental_state_file_name is None:
+            msg = "Only one incremental state file should be specified"
+            self.logger.fatal(msg)
+            raise Usage(msg)
+        self.incremental_state_file_name = value
 
-    def option_handler_preferred_site(self, option, opt_str, value, parser):
+        self.logger.info("Incremental state file to be used: `%s'" % \
+                         self.incremental_state_file_name)
 
-        self.preferred_site = value
+        # End of option_handler_incremental_state_file.
 
     ##########
 
@@ -1202,6 +5831,58 @@ class CMSHarvester(object):
 
     ##########
 
+    def option_handler_benchmark_dbs_parser(self, option, opt_str,
+                                            value, parser):
+        """Benchmark the DBS result parsers.
+
+        Runs the DBSParserBenchmark for the (comma-separated) numbers
+        of rows given, shows the results and quits.
+
+        """
+
+        num_rows_list = []
+        for piece in value.split(","):
+            piece = piece.strip().lower()
+            multiplier = 1
+            if piece.endswith("k"):
+                multiplier = 1000
+                piece = piece[:-1]
+            elif piece.endswith("m"):
+                multiplier = 1000000
+                piece = piece[:-1]
+            try:
+                num_rows = int(piece) * multiplier
+            except ValueError:
+                msg = "Could not understand `%s' as a number of rows" % \
+                      piece
+                self.logger.fatal(msg)
+                raise Usage(msg)
+            num_rows_list.append(num_rows)
+
+        sep_line = "-" * 50
+
+        print sep_line
+        print "DBS parser benchmarks (file-level results):"
+        print sep_line
+        print "%-8s %-8s %10s %10s %12s" % \
+              ("parser", "format", "rows", "time (s)", "rows/s")
+        benchmark = DBSParserBenchmark()
+        for num_rows in num_rows_list:
+            for (parser_name, format_name, num_rows, parse_time) in \
+                    benchmark.run([num_rows]):
+                print "%-8s %-8s %10d %10.2f %12.0f" % \
+                      (parser_name, format_name, num_rows, parse_time,
+                       num_rows / max(parse_time, 1.e-6))
+                sys.stdout.flush()
+        print sep_line
+
+        # We're done, let's quit.
+        raise SystemExit
+
+        # End of option_handler_benchmark_dbs_parser.
+
+    ##########
+
     def setup_harvesting_info(self):
         """Fill our dictionary with all info needed to understand
         harvesting.
@@ -1425,6 +6106,79 @@ class CMSHarvester(object):
 
     ##########
 
+    def build_harvested_output_indices(self, dataset_names):
+        """Find out which runs of these datasets already have output.
+
+        Instead of looking into the output directory of each run
+        separately, the common output path of each dataset (see
+        create_castor_path_name_common()) is listed recursively, once.
+        See HarvestedOutputIndex. The results are kept in
+        self.harvested_outputs.
+
+        NOTE: Datasets we already know about are not looked at again.
+
+        """
+
+        dataset_names = [i for i in dataset_names \
+                         if not self.harvested_outputs.has_key(i)]
+        if len(dataset_names) < 1:
+            return
+
+        self.logger.info("Looking for existing output of %d dataset(s)..." % \
+                         len(dataset_names))
+
+        castor_paths = dict([(i, self.datasets_information[i] \
+                              ["castor_path_common"]) \
+                             for i in dataset_names])
+
+        # Only the paths that exist can be listed, of course.
+        storage = self.storage_backend()
+        try:
+            stats = storage.stat_many(set(castor_paths.values()))
+            dataset_names_to_list = [i for i in dataset_names \
+                                     if not stats[castor_paths[i]] is None]
+            pool = WorkerPool(self.storage_workers)
+            trees = pool.map(storage.list_tree,
+                             [castor_paths[i] for i in dataset_names_to_list])
+        except Error, err:
+            self.logger.fatal(err.msg)
+            raise
+        trees = dict(zip(dataset_names_to_list, trees))
+
+        for dataset_name in dataset_names:
+            index = HarvestedOutputIndex(castor_paths[dataset_name],
+                                         trees.get(dataset_name, {}))
+            self.harvested_outputs[dataset_name] = index
+            self.logger.debug("  %d run(s) of dataset `%s' " \
+                              "already have output" % \
+                              (len(index.outputs), dataset_name))
+
+        # End of build_harvested_output_indices.
+
+    ##########
+
+    def storage_backend(self):
+        """Get the storage backend for the output area.
+
+        """
+
+        if self.storage is None:
+            path = self.castor_base_dir
+            if path is None:
+                path = self.castor_base_dir_default
+            # NOTE: Within a single run we keep track of what we
+            # already know about the output area (see
+            # CachingStorageBackend).
+            self.storage = CachingStorageBackend(StorageBackend. \
+                                                 for_path(path,
+                                                          self.storage_backend_name))
+            self.logger.debug("Using %s storage backend" % self.storage.name)
+
+        # End of storage_backend.
+        return self.storage
+
+    ##########
+
     def create_and_check_castor_dirs(self):
         """Make sure all required CASTOR output dirs exist.
 
@@ -1436,10 +6190,7 @@ class CMSHarvester(object):
         self.logger.info("Checking (and if necessary creating) CASTOR " \
                          "output area(s)...")
 
-        # Call the real checker method for the base dir.
-        self.create_and_check_castor_dir(self.castor_base_dir)
-
-        # Now call the checker for all (unique) subdirs.
+        # Collect the base dir and all (unique) subdirs.
         castor_dirs = []
         for (dataset_name, runs) in self.datasets_to_use.iteritems():
 
@@ -1448,34 +6199,33 @@ class CMSHarvester(object):
                                    ["castor_path"][run])
         castor_dirs_unique = list(set(castor_dirs))
         castor_dirs_unique.sort()
-        # This can take some time. E.g. CRAFT08 has > 300 runs, each
-        # of which will get a new directory. So we show some (rough)
-        # info in between.
         ndirs = len(castor_dirs_unique)
-        step = max(ndirs / 10, 1)
-        for (i, castor_dir) in enumerate(castor_dirs_unique):
-            if (i + 1) % step == 0 or \
-                   (i + 1) == ndirs:
-                self.logger.info("  %d/%d" % \
-                                 (i + 1, ndirs))
-            self.create_and_check_castor_dir(castor_dir)
-
-            # Now check if the directory is empty. If (an old version
-            # of) the output file already exists CRAB will run new
-            # jobs but never copy the results back. We assume the user
-            # knows what they are doing and only issue a warning in
-            # case the directory is not empty.
-            self.logger.debug("Checking if path `%s' is empty" % \
-                              castor_dir)
-            cmd = "rfdir %s" % castor_dir
-            (status, output) = commands.getstatusoutput(cmd)
-            if status != 0:
+
+        # This used to take some time (e.g. CRAFT08 has > 300 runs,
+        # each of which will get a new directory), but now all
+        # directories are handled together.
+        self.create_and_check_output_dirs([self.castor_base_dir] + \
+                                          castor_dirs_unique)
+
+        # Now check if the directories are empty. If (an old version
+        # of) the output file already exists CRAB will run new jobs
+        # but never copy the results back. We assume the user knows
+        # what they are doing and only issue a warning in case the
+        # directory is not empty.
+        self.logger.debug("Checking if %d path(s) are empty" % ndirs)
+        try:
+            listings = self.storage_backend().list_many(castor_dirs_unique)
+        except Error, err:
+            self.logger.fatal(err.msg)
+            raise
+        for castor_dir in castor_dirs_unique:
+            if listings[castor_dir] is None:
                 msg = "Could not access directory `%s'" \
                       " !!! This is bad since I should have just" \
                       " created it !!!" % castor_dir
                 self.logger.fatal(msg)
                 raise Error(msg)
-            if len(output) > 0:
+            if len(listings[castor_dir]) > 0:
                 self.logger.warning("Output directory `%s' is not empty:" \
                                     " new jobs will fail to" \
                                     " copy back output" % \
@@ -1485,21 +6235,13 @@ class CMSHarvester(object):
 
     ##########
 
-    def create_and_check_castor_dir(self, castor_dir):
-        """Check existence of the give CASTOR dir, if necessary create
-        it.
-
-        Some special care has to be taken with several things like
-        setting the correct permissions such that CRAB can store the
-        output results. Of course this means that things like
-        /castor/cern.ch/ and user/j/ have to be recognised and treated
-        properly.
-
-        NOTE: Only CERN CASTOR area (/castor/cern.ch/) supported for
-        the moment.
+    def castor_dir_pieces(self, castor_dir):
+        """Find the pieces of a CASTOR path that we should look after.
 
-        NOTE: This method uses some slightly tricky caching to make
-        sure we don't keep over and over checking the same base paths.
+        Returns the list of paths leading up to (and including)
+        castor_dir, leaving out the ones we don't want to touch. Of
+        course this means that things like /castor/cern.ch/ and
+        user/j/ have to be recognised and treated properly.
 
         """
 
@@ -1515,28 +6257,6 @@ class CMSHarvester(object):
 
         ###
 
-        # Local helper function to check rfio (i.e. CASTOR)
-        # directories.
-        def extract_permissions(rfstat_output):
-            """Parse the output from rfstat and return the
-            5-digit permissions string."""
-
-            permissions_line = [i for i in output.split("\n") \
-                                if i.lower().find("protection") > -1]
-            regexp = re.compile(".*\(([0123456789]{5})\).*")
-            match = regexp.search(rfstat_output)
-            if not match or len(match.groups()) != 1:
-                msg = "Could not extract permissions " \
-                      "from output: %s" % rfstat_output
-                self.logger.fatal(msg)
-                raise Error(msg)
-            permissions = match.group(1)
-
-            # End of extract_permissions.
-            return permissions
-
-        ###
-
         # These are the pieces of CASTOR directories that we do not
         # want to touch when modifying permissions.
 
@@ -1553,156 +6273,217 @@ class CMSHarvester(object):
             -1: ["user", "store"]
             }
 
-        self.logger.debug("Checking CASTOR path `%s'" % castor_dir)
-
         ###
 
         # First we take the full CASTOR path apart.
         castor_path_pieces = split_completely(castor_dir)
 
-        # Now slowly rebuild the CASTOR path and see if a) all
-        # permissions are set correctly and b) the final destination
-        # exists.
+        # Now slowly rebuild the CASTOR path and keep all the pieces
+        # we are not supposed to skip.
         path = ""
+        paths = []
         check_sizes = castor_paths_dont_touch.keys()
         check_sizes.sort()
         len_castor_path_pieces = len(castor_path_pieces)
         for piece_index in xrange (len_castor_path_pieces):
             skip_this_path_piece = False
             piece = castor_path_pieces[piece_index]
-##            self.logger.debug("Checking CASTOR path piece `%s'" % \
-##                              piece)
             for check_size in check_sizes:
                 # Do we need to do anything with this?
                 if (piece_index + check_size) > -1:
-##                    self.logger.debug("Checking `%s' against `%s'" % \
-##                                      (castor_path_pieces[piece_index + check_size],
-##                                       castor_paths_dont_touch[check_size]))
                     if castor_path_pieces[piece_index + check_size] in castor_paths_dont_touch[check_size]:
-##                        self.logger.debug("  skipping")
                         skip_this_path_piece = True
-##                    else:
-##                        # Piece not in the list, fine.
-##                        self.logger.debug("  accepting")
             # Add piece to the path we're building.
-##            self.logger.debug("!!! Skip path piece `%s'? %s" % \
-##                              (piece, str(skip_this_path_piece)))
-##            self.logger.debug("Adding piece to path...")
             path = os.path.join(path, piece)
-##            self.logger.debug("Path is now `%s'" % \
-##                              path)
+            if not skip_this_path_piece:
+                paths.append(path)
+
+        # End of castor_dir_pieces.
+        return paths
+
+    ##########
+
+    def create_and_check_output_dirs(self, castor_dirs):
+        """Make sure all given output dirs exist and are usable.
+
+        All paths leading up to the given directories are collected
+        in a single prefix tree (see OutputDirPlanner). That way every
+        path is looked at only once, no matter how many of the
+        directories share it, and each level of the tree costs only a
+        few (parallel) calls to the storage backend.
+
+        NOTE: Paths that have been checked before are remembered (in
+        castor_path_checks_cache) and not looked at again.
 
-            # Hmmmm, only at this point can we do some caching. Not
-            # ideal, but okay.
+        """
+
+        planner = OutputDirPlanner(self.storage_backend(),
+                                   self.storage_workers)
+
+        # Make sure all directories exist and set the permissions
+        # correctly for use by CRAB. This means that:
+        # - the final output directory should (at least) have
+        #   permissions 775
+        # - all directories above that should (at least) have
+        #   permissions 755.
+
+        # BUT: Even though the above permissions are the usual ones to
+        # used when setting up CASTOR areas for grid job output, there
+        # is one caveat in case multiple people are working in the
+        # same CASTOR area. If user X creates /a/b/c/ and user Y wants
+        # to create /a/b/d/ he/she does not have sufficient rights.
+        # So: we set all dir permissions to 775 to avoid this.
+        for castor_dir in castor_dirs:
+            self.logger.debug("Checking CASTOR path `%s'" % castor_dir)
+            for path in self.castor_dir_pieces(castor_dir):
+                if not path in self.castor_path_checks_cache:
+                    planner.add(path, "775")
+
+        if len(planner.nodes) < 1:
+            self.logger.debug("  all paths checked before")
+        else:
+            self.logger.debug("Checking %d path(s) in %d level(s)" % \
+                              (len(planner.nodes), len(planner.levels())))
             try:
-                if path in self.castor_path_checks_cache:
-                    continue
-            except AttributeError:
-                # This only happens the first time around.
-                self.castor_path_checks_cache = []
-            self.castor_path_checks_cache.append(path)
-
-            # Now, unless we're supposed to skip this piece of the
-            # path, let's make sure it exists and set the permissions
-            # correctly for use by CRAB. This means that:
-            # - the final output directory should (at least) have
-            #   permissions 775
-            # - all directories above that should (at least) have
-            #   permissions 755.
-
-            # BUT: Even though the above permissions are the usual
-            # ones to used when setting up CASTOR areas for grid job
-            # output, there is one caveat in case multiple people are
-            # working in the same CASTOR area. If user X creates
-            # /a/b/c/ and user Y wants to create /a/b/d/ he/she does
-            # not have sufficient rights. So: we set all dir
-            # permissions to 775 to avoid this.
+                (num_created, num_changed) = planner.run()
+            except Error, err:
+                self.logger.fatal(err.msg)
+                raise
+            self.castor_path_checks_cache.update(planner.nodes.iterkeys())
+            self.logger.debug("  created %d path(s), changed permissions " \
+                              "of %d path(s)" % (num_created, num_changed))
 
-            if not skip_this_path_piece:
+        # End of create_and_check_output_dirs.
 
-                # Ok, first thing: let's make sure this directory
-                # exists.
-                # NOTE: The nice complication is of course that the
-                # usual os.path.isdir() etc. methods don't work for an
-                # rfio filesystem. So we call rfstat and interpret an
-                # error as meaning that the path does not exist.
-                self.logger.debug("Checking if path `%s' exists" % \
-                                  path)
-                cmd = "rfstat %s" % path
-                (status, output) = commands.getstatusoutput(cmd)
-                if status != 0:
-                    # Path does not exist, let's try and create it.
-                    self.logger.debug("Creating path `%s'" % path)
-                    cmd = "nsmkdir -m 775 %s" % path
-                    (status, output) = commands.getstatusoutput(cmd)
-                    if status != 0:
-                        msg = "Could not create directory `%s'" % path
-                        self.logger.fatal(msg)
-                        raise Error(msg)
-                    cmd = "rfstat %s" % path
-                    (status, output) = commands.getstatusoutput(cmd)
-                # Now check that it looks like a directory. If I'm not
-                # mistaken one can deduce this from the fact that the
-                # (octal) permissions string starts with `40' (instead
-                # of `100').
-                permissions = extract_permissions(output)
-                if not permissions.startswith("40"):
-                    msg = "Path `%s' is not a directory(?)" % path
-                    self.logger.fatal(msg)
-                    raise Error(msg)
+    ##########
 
-                # Figure out the current permissions for this
-                # (partial) path.
-                self.logger.debug("Checking permissions for path `%s'" % path)
-                cmd = "rfstat %s" % path
-                (status, output) = commands.getstatusoutput(cmd)
-                if status != 0:
-                    msg = "Could not obtain permissions for directory `%s'" % \
-                          path
-                    self.logger.fatal(msg)
-                    raise Error(msg)
-                # Take the last three digits of the permissions.
-                permissions = extract_permissions(output)[-3:]
-
-                # Now if necessary fix permissions.
-                # NOTE: Be careful never to `downgrade' permissions.
-                if piece_index == (len_castor_path_pieces - 1):
-                    # This means we're looking at the final
-                    # destination directory.
-                    permissions_target = "775"
-                else:
-                    # `Only' an intermediate directory.
-                    permissions_target = "775"
-
-                # Compare permissions.
-                permissions_new = []
-                for (i, j) in zip(permissions, permissions_target):
-                    permissions_new.append(str(max(int(i), int(j))))
-                permissions_new = "".join(permissions_new)
-                self.logger.debug("  current permissions: %s" % \
-                                  permissions)
-                self.logger.debug("  target permissions : %s" % \
-                                  permissions_target)
-                if permissions_new != permissions:
-                    # We have to modify the permissions.
-                    self.logger.debug("Changing permissions of `%s' " \
-                                      "to %s (were %s)" % \
-                                      (path, permissions_new, permissions))
-                    cmd = "rfchmod %s %s" % (permissions_new, path)
-                    (status, output) = commands.getstatusoutput(cmd)
-                    if status != 0:
-                        msg = "Could not change permissions for path `%s' " \
-                              "to %s" % (path, permissions_new)
-                        self.logger.fatal(msg)
-                        raise Error(msg)
+    def create_and_check_castor_dir(self, castor_dir):
+        """Check existence of the give CASTOR dir, if necessary create
+        it.
 
-                self.logger.debug("  Permissions ok (%s)" % permissions_new)
+        Some special care has to be taken with several things like
+        setting the correct permissions such that CRAB can store the
+        output results.
+
+        NOTE: This is just create_and_check_output_dirs() for a single
+        directory. When checking many directories it is a lot cheaper
+        to do them all at once.
+
+        """
+
+        self.create_and_check_output_dirs([castor_dir])
 
         # End of create_and_check_castor_dir.
 
     ##########
 
-    def pick_a_site(self, sites, cmssw_version):
+    def remember_site_version(self, se_name, cmssw_version, available):
+        "Remember whether or not a site has a given CMSSW version."
+
+        if not self.sites_and_versions_cache.has_key(se_name):
+            self.sites_and_versions_cache[se_name] = {}
+        self.sites_and_versions_cache[se_name][cmssw_version] = available
+        if not self.site_version_cache is None:
+            self.site_version_cache.put(se_name, cmssw_version, available)
+
+        # End of remember_site_version.
+
+    ##########
+
+    def load_site_version_cache(self):
+        """Load what we found out about sites and versions before.
+
+        """
+
+        self.logger.info("Loading site version cache from `%s'" % \
+                         self.site_version_cache_file_name)
+
+        cache = SiteVersionCache(self.site_version_cache_file_name,
+                                 self.site_version_cache_refresh)
+        try:
+            self.sites_and_versions_cache = cache.load()
+        except Error, err:
+            # Not fatal, we just have to ask again.
+            self.logger.warning(err.msg)
+        self.site_version_cache = cache
+
+        if self.site_version_cache_refresh:
+            self.logger.info("  refreshing all cached site information")
+        else:
+            self.logger.info("  cached site information known " \
+                             "for %d site(s)" % \
+                             len(self.sites_and_versions_cache))
+
+        # End of load_site_version_cache.
+
+    ##########
+
+    def save_site_version_cache(self):
+        """Store what we found out about sites and versions.
+
+        """
+
+        try:
+            self.site_version_cache.save()
+        except Error, err:
+            self.logger.warning(err.msg)
+
+        # End of save_site_version_cache.
+
+    ##########
+
+    def site_capability_index(self):
+        """Get the index of CMSSW versions available at the sites.
+
+        The index is loaded from the snapshot file (if there is a
+        recent one) or built from a single bulk query to the
+        information system (and then stored in the snapshot file).
+        This is only tried once. Returns None if it did not work.
+
+        """
+
+        if not self.site_index_tried:
+            self.site_index_tried = True
+            snapshot_file_name = self.site_info_snapshot_file_name
+            site_index = SiteCapabilityIndex()
+            if not snapshot_file_name is None and \
+                   site_index.load(snapshot_file_name):
+                self.logger.info("Using site information snapshot `%s'" % \
+                                 snapshot_file_name)
+                self.site_index = site_index
+            else:
+                self.logger.info("Obtaining site information " \
+                                 "for all sites")
+                try:
+                    site_index.build()
+                    self.site_index = site_index
+                except Error, err:
+                    self.logger.error(err.msg)
+                    self.logger.error("  --> checking sites one by one")
+                if not self.site_index is None and \
+                       not snapshot_file_name is None:
+                    try:
+                        site_index.save(snapshot_file_name)
+                    except Error, err:
+                        self.logger.warning(err.msg)
+            if not self.site_index is None:
+                self.logger.info("  found %d SE(s) with production CE(s)" % \
+                                 len(self.site_index.ses))
+
+        # End of site_capability_index.
+        return self.site_index
+
+    ##########
+
+    def allowed_sites(self, sites):
+        """Remove all sites we can not (or do not want to) use.
+
+        Returns the remaining sites and, separately, the ones among
+        those that are T1 sites (or the CAF).
+
+        NOTE: The list of sites is modified in place.
+
+        """
 
 	# Create list of forbidden sites
         sites_forbidden = []
@@ -1763,24 +6544,124 @@ class CMSHarvester(object):
 		sites= []
 
 	#print sites
- 
+
+        t1_sites = [i for i in sites \
+                    if (i in all_t1) or (i == "caf.cern.ch")]
+
+        # End of allowed_sites.
+        return (sites, t1_sites)
+
+    ##########
+
+    def site_has_cmssw_version(self, se_name, cmssw_version):
+        """Check if a site hosts the CMSSW version we want.
+
+        Returns True or False, or None if we could not find out.
+
+        """
+
         # Looks like we have to do some caching here, otherwise things
         # become waaaay toooo sloooooow. So that's what the
         # sites_and_versions_cache does.
+        # NOTE: Normally all site information comes from a single bulk
+        # query (see site_capability_index()). Only if that fails do
+        # we fall back to asking about each site separately.
+
+        has_version = None
+        if self.sites_and_versions_cache.has_key(se_name) and \
+               self.sites_and_versions_cache[se_name].has_key(cmssw_version):
+            has_version = self.sites_and_versions_cache[se_name][cmssw_version]
+
+        elif not self.site_capability_index() is None:
+            # All site information in one go. (The CAF does not
+            # publish its software tags, but we know it has
+            # everything.)
+            has_version = (se_name == "caf.cern.ch") or \
+                          self.site_index.has_version(se_name, cmssw_version)
+            self.remember_site_version(se_name, cmssw_version, has_version)
+
+        else:
+            self.logger.info("Checking if site `%s' " \
+                             "has CMSSW version `%s'" % \
+                             (se_name, cmssw_version))
+
+            # TODO TODO TODO
+            # Test for SCRAM architecture removed as per request
+            # from Andreas.
+            # scram_arch = os.getenv("SCRAM_ARCH")
+            # cmd = "lcg-info --list-ce " \
+            #       "--query '" \
+            #       "Tag=VO-cms-%s," \
+            #       "Tag=VO-cms-%s," \
+            #       "CEStatus=Production," \
+            #       "CloseSE=%s'" % \
+            #       (cmssw_version, scram_arch, se_name)
+            # TODO TODO TODO end
+
+            cmd = "lcg-info --list-ce " \
+                  "--query '" \
+                  "Tag=VO-cms-%s," \
+                  "CEStatus=Production," \
+                  "CloseSE=%s'" % \
+                  (cmssw_version, se_name)
+            (status, output) = commands.getstatusoutput(cmd)
+            if status != 0:
+                self.logger.error("Could not check site information " \
+                                  "for site `%s'" % se_name)
+                self.logger.debug("      (command used: `%s')" % cmd)
+            else:
+                has_version = (len(output) > 0) or (se_name == "caf.cern.ch")
+                self.remember_site_version(se_name, cmssw_version,
+                                           has_version)
+
+        # End of site_has_cmssw_version.
+        return has_version
+
+    ##########
+
+    def choose_site(self, site_names):
+        """Choose a site, preferring the ones we expect to deliver
+        first.
+
+        This is a random choice, in which (with a site history to go
+        by) each site counts according to its speed (see
+        SiteHistory.speed_factors()). Always picking the fastest site
+        would send everything to the same one.
+
+        """
+
+        speed_factors = dict([(i, 1.) for i in site_names])
+        if not self.site_history is None:
+            speed_factors = self.site_history.speed_factors(site_names)
+        pick = uniform(0., sum(speed_factors.values()))
+        for site_name in site_names:
+            pick -= speed_factors[site_name]
+            if pick <= 0.:
+                break
+        if not self.site_history is None:
+            expected_completion = self.site_history. \
+                                  expected_completion(site_name)
+            if not expected_completion is None:
+                self.logger.debug("  expecting output from `%s' " \
+                                  "after %.1f hours" % \
+                                  (site_name, expected_completion / 3600.))
+
+        # End of choose_site.
+        return site_name
+
+    ##########
+
+    def pick_a_site(self, sites, cmssw_version):
+
+        (sites, t1_sites_allowed) = self.allowed_sites(sites)
 
         # NOTE: Keep this set to None!
         site_name = None
-        cmd = None
         while len(sites) > 0 and \
               site_name is None:
 
-	    # Create list of t1_sites
-	    t1_sites = []
-	    for site in sites:
-	        if site in all_t1:
-                    t1_sites.append(site)
-	        if site == "caf.cern.ch":
-                    t1_sites.append(site)
+            # Create list of t1_sites
+            t1_sites = [i for i in t1_sites_allowed if i in sites]
 
 	    # If avilable pick preferred site
 	    #if self.preferred_site in sites:
@@ -1788,68 +6669,25 @@ class CMSHarvester(object):
             # Else, if available pick t1 site
 
             if len(t1_sites) > 0:
-                se_name = choice(t1_sites)
+                se_name = self.choose_site(t1_sites)
             # Else pick any site
             else:
-                se_name = choice(sites)
+                se_name = self.choose_site(sites)
 
             # But check that it hosts the CMSSW version we want.
-
-            if self.sites_and_versions_cache.has_key(se_name) and \
-                   self.sites_and_versions_cache[se_name].has_key(cmssw_version):
-                if self.sites_and_versions_cache[se_name][cmssw_version]:
-                    site_name = se_name
-                    break
-                else:
-                    self.logger.debug("  --> rejecting site `%s'" % se_name)
-                    sites.remove(se_name)
-
-            else:
-                self.logger.info("Checking if site `%s' " \
-                                 "has CMSSW version `%s'" % \
-                                 (se_name, cmssw_version))
-                self.sites_and_versions_cache[se_name] = {}
-
-                # TODO TODO TODO
-                # Test for SCRAM architecture removed as per request
-                # from Andreas.
-                # scram_arch = os.getenv("SCRAM_ARCH")
-                # cmd = "lcg-info --list-ce " \
-                #       "--query '" \
-                #       "Tag=VO-cms-%s," \
-                #       "Tag=VO-cms-%s," \
-                #       "CEStatus=Production," \
-                #       "CloseSE=%s'" % \
-                #       (cmssw_version, scram_arch, se_name)
-                # TODO TODO TODO end
-
-                cmd = "lcg-info --list-ce " \
-                      "--query '" \
-                      "Tag=VO-cms-%s," \
-                      "CEStatus=Production," \
-                      "CloseSE=%s'" % \
-                      (cmssw_version, se_name)
-                (status, output) = commands.getstatusoutput(cmd)
-                if status != 0:
-                    self.logger.error("Could not check site information " \
-                                      "for site `%s'" % se_name)
-                else:
-                    if (len(output) > 0) or (se_name == "caf.cern.ch"):
-                        self.sites_and_versions_cache[se_name][cmssw_version] = True
-                        site_name = se_name
-                        break
-                    else:
-                        self.sites_and_versions_cache[se_name][cmssw_version] = False
-                        self.logger.debug("  --> rejecting site `%s'" % se_name)
-                        sites.remove(se_name)
+            has_version = self.site_has_cmssw_version(se_name, cmssw_version)
+            if has_version:
+                site_name = se_name
+                break
+            elif not has_version is None:
+                self.logger.debug("  --> rejecting site `%s'" % se_name)
+                sites.remove(se_name)
 
         if site_name is self.no_matching_site_found_str:
             self.logger.error("  --> no matching site found")
             self.logger.error("    --> Your release or SCRAM " \
                               "architecture may not be available" \
                               "anywhere on the (LCG) grid.")
-            if not cmd is None:
-                self.logger.debug("      (command used: `%s')" % cmd)
         else:
             self.logger.debug("  --> selected site `%s'" % site_name)
 
@@ -2149,8 +6987,269 @@ class CMSHarvester(object):
 					      srmcms.pic.es : ES \
 					      storm-fe-cms.cr.cnaf.infn.it : IT",
                           action="callback",
-                          callback=self.option_handler_preferred_site,
-                          type="string") 
+                          callback=self.option_handler_preferred_site,
+                          type="string")
+
+        # Option to choose how to access the output area.
+        parser.add_option("", "--storage-backend",
+                          help="How to access the output area: " \
+                          "`castor', `eos', `local' or `auto' (i.e. " \
+                          "based on the path). Default: %s." % \
+                          self.storage_backend_name,
+                          action="callback",
+                          callback=self.option_handler_storage_backend,
+                          type="string",
+                          metavar="BACKEND")
+
+        parser.add_option("", "--storage-workers",
+                          help="Number of storage commands to run " \
+                          "concurrently when setting up the output " \
+                          "area. Default: %d." % \
+                          self.storage_workers,
+                          action="callback",
+                          callback=self.option_handler_storage_workers,
+                          type="int",
+                          metavar="N")
+
+        # Options to keep track of (and use) the performance of the
+        # sites.
+        parser.add_option("", "--site-history-file",
+                          help="Prefer sites that delivered fast in " \
+                          "the past, according to this file, and " \
+                          "follow the new jobs in it",
+                          action="callback",
+                          callback=self.option_handler_site_history_file,
+                          type="string",
+                          metavar="HISTORY-FILE")
+
+        parser.add_option("", "--update-site-history",
+                          help="Check on the jobs followed in this " \
+                          "site history file, update the history " \
+                          "and quit",
+                          action="callback",
+                          callback=self.option_handler_update_site_history,
+                          type="string",
+                          metavar="HISTORY-FILE")
+
+        # Options to submit runs to more than one site, and to clean
+        # up afterwards.
+        parser.add_option("", "--hedge-sites",
+                          help="Submit runs that are available at " \
+                          "several complete sites to up to this many " \
+                          "sites, keeping the first output to arrive " \
+                          "(see --hedge-budget)",
+                          action="callback",
+                          callback=self.option_handler_hedge_sites,
+                          type="int",
+                          metavar="K")
+
+        parser.add_option("", "--hedge-budget",
+                          help="Maximum total number of extra " \
+                          "submissions for hedging. Default: %d." % \
+                          self.hedge_budget,
+                          action="callback",
+                          callback=self.option_handler_hedge_budget,
+                          type="int",
+                          metavar="N")
+
+        parser.add_option("", "--hedge-manifest",
+                          help="File to list hedged runs in. " \
+                          "Default: %s." % self.hedge_manifest_file_name,
+                          action="callback",
+                          callback=self.option_handler_hedge_manifest,
+                          type="string",
+                          metavar="MANIFEST-FILE")
+
+        parser.add_option("", "--reap-hedges",
+                          help="Kill the remaining CRAB tasks of hedged " \
+                          "runs whose output has arrived, and quit",
+                          action="callback",
+                          callback=self.option_handler_reap_hedges,
+                          type="string",
+                          metavar="MANIFEST-FILE")
+
+        # Option to set the relative capacities of the sites.
+        parser.add_option("", "--site-weights",
+                          help="Relative capacities of sites, used to " \
+                          "spread the jobs over them " \
+                          "(e.g. `cmssrm.fnal.gov=2,srmcms.pic.es=0.5'). " \
+                          "Sites not listed have weight one",
+                          action="callback",
+                          callback=self.option_handler_site_weights,
+                          type="string",
+                          metavar="WEIGHTS")
+
+        # Option to set the number of concurrent DBS queries.
+        parser.add_option("", "--dbs-workers",
+                          help="Number of DBS queries to run " \
+                          "concurrently. Default: %d." % \
+                          self.dbs_workers,
+                          action="callback",
+                          callback=self.option_handler_dbs_workers,
+                          type="int",
+                          metavar="N")
+
+        # Option to set how file-level DBS queries are split up.
+        parser.add_option("", "--dbs-spread-chunk-runs",
+                          help="Split file-level DBS queries into " \
+                          "pieces of this many runs (0: don't split). " \
+                          "Default: %d." % \
+                          self.dbs_spread_chunk_runs,
+                          action="callback",
+                          callback=self.option_handler_dbs_spread_chunk_runs,
+                          type="int",
+                          metavar="N")
+
+        # Option to choose how to determine the spread of datasets.
+        parser.add_option("", "--spread-mode",
+                          help="Determine the spread of datasets over " \
+                          "sites from `file'-level or from " \
+                          "`block'-level DBS information. " \
+                          "Default: %s." % self.spread_mode,
+                          action="callback",
+                          callback=self.option_handler_spread_mode,
+                          type="string",
+                          metavar="MODE")
+
+        # Options to keep the CMSSW versions found at each site
+        # between runs.
+        parser.add_option("", "--site-version-cache",
+                          help="Keep the CMSSW versions found at each " \
+                          "site in this file (shared between " \
+                          "harvesters). Positive answers are kept for " \
+                          "%d hours, negative ones for %d hours" % \
+                          (SiteVersionCache.ttl_positive / 3600,
+                           SiteVersionCache.ttl_negative / 3600),
+                          action="callback",
+                          callback=self.option_handler_site_version_cache,
+                          type="string",
+                          metavar="CACHE-FILE")
+
+        parser.add_option("", "--site-version-cache-refresh",
+                          help="Ignore the contents of the site version " \
+                          "cache (but do update it)",
+                          action="callback",
+                          callback=self.option_handler_site_version_cache_refresh)
+
+        # Option to keep the site information between runs.
+        parser.add_option("", "--site-info-snapshot",
+                          help="Keep the (bulk) site information from " \
+                          "the grid information system in this file, " \
+                          "and reuse it for up to %d hours" % \
+                          (SiteCapabilityIndex.snapshot_max_age / 3600),
+                          action="callback",
+                          callback=self.option_handler_site_info_snapshot,
+                          type="string",
+                          metavar="SNAPSHOT-FILE")
+
+        # Option to remember the spread of datasets between runs.
+        parser.add_option("", "--spread-cache-file",
+                          help="Keep the spread of datasets over sites " \
+                          "in this file, and only look again at runs " \
+                          "that changed since last time",
+                          action="callback",
+                          callback=self.option_handler_spread_cache_file,
+                          type="string",
+                          metavar="CACHE-FILE")
+
+        # Option to set the number of retries for failing DBS
+        # queries.
+        parser.add_option("", "--dbs-retries",
+                          help="Number of times to retry a failing " \
+                          "DBS query. Default: %d." % \
+                          self.dbs_retries,
+                          action="callback",
+                          callback=self.option_handler_dbs_retries,
+                          type="int",
+                          metavar="N")
+
+        # Option to cache DBS query results on disk between runs.
+        parser.add_option("", "--dbs-cache-dir",
+                          help="Directory in which to cache DBS " \
+                          "query results between runs",
+                          action="callback",
+                          callback=self.option_handler_dbs_cache_dir,
+                          type="string",
+                          metavar="DBS-CACHE-DIR")
+
+        # Option to ignore whatever is in the DBS cache.
+        parser.add_option("", "--dbs-cache-refresh",
+                          help="Ignore cached DBS query results " \
+                          "(but store the new ones)",
+                          action="callback",
+                          callback=self.option_handler_dbs_cache_refresh)
+
+        # Option to talk to a different DBS server.
+        parser.add_option("", "--dbs-url",
+                          help="URL of the DBS server to use. " \
+                          "Default: the global production DBS.",
+                          action="callback",
+                          callback=self.option_handler_dbs_url,
+                          type="string",
+                          metavar="DBS-URL")
+
+        # Option to write the DBS telemetry to a file.
+        parser.add_option("", "--dbs-telemetry-file",
+                          help="Write timing (and other) information " \
+                          "on all DBS queries to this (JSON) file",
+                          action="callback",
+                          callback=self.option_handler_dbs_telemetry_file,
+                          type="string",
+                          metavar="TELEMETRY-FILE")
+
+        # Option to record all DBS queries and responses.
+        parser.add_option("", "--dbs-record-dir",
+                          help="Record all DBS queries and responses " \
+                          "as fixtures in this directory",
+                          action="callback",
+                          callback=self.option_handler_dbs_record_dir,
+                          type="string",
+                          metavar="FIXTURE-DIR")
+
+        # Options to use a local stand-in for DBS.
+        parser.add_option("", "--dbs-replay",
+                          help="Use a local stand-in for DBS serving " \
+                          "the fixtures in this directory (and " \
+                          "synthetic results for anything else)",
+                          action="callback",
+                          callback=self.option_handler_dbs_replay,
+                          type="string",
+                          metavar="FIXTURE-DIR")
+
+        parser.add_option("", "--dbs-replay-format",
+                          help="DBS XML format (old/new) to be used " \
+                          "by the local DBS stand-in. Default: new.",
+                          action="callback",
+                          callback=self.option_handler_dbs_replay_format,
+                          type="string",
+                          metavar="FORMAT")
+
+        parser.add_option("", "--dbs-replay-latency",
+                          help="Time (in seconds) each request to the " \
+                          "local DBS stand-in takes",
+                          action="callback",
+                          callback=self.option_handler_dbs_replay_latency,
+                          type="float",
+                          metavar="SECONDS")
+
+        parser.add_option("", "--dbs-replay-failure-rate",
+                          help="Fraction of requests the local DBS " \
+                          "stand-in fails",
+                          action="callback",
+                          callback=self.option_handler_dbs_replay_failure_rate,
+                          type="float",
+                          metavar="FRACTION")
+
+        # Option to only look at datasets and runs that are new
+        # since the last time we ran.
+        parser.add_option("", "--incremental-state-file",
+                          help="Only consider datasets and runs newer " \
+                          "than the ones recorded in this file (and " \
+                          "update it afterwards)",
+                          action="callback",
+                          callback=self.option_handler_incremental_state_file,
+                          type="string",
+                          metavar="STATE-FILE")
 
         # This is the command line flag to list all harvesting
         # type-to-sequence mappings.
@@ -2160,6 +7259,16 @@ class CMSHarvester(object):
                           action="callback",
                           callback=self.option_handler_list_types)
 
+        # This runs the DBS parser benchmarks.
+        parser.add_option("", "--benchmark-dbs-parser",
+                          help="Benchmark the DBS result parsers on " \
+                          "synthetic results with these numbers of " \
+                          "rows (e.g. `10k,1M,10M') and quit",
+                          action="callback",
+                          callback=self.option_handler_benchmark_dbs_parser,
+                          type="string",
+                          metavar="ROWS")
+
         # If nothing was specified: tell the user how to do things the
         # next time and exit.
         # NOTE: We just use the OptParse standard way of doing this by
@@ -2272,6 +7381,9 @@ class CMSHarvester(object):
             #raise Usage(msg)
 
         # Only the CERN CASTOR area is supported.
+        # NOTE: This holds independent of the storage backend used to
+        # set up the output area: the CRAB stage-out settings written
+        # by create_multicrab_config() are CASTOR-specific.
         if not self.castor_base_dir.startswith(self.castor_prefix):
             msg = "CASTOR area does not start with `%s'" % \
                   self.castor_prefix
@@ -2397,10 +7509,36 @@ class CMSHarvester(object):
 
         """
 
+        if not self.dbs_replay_dir is None:
+            if not self.dbs_url is None:
+                self.logger.warning("Using local DBS stand-in " \
+                                    "--> ignoring `--dbs-url'")
+            self.dbs_replay_server = DBSReplayServer(self.dbs_replay_dir,
+                                                     self.dbs_replay_old_format,
+                                                     self.dbs_replay_latency,
+                                                     self.dbs_replay_failure_rate)
+            self.dbs_replay_server.start()
+            self.dbs_url = self.dbs_replay_server.url
+            self.logger.info("Local DBS stand-in running at `%s'" % \
+                             self.dbs_url)
+
+        if not self.dbs_record_dir is None:
+            if not os.path.isdir(self.dbs_record_dir):
+                try:
+                    os.makedirs(self.dbs_record_dir)
+                except OSError:
+                    msg = "ERROR: Could not create DBS record " \
+                          "directory `%s'" % self.dbs_record_dir
+                    self.logger.fatal(msg)
+                    raise Error(msg)
+
         try:
             args={}
-            args["url"]= "http://cmsdbsprod.cern.ch/cms_dbs_prod_global/" \
-                         "servlet/DBSServlet"
+            if self.dbs_url is None:
+                args["url"]= "http://cmsdbsprod.cern.ch/cms_dbs_prod_global/" \
+                             "servlet/DBSServlet"
+            else:
+                args["url"] = self.dbs_url
             api = DbsApi(args)
             self.dbs_api = api
 
@@ -2411,10 +7549,284 @@ class CMSHarvester(object):
                 logger.debug("DBS exception error code: ", ex.getErrorCode())
             raise
 
+        try:
+            api_version = api.getApiVersion()
+        except AttributeError:
+            api_version = None
+
+        # All queries go through this client. It hands out API
+        # instances to our worker threads (starting with the one we
+        # just created) and retries queries that fail.
+        self.dbs_client = DBSClient(lambda: DbsApi(args),
+                                    self.dbs_workers,
+                                    self.dbs_retries,
+                                    (DBSAPI.dbsApiException.DbsApiException,
+                                     socket.error,
+                                     httplib.HTTPException),
+                                    (DBSAPI.dbsApiException.DbsBadRequest,),
+                                    api,
+                                    self.logger,
+                                    args["url"],
+                                    api_version)
+
+        if not self.dbs_cache_dir is None:
+            try:
+                self.dbs_cache = DBSQueryCache(self.dbs_cache_dir,
+                                               self.dbs_cache_refresh)
+            except Error, err:
+                self.logger.fatal(err.msg)
+                raise
+            if self.dbs_cache_refresh:
+                self.logger.info("Refreshing DBS cache in `%s'" % \
+                                 self.dbs_cache_dir)
+        elif self.dbs_cache_refresh:
+            self.logger.warning("No DBS cache directory specified " \
+                                "--> ignoring `--dbs-cache-refresh'")
+
         # End of setup_dbs.
 
     ##########
 
+    def dbs_execute_query(self, dbs_query, query_info=None):
+        """Send a query to DBS and return the raw XML result.
+
+        This is the single place through which all our DBS queries
+        go. If a DBS cache is in use, the cache is checked first and
+        any new results are stored in it. Transient DBS failures are
+        retried by the DBS client.
+
+        If a query_info dictionary is given, the source of the result
+        (`cache' or `dbs') and the time it took to get it are stored
+        in it.
+
+        """
+
+        time_start = time.time()
+        if query_info is None:
+            query_info = {}
+
+        if not self.dbs_cache is None:
+            api_result = self.dbs_cache.get(dbs_query)
+            if not api_result is None:
+                self.logger.debug("Using cached DBS result for `%s'" % \
+                                  dbs_query)
+                # NOTE: When recording, the fixtures should cover all
+                # queries, not just the ones we did not have yet.
+                self.dbs_record_result(dbs_query, api_result)
+                query_info["source"] = "cache"
+                query_info["latency"] = time.time() - time_start
+                return api_result
+
+        try:
+            api_result = self.dbs_client.execute(dbs_query)
+        except Error, err:
+            msg = "ERROR: Could not execute DBS query"
+            self.logger.fatal(msg)
+            self.logger.fatal("  %s" % err.msg)
+            raise Error(msg)
+
+        if not self.dbs_cache is None:
+            self.dbs_cache.put(dbs_query, api_result)
+
+        self.dbs_record_result(dbs_query, api_result)
+
+        query_info["source"] = "dbs"
+        query_info["latency"] = time.time() - time_start
+
+        # End of dbs_execute_query.
+        return api_result
+
+    ##########
+
+    def dbs_record_result(self, dbs_query, api_result):
+        """If asked to, keep the result of this query as fixture for
+        the DBS stand-in (see DBSReplayServer).
+
+        NOTE: Failing to do so is not fatal.
+
+        """
+
+        if self.dbs_record_dir is None:
+            return
+
+        try:
+            DBSReplayServer.write_fixture(self.dbs_record_dir,
+                                          dbs_query, api_result)
+        except Error, err:
+            self.logger.warning(err.msg)
+
+        # End of dbs_record_result.
+
+    ##########
+
+    def dbs_query_results(self, dbs_query, tag_names):
+        """Send a query to DBS and parse the results.
+
+        Returns the results dictionary of the DBSXMLHandler used to
+        parse the DBS output: tag name -> list of values.
+
+        NOTE: Each query is only sent and parsed once per run. All
+        callers asking the same query, also concurrently, share the
+        same results dictionary, so don't modify it.
+
+        """
+
+        key = (" ".join(dbs_query.split()), tuple(tag_names))
+        results = self.dbs_single_flight.do(key,
+                                            self.dbs_fetch_query_results,
+                                            dbs_query, tag_names)
+
+        # End of dbs_query_results.
+        return results
+
+    ##########
+
+    def dbs_fetch_query_results(self, dbs_query, tag_names):
+        """Send a query to DBS and parse the results.
+
+        This is where dbs_query_results() does the actual work.
+
+        """
+
+        query_info = {}
+        api_result = self.dbs_execute_query(dbs_query, query_info)
+
+        time_start = time.time()
+        handler = DBSFastParser(tag_names)
+        try:
+            handler.feed(api_result)
+            handler.close()
+        except ExpatError:
+            msg = "ERROR: Could not parse DBS server output"
+            self.logger.fatal(msg)
+            raise Error(msg)
+        parse_time = time.time() - time_start
+
+        # DEBUG DEBUG DEBUG
+        assert(handler.check_results_validity()), "ERROR The DBSXMLHandler screwed something up!"
+        # DEBUG DEBUG DEBUG end
+
+        self.dbs_telemetry.record(dbs_query, query_info["source"],
+                                  query_info["latency"], len(api_result),
+                                  parse_time, handler.num_rows())
+
+        # End of dbs_fetch_query_results.
+        return handler.results
+
+    ##########
+
+    def dbs_stream_query_rows(self, dbs_query, tag_names, row_callback):
+        """Send a query to DBS and hand each result row to row_callback.
+
+        This is meant for queries with huge results (e.g. file-level
+        ones). The DBS output is parsed while it is coming in and
+        each row is handed over as soon as it has been parsed, so
+        neither the raw nor the parsed results are ever held in
+        memory completely.
+
+        NOTE: Streamed queries are not shared with other callers, and
+        when a DBS cache is in use (or when recording DBS fixtures) we
+        go through dbs_execute_query() instead of streaming.
+
+        """
+
+        # Keep track of the costs of all this.
+        num_rows = [0]
+        num_bytes = [0]
+        parse_time = [0.]
+        def count_row(row):
+            num_rows[0] += 1
+            row_callback(row)
+        def feed(data):
+            num_bytes[0] += len(data)
+            time_start = time.time()
+            handler.feed(data)
+            parse_time[0] += time.time() - time_start
+
+        handler = DBSFastParser(tag_names, count_row)
+
+        time_start = time.time()
+        try:
+            streamed = False
+            if self.dbs_cache is None and self.dbs_record_dir is None:
+                try:
+                    streamed = self.dbs_client.stream(dbs_query, feed)
+                except Error, err:
+                    self.logger.fatal(err.msg)
+                    raise
+            if streamed:
+                source = "stream"
+                latency = time.time() - time_start - parse_time[0]
+            else:
+                query_info = {}
+                api_result = self.dbs_execute_query(dbs_query, query_info)
+                source = query_info["source"]
+                latency = query_info["latency"]
+                feed(api_result)
+            handler.close()
+        except ExpatError:
+            msg = "ERROR: Could not parse DBS server output"
+            self.logger.fatal(msg)
+            raise Error(msg)
+
+        # DEBUG DEBUG DEBUG
+        assert(handler.check_results_validity()), "ERROR The DBSXMLHandler screwed something up!"
+        # DEBUG DEBUG DEBUG end
+
+        self.dbs_telemetry.record(dbs_query, source, latency, num_bytes[0],
+                                  parse_time[0], num_rows[0])
+
+        # End of dbs_stream_query_rows.
+
+    ##########
+
+    def dbs_resolve_datasets_metadata(self, dataset_names, query_plans,
+                                      query_results):
+        """Extract runs, CMSSW version, data type and GlobalTag.
+
+        This turns the results of the combined queries planned by the
+        DBSQueryPlanner into the same values the individual
+        dbs_resolve_xxx() methods return. Returns a dictionary mapping
+        each dataset name to a dictionary with the keys `runs',
+        `cmssw_version', `datatype' and (if we asked for it)
+        `globaltag'.
+
+        NOTE: If DBS did not return anything for a given dataset, it
+        is left out here. The caller should fall back to the
+        individual queries for those.
+
+        """
+
+        planner = DBSQueryPlanner()
+        per_dataset = planner.split(query_plans, query_results)
+
+        metadata = {}
+        for dataset_name in dataset_names:
+            if not per_dataset.has_key(dataset_name):
+                continue
+            info = per_dataset[dataset_name]
+            metadata[dataset_name] = {}
+
+            runs = list(set(info["run"]))
+            runs.sort()
+            metadata[dataset_name]["runs"] = runs
+
+            for (key, tag_name) in [("cmssw_version", "algo.version"),
+                                    ("datatype", "datatype.type"),
+                                    ("globaltag", "dataset.tag")]:
+                if not info.has_key(tag_name):
+                    continue
+                values = list(set(info[tag_name]))
+                # DEBUG DEBUG DEBUG
+                assert len(values) == 1
+                # DEBUG DEBUG DEBUG end
+                metadata[dataset_name][key] = values[0]
+
+        # End of dbs_resolve_datasets_metadata.
+        return metadata
+
+    ##########
+
     def dbs_resolve_dataset_name(self, dataset_name):
         """Use DBS to resolve a wildcarded dataset name.
 
@@ -2435,42 +7847,229 @@ class CMSHarvester(object):
 
         #----------
 
-        api = self.dbs_api
         dbs_query = "find dataset where dataset like %s " \
                     "and dataset.status = VALID" % \
                     dataset_name
-        try:
-            api_result = api.executeQuery(dbs_query)
-        except DBSAPI.dbsApiException.DbsApiException:
-            msg = "ERROR: Could not execute DBS query"
-            self.logger.fatal(msg)
-            raise Error(msg)
+        results = self.dbs_query_results(dbs_query, ["dataset"])
 
-        # Setup parsing.
-        handler = DBSXMLHandler(["dataset"])
-        parser = xml.sax.make_parser()
-        parser.setContentHandler(handler)
+        # Extract the results.
+        # NOTE: These results are shared, so make a copy.
+        datasets = list(results["dataset"])
 
-        # Parse.
-        try:
-            xml.sax.parseString(api_result, handler)
-        except SAXParseException:
-            msg = "ERROR: Could not parse DBS server output"
-            self.logger.fatal(msg)
-            raise Error(msg)
+        # Remember this for later use by the DBS query planner.
+        self.dataset_patterns[dataset_name] = datasets
+
+        # End of dbs_resolve_dataset_name.
+        return datasets
+
+    ##########
+
+    def dbs_resolve_dataset_name_incremental(self, dataset_name):
+        """Use DBS to resolve a wildcarded dataset name, but only
+        return datasets that are new or contain new runs.
+
+        `New' is with respect to the high-water marks in our
+        incremental state: datasets created after the creation date
+        mark and runs after the last run we saw for each dataset.
+
+        """
 
         # DEBUG DEBUG DEBUG
-        assert(handler.check_results_validity()), "ERROR The DBSXMLHandler screwed something up!"
+        assert not self.incremental_state is None
         # DEBUG DEBUG DEBUG end
 
-        # Extract the results.
-        datasets = handler.results.values()[0]
+        state = self.incremental_state
 
-        # End of dbs_resolve_dataset_name.
+        if dataset_name.find("*") > -1:
+            operator = "like"
+        else:
+            operator = "="
+
+        # First the datasets created since last time.
+        dbs_query = "find dataset, dataset.createdate " \
+                    "where dataset %s %s " \
+                    "and dataset.status = VALID" % \
+                    (operator, dataset_name)
+        if not state.createdate_mark is None:
+            try:
+                createdate_mark = long(float(state.createdate_mark))
+            except ValueError:
+                msg = "Invalid dataset creation date mark `%s'" % \
+                      state.createdate_mark
+                self.logger.fatal(msg)
+                raise Error(msg)
+            dbs_query += " and dataset.createdate > %d" % createdate_mark
+        results = self.dbs_query_results(dbs_query,
+                                         ["dataset", "dataset.createdate"])
+        datasets_new = list(results.get("dataset", []))
+        for (dataset, createdate) in \
+                zip(datasets_new, results.get("dataset.createdate", [])):
+            self.dataset_createdates[dataset] = createdate
+
+        # Then the new runs in datasets we already know about. One
+        # query for all of them, starting from the oldest mark.
+        run_marks = dict([(i, j) for (i, j) in state.last_runs.items() \
+                          if self.dataset_spec_covers(dataset_name, i)])
+        datasets_new_runs = []
+        if len(run_marks) > 0:
+            dbs_query = "find dataset, run " \
+                        "where dataset %s %s " \
+                        "and dataset.status = VALID " \
+                        "and run > %d" % \
+                        (operator, dataset_name, min(run_marks.values()))
+            results = self.dbs_query_results(dbs_query, ["dataset", "run"])
+            for (dataset, run) in zip(results.get("dataset", []),
+                                      results.get("run", [])):
+                if run_marks.has_key(dataset) and \
+                       run > run_marks[dataset]:
+                    datasets_new_runs.append(dataset)
+
+        datasets = list(set(datasets_new + datasets_new_runs))
+        self.logger.info("  `%s': %d new dataset(s), " \
+                         "%d dataset(s) with new runs" % \
+                         (dataset_name, len(set(datasets_new)),
+                          len(set(datasets_new_runs))))
+
+        # End of dbs_resolve_dataset_name_incremental.
         return datasets
 
     ##########
 
+    def incremental_run_mark(self, dataset_name):
+        """Return the last run we already saw for this dataset.
+
+        Returns None if we are not running incrementally or if we
+        never saw this dataset before.
+
+        """
+
+        run_mark = None
+        if not self.incremental_state is None:
+            run_mark = self.incremental_state.last_runs.get(dataset_name,
+                                                            None)
+
+        # End of incremental_run_mark.
+        return run_mark
+
+    ##########
+
+    def load_incremental_state(self):
+        """Load the high-water marks for incremental running.
+
+        """
+
+        self.logger.info("Loading incremental state from `%s'" % \
+                         self.incremental_state_file_name)
+
+        state = IncrementalState(self.incremental_state_file_name)
+        try:
+            state.load()
+        except Error, err:
+            self.logger.fatal(err.msg)
+            raise
+        self.incremental_state = state
+
+        if state.createdate_mark is None:
+            self.logger.info("  no previous state found " \
+                             "--> considering everything")
+        else:
+            self.logger.info("  dataset creation date mark: %s" % \
+                             state.createdate_mark)
+            self.logger.info("  run marks known for %d dataset(s)" % \
+                             len(state.last_runs))
+
+        # End of load_incremental_state.
+
+    ##########
+
+    def load_spread_cache(self):
+        """Load the spread of datasets found last time.
+
+        """
+
+        self.logger.info("Loading spread cache from `%s'" % \
+                         self.spread_cache_file_name)
+
+        cache = SpreadCatalogCache(self.spread_cache_file_name)
+        try:
+            cache.load()
+        except Error, err:
+            self.logger.fatal(err.msg)
+            raise
+        self.spread_cache = cache
+
+        self.logger.info("  cached spread known for %d dataset(s)" % \
+                         len(cache.datasets))
+
+        # End of load_spread_cache.
+
+    ##########
+
+    def save_spread_cache(self):
+        """Save the spread of datasets for next time.
+
+        NOTE: Failing to do so is not fatal, we just have to look
+        again next time.
+
+        """
+
+        self.logger.info("Saving spread cache to `%s'" % \
+                         self.spread_cache.file_name)
+        try:
+            self.spread_cache.save()
+        except Error, err:
+            self.logger.warning(err.msg)
+
+        # End of save_spread_cache.
+
+    ##########
+
+    def update_incremental_state(self):
+        """Move the high-water marks past everything seen this time.
+
+        Only datasets that made it through all our checks (i.e. into
+        datasets_to_use) count. Datasets that were dropped (e.g. by
+        the ignore list) should be found again next time, so the
+        creation date mark stays below the earliest of those.
+
+        NOTE: Runs of the datasets we used are considered `seen' once
+        DBS told us about them, independent of whether or not they
+        passed all our checks. To re-consider older runs just remove
+        (or edit) the state file.
+
+        """
+
+        state = self.incremental_state
+
+        createdates_used = []
+        createdates_dropped = []
+        for (dataset_name, createdate) in self.dataset_createdates.items():
+            if self.datasets_to_use.has_key(dataset_name):
+                createdates_used.append(createdate)
+            else:
+                createdates_dropped.append(createdate)
+        if len(createdates_dropped) > 0:
+            createdate_limit = min([state.createdate_key(i) \
+                                    for i in createdates_dropped])
+            createdates_used = [i for i in createdates_used \
+                                if state.createdate_key(i) < createdate_limit]
+        state.update_createdate_mark(createdates_used)
+        for (dataset_name, info) in self.datasets_information.items():
+            if self.datasets_to_use.has_key(dataset_name):
+                state.update_last_run(dataset_name, info["runs"])
+
+        self.logger.info("Saving incremental state to `%s'" % \
+                         state.file_name)
+        try:
+            state.save()
+        except Error, err:
+            self.logger.fatal(err.msg)
+            raise
+
+        # End of update_incremental_state.
+
+    ##########
+
     def dbs_resolve_cmssw_version(self, dataset_name):
         """Ask DBS for the CMSSW version used to create this dataset.
 
@@ -2481,33 +8080,12 @@ class CMSHarvester(object):
         assert not self.dbs_api is None
         # DEBUG DEBUG DEBUG end
 
-        api = self.dbs_api
         dbs_query = "find algo.version where dataset = %s " \
                     "and dataset.status = VALID" % \
                     dataset_name
-        try:
-            api_result = api.executeQuery(dbs_query)
-        except DBSAPI.dbsApiException.DbsApiException:
-            msg = "ERROR: Could not execute DBS query"
-            self.logger.fatal(msg)
-            raise Error(msg)
-
-        handler = DBSXMLHandler(["algo.version"])
-        parser = xml.sax.make_parser()
-        parser.setContentHandler(handler)
-
-        try:
-            xml.sax.parseString(api_result, handler)
-        except SAXParseException:
-            msg = "ERROR: Could not parse DBS server output"
-            self.logger.fatal(msg)
-            raise Error(msg)
-
-        # DEBUG DEBUG DEBUG
-        assert(handler.check_results_validity()), "ERROR The DBSXMLHandler screwed something up!"
-        # DEBUG DEBUG DEBUG end
+        results = self.dbs_query_results(dbs_query, ["algo.version"])
 
-        cmssw_version = handler.results.values()[0]
+        cmssw_version = results["algo.version"]
 
         # DEBUG DEBUG DEBUG
         assert len(cmssw_version) == 1
@@ -2568,6 +8146,9 @@ class CMSHarvester(object):
     def dbs_resolve_runs(self, dataset_name):
         """Ask DBS for the list of runs in a given dataset.
 
+        When running incrementally only the runs after the run mark of
+        the dataset are returned (see incremental_run_mark()).
+
         # NOTE: This does not (yet?) skip/remove empty runs. There is
         # a bug in the DBS entry run.numevents (i.e. it always returns
         # zero) which should be fixed in the `next DBS release'.
@@ -2587,35 +8168,15 @@ class CMSHarvester(object):
         assert not self.dbs_api is None
         # DEBUG DEBUG DEBUG end
 
-        api = self.dbs_api
         dbs_query = "find run where dataset = %s " \
                     "and dataset.status = VALID" % \
                     dataset_name
-        try:
-            api_result = api.executeQuery(dbs_query)
-        except DBSAPI.dbsApiException.DbsApiException:
-            msg = "ERROR: Could not execute DBS query"
-            self.logger.fatal(msg)
-            raise Error(msg)
-
-        handler = DBSXMLHandler(["run"])
-        parser = xml.sax.make_parser()
-        parser.setContentHandler(handler)
-
-        try:
-            xml.sax.parseString(api_result, handler)
-        except SAXParseException:
-            msg = "ERROR: Could not parse DBS server output"
-            self.logger.fatal(msg)
-            raise Error(msg)
-
-        # DEBUG DEBUG DEBUG
-        assert(handler.check_results_validity()), "ERROR The DBSXMLHandler screwed something up!"
-        # DEBUG DEBUG DEBUG end
+        run_mark = self.incremental_run_mark(dataset_name)
+        if not run_mark is None:
+            dbs_query += " and run > %d" % run_mark
+        results = self.dbs_query_results(dbs_query, ["run"])
 
-        runs = handler.results.values()[0]
-        # Turn strings into integers.
-        runs = [int(i) for i in runs]
+        runs = list(results.get("run", []))
         runs.sort()
 
         # End of dbs_resolve_runs.
@@ -2640,33 +8201,12 @@ class CMSHarvester(object):
         assert not self.dbs_api is None
         # DEBUG DEBUG DEBUG end
 
-        api = self.dbs_api
         dbs_query = "find dataset.tag where dataset = %s " \
                     "and dataset.status = VALID" % \
                     dataset_name
-        try:
-            api_result = api.executeQuery(dbs_query)
-        except DBSAPI.dbsApiException.DbsApiException:
-            msg = "ERROR: Could not execute DBS query"
-            self.logger.fatal(msg)
-            raise Error(msg)
-
-        handler = DBSXMLHandler(["dataset.tag"])
-        parser = xml.sax.make_parser()
-        parser.setContentHandler(parser)
-
-        try:
-            xml.sax.parseString(api_result, handler)
-        except SAXParseException:
-            msg = "ERROR: Could not parse DBS server output"
-            self.logger.fatal(msg)
-            raise Error(msg)
-
-        # DEBUG DEBUG DEBUG
-        assert(handler.check_results_validity()), "ERROR The DBSXMLHandler screwed something up!"
-        # DEBUG DEBUG DEBUG end
+        results = self.dbs_query_results(dbs_query, ["dataset.tag"])
 
-        globaltag = handler.results.values()[0]
+        globaltag = results["dataset.tag"]
 
         # DEBUG DEBUG DEBUG
         assert len(globaltag) == 1
@@ -2690,33 +8230,12 @@ class CMSHarvester(object):
         assert not self.dbs_api is None
         # DEBUG DEBUG DEBUG end
 
-        api = self.dbs_api
         dbs_query = "find datatype.type where dataset = %s " \
                     "and dataset.status = VALID" % \
-                    dataset_name
-        try:
-            api_result = api.executeQuery(dbs_query)
-        except DBSAPI.dbsApiException.DbsApiException:
-            msg = "ERROR: Could not execute DBS query"
-            self.logger.fatal(msg)
-            raise Error(msg)
-
-        handler = DBSXMLHandler(["datatype.type"])
-        parser = xml.sax.make_parser()
-        parser.setContentHandler(handler)
-
-        try:
-            xml.sax.parseString(api_result, handler)
-        except SAXParseException:
-            msg = "ERROR: Could not parse DBS server output"
-            self.logger.fatal(msg)
-            raise Error(msg)
-
-        # DEBUG DEBUG DEBUG
-        assert(handler.check_results_validity()), "ERROR The DBSXMLHandler screwed something up!"
-        # DEBUG DEBUG DEBUG end
+                    dataset_name
+        results = self.dbs_query_results(dbs_query, ["datatype.type"])
 
-        datatype = handler.results.values()[0]
+        datatype = results["datatype.type"]
 
         # DEBUG DEBUG DEBUG
         assert len(datatype) == 1
@@ -2752,35 +8271,14 @@ class CMSHarvester(object):
         assert not self.dbs_api is None
         # DEBUG DEBUG DEBUG end
 
-        api = self.dbs_api
         dbs_query = "find file.name, file.numevents where dataset = %s " \
                     "and dataset.status = VALID" % \
                     dataset_name
         if not run_number is None:
             dbs_query = dbq_query + (" and run = %d" % run_number)
-        try:
-            api_result = api.executeQuery(dbs_query)
-        except DBSAPI.dbsApiException.DbsApiException:
-            msg = "ERROR: Could not execute DBS query"
-            self.logger.fatal(msg)
-            raise Error(msg)
-
-        handler = DBSXMLHandler(["file.name", "file.numevents"])
-        parser = xml.sax.make_parser()
-        parser.setContentHandler(handler)
-
-        try:
-            xml.sax.parseString(api_result, handler)
-        except SAXParseException:
-            msg = "ERROR: Could not parse DBS server output"
-            self.logger.fatal(msg)
-            raise Error(msg)
-
-        # DEBUG DEBUG DEBUG
-        assert(handler.check_results_validity()), "ERROR The DBSXMLHandler screwed something up!"
-        # DEBUG DEBUG DEBUG end
+        results = self.dbs_query_results(dbs_query, ["file.name", "file.numevents"])
 
-        num_events = sum(handler.results["file.numevents"])
+        num_events = sum(results["file.numevents"])
 
         # End of dbs_resolve_number_of_events.
         return num_events
@@ -3073,93 +8571,77 @@ class CMSHarvester(object):
 
     ##########
 
-    def dbs_check_dataset_spread(self, dataset_name):
-        """Figure out the number of events in each run of this dataset.
-
-        This is a more efficient way of doing this than calling
-        dbs_resolve_number_of_events for each run.
+    def dbs_spread_queries(self, dataset_name, runs=None,
+                           runs_selected=None):
+        """Build the DBS queries for the spread of this dataset.
+
+        If the runs of the dataset are given, and there are more than
+        dbs_spread_chunk_runs of them, the query is split by run range
+        into pieces of (at most) that many runs. The first and last
+        pieces are open-ended, so together the pieces cover all runs,
+        including ones that may have appeared in DBS since we asked
+        for the list of runs.
+
+        NOTE: Without the runs there is no splitting. Asking DBS for
+        the runs just for this would cost more than it saves. (The
+        usual callers know the runs from the combined queries, see
+        build_datasets_information().)
+
+        NOTE: The pieces are sent in parallel only if we are not
+        running in a worker already (see WorkerPool). Since the
+        spread of all datasets is looked at in parallel, this normally
+        means the pieces for one dataset go one after the other. The
+        point of the splitting is to keep each single query (and the
+        memory needed for its results) small.
+
+        If only some of the runs are needed (runs_selected), the
+        pieces only cover those. In that case the runs of the dataset
+        have to be given as well.
 
         """
 
-        self.logger.debug("Checking spread of dataset `%s'" % dataset_name)
-
-        # DEBUG DEBUG DEBUG
-        # If we get here DBS should have been set up already.
-        assert not self.dbs_api is None
-        # DEBUG DEBUG DEBUG end
-
-        api = self.dbs_api
         dbs_query = "find run.number, site, file.name, file.numevents " \
                     "where dataset = %s " \
                     "and dataset.status = VALID" % \
                     dataset_name
-        try:
-            api_result = api.executeQuery(dbs_query)
-        except DBSAPI.dbsApiException.DbsApiException:
-            msg = "ERROR: Could not execute DBS query"
-            self.logger.fatal(msg)
-            raise Error(msg)
+        run_mark = self.incremental_run_mark(dataset_name)
+        if not run_mark is None:
+            dbs_query += " and run > %d" % run_mark
+
+        dbs_queries = [dbs_query]
+        chunk_size = self.dbs_spread_chunk_runs
+        if not runs is None and \
+               (chunk_size > 0 or not runs_selected is None):
+            runs = list(runs)
+            runs.sort()
+            if runs_selected is None:
+                runs_selected = runs
+            if len(runs) > 0:
+                dbs_queries = [dbs_query + i for i in \
+                               DBSQueryPlanner.run_ranges(runs,
+                                                          set(runs_selected),
+                                                          chunk_size)]
 
-        handler = DBSXMLHandler(["run.number", "site", "file.name", "file.numevents"])
-        parser = xml.sax.make_parser()
-        parser.setContentHandler(handler)
+        # End of dbs_spread_queries.
+        return dbs_queries
 
-        try:
-            # OBSOLETE OBSOLETE OBSOLETE
-##            class Handler(xml.sax.handler.ContentHandler):
-##                def startElement(self, name, attrs):
-##                    if name == "result":
-##                        site_name = str(attrs["STORAGEELEMENT_SENAME"])
-##                        # TODO TODO TODO
-##                        # Ugly hack to get around cases like this:
-##                        #   $ dbs search --query="find dataset, site, file.count where dataset=/RelValQCD_Pt_3000_3500/CMSSW_3_3_0_pre1-STARTUP31X_V4-v1/GEN-SIM-RECO"
-##                        #   Using DBS instance at: http://cmsdbsprod.cern.ch/cms_dbs_prod_global/servlet/DBSServlet
-##                        #   Processing ... \
-##                        #   PATH    STORAGEELEMENT_SENAME   COUNT_FILES
-##                        #   _________________________________________________________________________________
-##                        #   /RelValQCD_Pt_3000_3500/CMSSW_3_3_0_pre1-STARTUP31X_V4-v1/GEN-SIM-RECO          1
-##                        #   /RelValQCD_Pt_3000_3500/CMSSW_3_3_0_pre1-STARTUP31X_V4-v1/GEN-SIM-RECO  cmssrm.fnal.gov 12
-##                        #   /RelValQCD_Pt_3000_3500/CMSSW_3_3_0_pre1-STARTUP31X_V4-v1/GEN-SIM-RECO  srm-cms.cern.ch 12
-##                        if len(site_name) < 1:
-##                            return
-##                        # TODO TODO TODO end
-##                        run_number = int(attrs["RUNS_RUNNUMBER"])
-##                        file_name = str(attrs["FILES_LOGICALFILENAME"])
-##                        nevents = int(attrs["FILES_NUMBEROFEVENTS"])
-##                        # I know, this is a bit of a kludge.
-##                        if not files_info.has_key(run_number):
-##                            # New run.
-##                            files_info[run_number] = {}
-##                            files_info[run_number][file_name] = (nevents,
-##                                                                 [site_name])
-##                        elif not files_info[run_number].has_key(file_name):
-##                            # New file for a known run.
-##                            files_info[run_number][file_name] = (nevents,
-##                                                                 [site_name])
-##                        else:
-##                            # New entry for a known file for a known run.
-##                            # DEBUG DEBUG DEBUG
-##                            # Each file should have the same number of
-##                            # events independent of the site it's at.
-##                            assert nevents == files_info[run_number][file_name][0]
-##                            # DEBUG DEBUG DEBUG end
-##                            files_info[run_number][file_name][1].append(site_name)
-            # OBSOLETE OBSOLETE OBSOLETE end
-            xml.sax.parseString(api_result, handler)
-        except SAXParseException:
-            msg = "ERROR: Could not parse DBS server output"
-            self.logger.fatal(msg)
-            raise Error(msg)
+    ##########
 
-        # DEBUG DEBUG DEBUG
-        assert(handler.check_results_validity()), "ERROR The DBSXMLHandler screwed something up!"
-        # DEBUG DEBUG DEBUG end
+    def dbs_fetch_files_info(self, dbs_query):
+        """Ask DBS for the files (and their sites and numbers of
+        events) in each run.
+
+        Returns a dictionary run number -> file name -> (number of
+        events, list of sites).
+
+        """
 
-        # Now reshuffle all results a bit so we can more easily use
-        # them later on. (Remember that all arrays in the results
-        # should have equal length.)
+        # Reshuffle all results a bit so we can more easily use them
+        # later on. This is done row by row while the results come
+        # in, so we never have to keep the complete DBS output around.
         files_info = {}
-        for (index, site_name) in enumerate(handler.results["site"]):
+        def add_row(row):
+            site_name = row["site"]
             # Ugly hack to get around cases like this:
             #   $ dbs search --query="find dataset, site, file.count where dataset=/RelValQCD_Pt_3000_3500/CMSSW_3_3_0_pre1-STARTUP31X_V4-v1/GEN-SIM-RECO"
             #   Using DBS instance at: http://cmsdbsprod.cern.ch/cms_dbs_prod_global/servlet/DBSServlet
@@ -3170,10 +8652,10 @@ class CMSHarvester(object):
             #   /RelValQCD_Pt_3000_3500/CMSSW_3_3_0_pre1-STARTUP31X_V4-v1/GEN-SIM-RECO  cmssrm.fnal.gov 12
             #   /RelValQCD_Pt_3000_3500/CMSSW_3_3_0_pre1-STARTUP31X_V4-v1/GEN-SIM-RECO  srm-cms.cern.ch 12
             if len(site_name) < 1:
-                continue
-            run_number = int(handler.results["run.number"][index])
-            file_name = handler.results["file.name"][index]
-            nevents = int(handler.results["file.numevents"][index])
+                return
+            run_number = row["run.number"]
+            file_name = row["file.name"]
+            nevents = row["file.numevents"]
 
             # I know, this is a bit of a kludge.
             if not files_info.has_key(run_number):
@@ -3194,9 +8676,44 @@ class CMSHarvester(object):
                 # DEBUG DEBUG DEBUG end
                 files_info[run_number][file_name][1].append(site_name)
 
+        self.dbs_stream_query_rows(dbs_query,
+                                   ["run.number", "site",
+                                    "file.name", "file.numevents"],
+                                   add_row)
+
+        # End of dbs_fetch_files_info.
+        return files_info
+
+    ##########
+
+    def dbs_spread_files_info(self, dataset_name, dbs_queries):
+        """Get the per-run file catalog of a dataset.
+
+        The pieces of the file-level query (see dbs_spread_queries())
+        are sent in parallel (unless we are running in a worker
+        already, see WorkerPool), and their results are combined.
+
+        """
+
+        if len(dbs_queries) == 1:
+            files_info = self.dbs_fetch_files_info(dbs_queries[0])
+        else:
+            self.logger.debug("  sending %d file-level quer(y/ies) " \
+                              "for `%s'" % \
+                              (len(dbs_queries), dataset_name))
+            files_info = {}
+            pool = WorkerPool(self.dbs_workers)
+            for (index, files_info_tmp) in \
+                    pool.imap_unordered(self.dbs_fetch_files_info,
+                                        dbs_queries):
+                # NOTE: The pieces cover different runs, so there is
+                # no overlap.
+                files_info.update(files_info_tmp)
+
         # Remove any information for files that are not available
-        # anywhere. NOTE: After introducing the ugly hack above, this
-        # is a bit redundant, but let's keep it for the moment.
+        # anywhere. NOTE: After introducing the ugly hack in
+        # dbs_fetch_files_info(), this is a bit redundant, but let's
+        # keep it for the moment.
         for run_number in files_info.keys():
             files_without_sites = [i for (i, j) in \
                                    files_info[run_number].items() \
@@ -3211,88 +8728,286 @@ class CMSHarvester(object):
                     #                                     [run_number] \
                     #                                      [file_name][0], [])
 
-        # And another bit of a kludge.
-        num_events_catalog = {}
-        for run_number in files_info.keys():
-            site_names = list(set([j for i in files_info[run_number].values() for j in i[1]]))
-
-            # NOTE: The term `mirrored' does not have the usual
-            # meaning here. It basically means that we can apply
-            # single-step harvesting.
-            mirrored = None
-            if len(site_names) > 1:
-                # Now we somehow need to figure out if we're dealing
-                # with a mirrored or a spread-out dataset. The rule we
-                # use here is that we're dealing with a spread-out
-                # dataset unless we can find at least one site
-                # containing exactly the full list of files for this
-                # dataset that DBS knows about. In that case we just
-                # use only that site.
-                all_file_names = files_info[run_number].keys()
-                all_file_names = set(all_file_names)
-                sites_with_complete_copies = []
-                for site_name in site_names:
-                    files_at_site = [i for (i, (j, k)) \
-                                     in files_info[run_number].items() \
-                                     if site_name in k]
-                    files_at_site = set(files_at_site)
-                    if files_at_site == all_file_names:
-                        sites_with_complete_copies.append(site_name)
-                if len(sites_with_complete_copies) < 1:
-                    # This dataset/run is available at more than one
-                    # site, but no one has a complete copy. So this is
-                    # a spread-out sample.
-                    mirrored = False
-                else:
-                    if len(sites_with_complete_copies) > 1:
-                        # This sample is available (and complete) at
-                        # more than one site. Definitely mirrored.
-                        mirrored = True
-                    else:
-                        # This dataset/run is available at more than
-                        # one site and at least one of them has a
-                        # complete copy. Even if this is only a single
-                        # site, let's call this `mirrored' and run the
-                        # single-step harvesting.
-                        mirrored = True
-
-##                site_names_ref = set(files_info[run_number].values()[0][1])
-##                for site_names_tmp in files_info[run_number].values()[1:]:
-##                    if set(site_names_tmp[1]) != site_names_ref:
-##                        mirrored = False
-##                        break
+        # End of dbs_spread_files_info.
+        return files_info
+
+    ##########
+
+    def dbs_block_spread_catalog(self, dataset_name, run_condition=""):
+        """Figure out the spread of a dataset from block-level info.
+
+        Data is placed at sites in blocks, so instead of asking DBS
+        about each file we ask about the blocks in each run: how many
+        files (and events) each block has in that run, and at which
+        sites it is. That is a lot less information to transfer and
+        parse than the file-level version.
+
+        For runs where the block-level information is not conclusive
+        (e.g. blocks that are only partially at a site, or without
+        any site at all) we fall back to the file-level information
+        for just those runs.
+
+        The query can be restricted to a range of runs by giving the
+        condition for that (see DBSQueryPlanner.run_ranges()).
+
+        Returns the same catalog as RunSpreadIndex.catalog().
+
+        """
+
+        condition = "where dataset = %s and dataset.status = VALID" % \
+                    dataset_name
+        run_mark = self.incremental_run_mark(dataset_name)
+        if not run_mark is None:
+            condition += " and run > %d" % run_mark
+        condition += run_condition
+
+        tag_names_totals = ["run", "block.name",
+                            "file.count", "sum(file.numevents)"]
+        tag_names_sites = ["run", "block.name", "site",
+                           "file.count", "sum(file.numevents)"]
+        # NOTE: If DBS itself fails there is no point in asking it
+        # for the file-level information instead, so errors are
+        # passed on.
+        pool = WorkerPool(self.dbs_workers)
+        (results_totals, results_sites) = \
+                         pool.map(lambda tag_names: \
+                                  self.dbs_query_results("find %s %s" % \
+                                                         (", ".join(tag_names),
+                                                          condition),
+                                                         tag_names),
+                                  [tag_names_totals, tag_names_sites])
+        if len([i for i in tag_names_totals \
+                if not results_totals.has_key(i)]) > 0 or \
+           len([i for i in tag_names_sites \
+                if not results_sites.has_key(i)]) > 0:
+            # Either this DBS does not know about block-level
+            # aggregates or there simply is nothing to be found. Let's
+            # make sure using the file-level information.
+            self.logger.warning("No block-level information for `%s' " \
+                                "--> using file-level information" % \
+                                dataset_name)
+            if len(run_condition) < 1:
+                dbs_queries = self.dbs_spread_queries(dataset_name)
+            else:
+                dbs_queries = ["find run.number, site, file.name, " \
+                               "file.numevents %s" % condition]
+            files_info = self.dbs_spread_files_info(dataset_name,
+                                                    dbs_queries)
+            return RunSpreadIndex(files_info).catalog()
+
+        # The number of files (and events) in each block, per run.
+        counts = {}
+        block_files = {}
+        for (run_number, block_name, num_files, num_events) in \
+                zip(*[results_totals.get(i, []) for i in tag_names_totals]):
+            if not counts.has_key(run_number):
+                counts[run_number] = (0, 0, {}, {})
+            (num_files_run, num_events_run, site_files, site_events) = \
+                            counts[run_number]
+            counts[run_number] = (num_files_run + num_files,
+                                  num_events_run + num_events,
+                                  site_files, site_events)
+            block_files[(run_number, block_name)] = num_files
+
+        # And where they are.
+        ambiguous_runs = set()
+        blocks_with_sites = set()
+        for (run_number, block_name, site_name, num_files, num_events) in \
+                zip(*[results_sites.get(i, []) for i in tag_names_sites]):
+            block_key = (run_number, block_name)
+            if len(site_name) < 1 or \
+                   block_files.get(block_key, None) != num_files:
+                ambiguous_runs.add(run_number)
+                continue
+            blocks_with_sites.add(block_key)
+            (num_files_run, num_events_run, site_files, site_events) = \
+                            counts[run_number]
+            site_files[site_name] = site_files.get(site_name, 0) + \
+                                    num_files
+            site_events[site_name] = site_events.get(site_name, 0) + \
+                                     num_events
+        for block_key in block_files.keys():
+            if not block_key in blocks_with_sites:
+                ambiguous_runs.add(block_key[0])
+
+        for run_number in ambiguous_runs:
+            if counts.has_key(run_number):
+                del counts[run_number]
+        num_events_catalog = RunSpreadIndex().catalog(counts)
+
+        if len(ambiguous_runs) > 0:
+            self.logger.debug("  block-level information for %d run(s) " \
+                              "of `%s' is not conclusive " \
+                              "--> using file-level information" % \
+                              (len(ambiguous_runs), dataset_name))
+            ambiguous_runs = list(ambiguous_runs)
+            ambiguous_runs.sort()
+            dbs_queries = ["find run.number, site, file.name, " \
+                           "file.numevents %s and run = %d" % \
+                           (condition, i) for i in ambiguous_runs]
+            files_info = self.dbs_spread_files_info(dataset_name,
+                                                    dbs_queries)
+            num_events_catalog.update(RunSpreadIndex(files_info).catalog())
+
+        # End of dbs_block_spread_catalog.
+        return num_events_catalog
+
+    ##########
+
+    def dbs_spread_fingerprints(self, dataset_name):
+        """Get a cheap fingerprint of each run of this dataset.
+
+        The fingerprint of a run is its number of files, its number
+        of events and the last modification date of its files. If
+        any of these changed, the spread of the run may have changed.
+
+        Returns a dictionary run number -> fingerprint, or None if
+        DBS could not tell us.
+
+        """
+
+        tag_names = ["run", "file.count", "sum(file.numevents)",
+                     "max(file.moddate)"]
+        dbs_query = "find %s where dataset = %s " \
+                    "and dataset.status = VALID" % \
+                    (", ".join(tag_names), dataset_name)
+        run_mark = self.incremental_run_mark(dataset_name)
+        if not run_mark is None:
+            dbs_query += " and run > %d" % run_mark
+
+        try:
+            results = self.dbs_query_results(dbs_query, tag_names)
+        except Error:
+            results = {}
+
+        fingerprints = None
+        if len([i for i in tag_names if not results.has_key(i)]) > 0:
+            self.logger.debug("  no run fingerprints for `%s' " \
+                              "--> not using cached spread information" % \
+                              dataset_name)
+        else:
+            fingerprints = {}
+            for (run_number, num_files, num_events, moddate) in \
+                    zip(*[results[i] for i in tag_names]):
+                fingerprints[run_number] = (num_files, num_events,
+                                            str(moddate))
+
+        # End of dbs_spread_fingerprints.
+        return fingerprints
 
+    ##########
+
+    def dbs_spread_catalog(self, dataset_name, runs=None,
+                           runs_selected=None):
+        """Figure out the spread of (some of the runs of) a dataset.
+
+        This uses file-level or block-level information, depending on
+        the spread mode. See dbs_spread_queries() for the meaning of
+        runs and runs_selected.
+
+        Returns the same catalog as RunSpreadIndex.catalog().
+
+        """
+
+        if self.spread_mode == "block":
+            if runs_selected is None:
+                num_events_catalog = \
+                            self.dbs_block_spread_catalog(dataset_name)
+            else:
+                runs = list(runs)
+                runs.sort()
+                run_conditions = DBSQueryPlanner.run_ranges(runs,
+                                                            set(runs_selected))
+                num_events_catalog = {}
+                pool = WorkerPool(self.dbs_workers)
+                for num_events_catalog_tmp in \
+                        pool.map(lambda run_condition: \
+                                 self.dbs_block_spread_catalog(dataset_name,
+                                                               run_condition),
+                                 run_conditions):
+                    num_events_catalog.update(num_events_catalog_tmp)
+        else:
+            dbs_queries = self.dbs_spread_queries(dataset_name, runs,
+                                                  runs_selected)
+            files_info = self.dbs_spread_files_info(dataset_name,
+                                                    dbs_queries)
+            num_events_catalog = RunSpreadIndex(files_info).catalog()
+
+        # End of dbs_spread_catalog.
+        return num_events_catalog
+
+    ##########
+
+    def dbs_check_dataset_spread(self, dataset_name, runs=None):
+        """Figure out the number of events in each run of this dataset.
+
+        This is a more efficient way of doing this than calling
+        dbs_resolve_number_of_events for each run.
+
+        If the runs of the dataset are given, large datasets are
+        handled in pieces (see dbs_spread_queries()).
+
+        """
+
+        self.logger.debug("Checking spread of dataset `%s'" % dataset_name)
+
+        # DEBUG DEBUG DEBUG
+        # If we get here DBS should have been set up already.
+        assert not self.dbs_api is None
+        # DEBUG DEBUG DEBUG end
+
+        # Figure out, for each run, which sites have (how many of)
+        # the events and whether the run is mirrored or spread-out.
+        # If we kept the results from last time, we only have to do
+        # that for the runs that changed since then.
+        fingerprints = None
+        if not self.spread_cache is None:
+            fingerprints = self.dbs_spread_fingerprints(dataset_name)
+        if fingerprints is None:
+            num_events_catalog = self.dbs_spread_catalog(dataset_name, runs)
+        else:
+            (num_events_catalog, runs_changed) = \
+                                 self.spread_cache.lookup(dataset_name,
+                                                          fingerprints)
+            self.logger.debug("  %d run(s) unchanged since last time, " \
+                              "%d run(s) to check" % \
+                              (len(num_events_catalog), len(runs_changed)))
+            num_events_catalog_changed = {}
+            if len(runs_changed) > 0:
+                runs = fingerprints.keys()
+                if len(runs_changed) == len(runs):
+                    runs_changed = None
+                num_events_catalog_changed = \
+                            self.dbs_spread_catalog(dataset_name, runs,
+                                                    runs_changed)
+            self.spread_cache.update(dataset_name, fingerprints,
+                                     num_events_catalog_changed,
+                                     self.incremental_run_mark(dataset_name))
+            num_events_catalog.update(num_events_catalog_changed)
+
+        run_numbers = num_events_catalog.keys()
+        run_numbers.sort()
+        for run_number in run_numbers:
+            info = num_events_catalog[run_number]
+            mirrored = info["mirrored"]
+            if not mirrored is None:
                 if mirrored:
                     self.logger.debug("    -> run appears to be `mirrored'")
                 else:
                     self.logger.debug("    -> run appears to be spread-out")
-
-                if mirrored and \
-                       len(sites_with_complete_copies) != len(site_names):
-                    # Remove any references to incomplete sites if we
-                    # have at least one complete site (and if there
-                    # are incomplete sites).
-                    for (file_name, (i, sites)) in files_info[run_number].items():
-                        complete_sites = [site for site in sites \
-                                          if site in sites_with_complete_copies]
-                        files_info[run_number][file_name] = (i, complete_sites)
-                    site_names = sites_with_complete_copies
-
             self.logger.debug("  for run #%d:" % run_number)
-            num_events_catalog[run_number] = {}
-            num_events_catalog[run_number]["all_sites"] = sum([i[0] for i in files_info[run_number].values()])
+            site_names = [i for i in info.keys() \
+                          if not i in ["all_sites", "mirrored"]]
             if len(site_names) < 1:
                 self.logger.debug("    run is not available at any site")
                 self.logger.debug("      (but should contain %d events" % \
-                                  num_events_catalog[run_number]["all_sites"])
+                                  info["all_sites"])
             else:
                 self.logger.debug("    at all sites combined there are %d events" % \
-                                  num_events_catalog[run_number]["all_sites"])
+                                  info["all_sites"])
                 for site_name in site_names:
-                    num_events_catalog[run_number][site_name] = sum([i[0] for i in files_info[run_number].values() if site_name in i[1]])
                     self.logger.debug("    at site `%s' there are %d events" % \
-                                      (site_name, num_events_catalog[run_number][site_name]))
-            num_events_catalog[run_number]["mirrored"] = mirrored
+                                      (site_name, info[site_name]))
 
         # End of dbs_check_dataset_spread.
         return num_events_catalog
@@ -3354,13 +9069,22 @@ class CMSHarvester(object):
 
     ##########
 
-    def build_dataset_list(self, input_method, input_name):
+    def build_dataset_list(self, input_method, input_name,
+                           incremental=False):
         """Build a list of all datasets to be processed.
 
+        In incremental mode only datasets that are new, or that
+        contain new runs, are returned.
+
         """
 
         dataset_names = []
 
+        if incremental:
+            resolve_dataset_name = self.dbs_resolve_dataset_name_incremental
+        else:
+            resolve_dataset_name = self.dbs_resolve_dataset_name
+
         # It may be, but only for the list of datasets to ignore, that
         # the input method and name are None because nothing was
         # specified. In that case just an empty list is returned.
@@ -3372,7 +9096,7 @@ class CMSHarvester(object):
             # DBS to translate it conclusively into a list of explicit
             # dataset names.
             self.logger.info("Asking DBS for dataset names")
-            dataset_names = self.dbs_resolve_dataset_name(input_name)
+            dataset_names = resolve_dataset_name(input_name)
         elif input_method == "datasetfile":
             # In this case a file containing a list of dataset names
             # is specified. Still, each line may contain wildcards so
@@ -3380,6 +9104,7 @@ class CMSHarvester(object):
             # NOTE: Lines starting with a `#' are ignored.
             self.logger.info("Reading input from list file `%s'" % \
                              input_name)
+            dataset_specs = []
             try:
                 listfile = open("/afs/cern.ch/cms/CAF/CMSCOMM/COMM_DQM/harvesting/bin/%s" %input_name, "r")
 		print "open listfile"
@@ -3390,14 +9115,45 @@ class CMSHarvester(object):
                         continue
                     # Skip lines starting with a `#'.
                     if dataset_stripped[0] != "#":
-                        dataset_names.extend(self. \
-                                             dbs_resolve_dataset_name(dataset_stripped))
+                        dataset_specs.append(dataset_stripped)
                 listfile.close()
             except IOError:
                 msg = "ERROR: Could not open input list file `%s'" % \
                       input_name
                 self.logger.fatal(msg)
                 raise Error(msg)
+
+            # There is no need to ask DBS about anything that is
+            # already covered by a broader wildcard in the same
+            # list. E.g. with `/*/Run2012*/DQM' in the list,
+            # `/Jet/Run2012A*/DQM' cannot add anything.
+            dataset_specs = list(set(dataset_specs))
+            dataset_specs.sort()
+            dataset_specs_needed = []
+            for dataset_spec in dataset_specs:
+                covered_by = [i for i in dataset_specs \
+                              if i != dataset_spec and \
+                              self.dataset_spec_covers(i, dataset_spec) and \
+                              not (self.dataset_spec_covers(dataset_spec, i) \
+                                   and dataset_spec < i)]
+                if len(covered_by) > 0:
+                    self.logger.debug("  skipping `%s' (covered by `%s')" % \
+                                      (dataset_spec, covered_by[0]))
+                else:
+                    dataset_specs_needed.append(dataset_spec)
+            self.logger.info("  resolving %d unique dataset name(s) " \
+                             "(out of %d)" % \
+                             (len(dataset_specs_needed), len(dataset_specs)))
+
+            # Now ask DBS about all of these at the same time, merging
+            # the results as they come in.
+            dataset_names_unique = set()
+            pool = WorkerPool(self.dbs_workers)
+            for (index, datasets) in \
+                    pool.imap_unordered(resolve_dataset_name,
+                                        dataset_specs_needed):
+                dataset_names_unique.update(datasets)
+            dataset_names = list(dataset_names_unique)
         else:
             # DEBUG DEBUG DEBUG
             # We should never get here.
@@ -3418,6 +9174,28 @@ class CMSHarvester(object):
 
     ##########
 
+    def dataset_spec_covers(self, dataset_spec, dataset_spec_other):
+        """Check if dataset_spec matches everything dataset_spec_other
+        matches.
+
+        Both are dataset names possibly containing `*' wildcards. If
+        the other specification, taken literally, matches the first
+        one then any `*' in it is matched by a `*' in the first one,
+        so whatever it expands to is matched as well. (The reverse is
+        not true, so this may miss some cases. That's fine, we only
+        use this to skip superfluous DBS queries.)
+
+        """
+
+        regexp = ".*".join([re.escape(i) for i in dataset_spec.split("*")])
+        regexp = "^%s$" % regexp
+        covers = not re.match(regexp, dataset_spec_other) is None
+
+        # End of dataset_spec_covers.
+        return covers
+
+    ##########
+
     def build_dataset_use_list(self):
         """Build a list of datasets to process.
 
@@ -3427,8 +9205,10 @@ class CMSHarvester(object):
 
         input_method = self.input_method["datasets"]["use"]
         input_name = self.input_name["datasets"]["use"]
+        incremental = not self.incremental_state is None
         dataset_names = self.build_dataset_list(input_method,
-                                                input_name)
+                                                input_name,
+                                                incremental)
         self.datasets_to_use = dict(zip(dataset_names,
                                         [None] * len(dataset_names)))
 
@@ -3626,6 +9406,9 @@ class CMSHarvester(object):
         runs_to_use = self.runs_to_use
         runs_to_ignore = self.runs_to_ignore
 
+        # Find out which runs were harvested already.
+        self.build_harvested_output_indices(self.datasets_to_use.keys())
+
         for dataset_name in self.datasets_to_use:
             runs_in_dataset = self.datasets_information[dataset_name]["runs"]
 
@@ -3733,6 +9516,21 @@ class CMSHarvester(object):
                                   dataset_name))
 		runs=good_runs
 
+            # Runs that already have output would only lead to jobs
+            # that fail to copy back their results (CRAB does not
+            # overwrite existing files).
+            index = self.harvested_outputs[dataset_name]
+            runs_harvested = [i for i in runs if index.has_output(i)]
+            if len(runs_harvested) > 0:
+                self.logger.info("Skipping %d run(s) of dataset `%s' " \
+                                 "that already have output" % \
+                                 (len(runs_harvested), dataset_name))
+                for run in runs_harvested:
+                    self.logger.debug("  run %d: %d file(s), %d bytes" % \
+                                      (run, len(index.run_outputs(run)),
+                                       index.output_size(run)))
+                runs = [i for i in runs if not i in runs_harvested]
+
             self.datasets_to_use[dataset_name] = runs
 
         # End of process_runs_use_and_ignore_lists().
@@ -4310,6 +10108,160 @@ class CMSHarvester(object):
 
     ##########
 
+    def plan_hedges(self, jobs):
+        """Decide which runs to submit to more than one site.
+
+        Runs that are available at several (complete) sites can be
+        submitted to up to hedge_sites sites, keeping whichever
+        output arrives first. This cuts down on the time we have to
+        wait for slow sites. The total number of extra submissions is
+        limited by hedge_budget. The newest runs (i.e. the ones people
+        are most likely waiting for) go first.
+
+        Takes and returns the jobs as given to SiteScheduler.assign().
+
+        """
+
+        self.hedged_runs = {}
+        if self.hedge_sites <= self.nr_max_sites or self.hedge_budget < 1:
+            return jobs
+
+        jobs = list(jobs)
+        job_indices = range(len(jobs))
+        job_indices.sort(key=lambda i: (-jobs[i][0][1], jobs[i][0][0]))
+        budget = self.hedge_budget
+        for job_index in job_indices:
+            if budget < 1:
+                break
+            (key, load, num_sites, site_groups) = jobs[job_index]
+            num_candidates = len(set([j for i in site_groups for j in i]))
+            num_hedges = min(self.hedge_sites, num_candidates) - num_sites
+            num_hedges = min(num_hedges, budget)
+            if num_hedges < 1:
+                continue
+            jobs[job_index] = (key, load, num_sites + num_hedges,
+                               site_groups)
+            self.hedged_runs[key] = num_sites + num_hedges
+            budget -= num_hedges
+
+        self.logger.info("Hedging %d run(s) using %d extra " \
+                         "submission(s)" % \
+                         (len(self.hedged_runs),
+                          self.hedge_budget - budget))
+
+        # End of plan_hedges.
+        return jobs
+
+    ##########
+
+    def plan_multicrab_sites(self):
+        """Decide at which site(s) each harvesting job will run.
+
+        Instead of picking a site at random for each run separately,
+        all runs (with their candidate sites and numbers of events)
+        are looked at at once, and spread over the sites such that no
+        site gets much more than its share. See SiteScheduler.
+
+        Returns a dictionary (dataset name, run number) -> list of
+        sites. Runs that already have output in CASTOR are skipped
+        (see build_harvested_output_indices()).
+
+        """
+
+        dataset_names = self.datasets_to_use.keys()
+        dataset_names.sort()
+
+        # See which runs already have output (normally we know this
+        # already from the run selection).
+        self.build_harvested_output_indices(dataset_names)
+
+        jobs = []
+        for dataset_name in dataset_names:
+            runs = self.datasets_to_use[dataset_name]
+            for run in runs:
+
+                if self.harvested_outputs[dataset_name].has_output(run):
+                    continue
+
+                # DEBUG DEBUG DEBUG
+                # We should only get here if we're treating a
+                # dataset/run that is fully contained at a single
+                # site.
+                assert (len(self.datasets_information[dataset_name] \
+                        ["sites"][run]) == 1) or \
+                        self.datasets_information[dataset_name]["mirrored"]
+                # DEBUG DEBUG DEBUG end
+
+                site_names = self.datasets_information[dataset_name] \
+                             ["sites"][run].keys()
+
+                # If we're looking at a mirrored dataset we can
+                # choose between the sites (preferring T1 sites, just
+                # like pick_a_site()). Otherwise there is nothing to
+                # choose.
+                if len(site_names) > 1:
+                    cmssw_version = self.datasets_information[dataset_name] \
+                                    ["cmssw_version"]
+                    (site_names, t1_sites) = self.allowed_sites(site_names)
+                    site_names = [i for i in site_names \
+                                  if self.site_has_cmssw_version(i,
+                                                                 cmssw_version)]
+                    t1_sites = [i for i in t1_sites if i in site_names]
+                    site_groups = [t1_sites, site_names]
+                    # With a site history, faster sites go first
+                    # (when it's a tie, see the site weights below).
+                    if not self.site_history is None:
+                        site_groups = [[j for (i, j) in \
+                                        self.site_history.rank(k)] \
+                                       for k in site_groups]
+                else:
+                    site_groups = [site_names]
+
+                nevents = self.datasets_information[dataset_name] \
+                          ["num_events"][run]
+                jobs.append(((dataset_name, run), nevents,
+                             self.nr_max_sites, site_groups))
+
+        jobs = self.plan_hedges(jobs)
+
+        # With a site history, faster sites can take on more work.
+        site_weights = self.site_weights
+        if not self.site_history is None:
+            site_names = set()
+            for job in jobs:
+                for site_group in job[3]:
+                    site_names.update(site_group)
+            speed_factors = self.site_history.speed_factors(list(site_names))
+            site_weights = dict([(i, self.site_weights.get(i, 1.) * j) \
+                                 for (i, j) in speed_factors.items()])
+
+        scheduler = SiteScheduler(site_weights)
+        site_plan = scheduler.assign(jobs)
+
+        for ((dataset_name, run), site_names) in site_plan.items():
+            if len(site_names) < 1:
+                self.logger.error("No matching site found for " \
+                                  "dataset `%s', run %d" % \
+                                  (dataset_name, run))
+                self.logger.error("    --> Your release or SCRAM " \
+                                  "architecture may not be available" \
+                                  "anywhere on the (LCG) grid.")
+                self.all_sites_found = False
+
+        site_names = scheduler.loads.keys()
+        site_names.sort()
+        self.logger.info("Placed %d job(s) at %d site(s):" % \
+                         (len(jobs), len(site_names)))
+        for site_name in site_names:
+            self.logger.info("  `%s': %d events (weight %.2f)" % \
+                             (site_name, scheduler.loads[site_name],
+                              scheduler.weight(site_name)))
+
+        # End of plan_multicrab_sites.
+        return site_plan
+
+    ##########
+
     def create_multicrab_config(self):
         """Create a multicrab.cfg file for all samples.
 
@@ -4333,7 +10285,7 @@ class CMSHarvester(object):
 	if self.caf_access == True:
 	    print "Extracting %s as user name" %UserName 
 
-        number_max_sites = self.nr_max_sites + 1
+        number_max_sites = max(self.nr_max_sites, self.hedge_sites) + 1
 
         multicrab_config_lines = []
         multicrab_config_lines.append(self.config_file_header())
@@ -4342,6 +10294,13 @@ class CMSHarvester(object):
         multicrab_config_lines.append("cfg = crab.cfg")
         multicrab_config_lines.append("")
 
+        # Decide where each job will run.
+        site_plan = self.plan_multicrab_sites()
+        self.hedge_manifest = None
+        self.multicrab_blocks = []
+        if len(self.hedged_runs) > 0:
+            self.hedge_manifest = HedgeManifest(self.hedge_manifest_file_name)
+
         dataset_names = self.datasets_to_use.keys()
         dataset_names.sort()
 
@@ -4356,22 +10315,13 @@ class CMSHarvester(object):
                 castor_dir = self.datasets_information[dataset_name] \
                                  ["castor_path"][run]
 
-                cmd = "rfdir %s" % castor_dir
-                (status, output) = commands.getstatusoutput(cmd)
-
-                if len(output) <= 0:
-
-                    # DEBUG DEBUG DEBUG
-                    # We should only get here if we're treating a
-                    # dataset/run that is fully contained at a single
-                    # site.
-                    assert (len(self.datasets_information[dataset_name] \
-                            ["sites"][run]) == 1) or \
-                            self.datasets_information[dataset_name]["mirrored"]
-                    # DEBUG DEBUG DEBUG end
+                # NOTE: Runs for which there already is output do
+                # not appear in the plan.
+                if site_plan.has_key((dataset_name, run)):
 
-                    site_names = self.datasets_information[dataset_name] \
-                             ["sites"][run].keys()
+                    # The sites have already been chosen for all runs
+                    # together.
+                    site_names = list(site_plan[(dataset_name, run)])
 
                     for i in range(1, number_max_sites, 1):
                         if len(site_names) > 0: 
@@ -4382,31 +10332,10 @@ class CMSHarvester(object):
                             output_file_name = self. \
                                        create_output_file_name(dataset_name, run)
 
-
-                            # If we're looking at a mirrored dataset we just pick
-                            # one of the sites. Otherwise there is nothing to
-                            # choose.
-
                             # Loop variable
                             loop = 0
 
-                            if len(site_names) > 1:
-                                cmssw_version = self.datasets_information[dataset_name] \
-                                            ["cmssw_version"]
-                                self.logger.info("Picking site for mirrored dataset " \
-                                             "`%s', run %d" % \
-                                             (dataset_name, run))
-                                site_name = self.pick_a_site(site_names, cmssw_version)
-                                if site_name in site_names:
-                                    site_names.remove(site_name)
-
-                            else:
-                                site_name = site_names[0]
-                                site_names.remove(site_name)
-
-                            if site_name is self.no_matching_site_found_str:
-                                if loop < 1:
-                                    break
+                            site_name = site_names.pop(0)
 
                             nevents = self.datasets_information[dataset_name]["num_events"][run]
     
@@ -4415,6 +10344,18 @@ class CMSHarvester(object):
                                 dataset_name, run, index)
                             multicrab_config_lines.append("[%s]" % \
                                                       multicrab_block_name)
+                            self.multicrab_blocks.append((multicrab_block_name,
+                                                          site_name,
+                                                          self.datasets_information[dataset_name] \
+                                                          ["castor_path"][run],
+                                                          output_file_name))
+                            if self.hedged_runs.has_key((dataset_name, run)):
+                                self.hedge_manifest.add(dataset_name, run,
+                                                        self.datasets_information[dataset_name] \
+                                                        ["castor_path"][run],
+                                                        output_file_name,
+                                                        multicrab_block_name,
+                                                        site_name)
 
 			    ## CRAB
 			    ##------
@@ -5099,10 +11040,222 @@ class CMSHarvester(object):
             raise Error("ERROR: Could not write to file `%s'!" % \
                         multicrab_file_name)
 
+        # Follow all jobs to learn about the sites.
+        if not self.site_history is None:
+            for (block_name, site_name, output_dir, output_file_name) in \
+                    self.multicrab_blocks:
+                self.site_history.add_job(block_name, site_name,
+                                          output_dir, output_file_name)
+            try:
+                self.site_history.save()
+            except Error, err:
+                self.logger.warning(err.msg)
+
+        # Keep track of the runs we submitted to more than one site.
+        if not self.hedge_manifest is None:
+            self.logger.info("Writing hedge manifest `%s'" % \
+                             self.hedge_manifest.file_name)
+            try:
+                self.hedge_manifest.save()
+            except Error, err:
+                self.logger.fatal(err.msg)
+                raise
+
         # End of write_multicrab_config.
 
     ##########
 
+    def crab_task_status(self, task_name):
+        """Ask CRAB what a task is up to.
+
+        Returns one of `running', `done' and `aborted', or None if we
+        can't tell (e.g. because the task was not submitted yet).
+
+        """
+
+        cmd = "crab -status -c %s" % task_name
+        (status, output) = commands.getstatusoutput(cmd)
+        if status != 0:
+            # Probably not submitted (yet).
+            crab_status = None
+        elif output.find("Aborted") > -1:
+            crab_status = "aborted"
+        elif output.find("Done") > -1 or \
+                 output.find("Retrieved") > -1 or \
+                 output.find("Cleared") > -1:
+            crab_status = "done"
+        elif output.find("Running") > -1:
+            crab_status = "running"
+        else:
+            crab_status = None
+
+        # End of crab_task_status.
+        return crab_status
+
+    ##########
+
+    def update_site_history(self, history_file_name):
+        """Follow the jobs in the site history.
+
+        For each job we're following, check whether its output has
+        arrived, and otherwise ask CRAB what it is up to. Jobs that
+        started running, and jobs that finished (successfully or
+        not) update the averages of their sites.
+
+        NOTE: When several jobs write the same output (i.e. for hedged
+        runs) we can't tell from the output which one delivered
+        it. Only jobs that CRAB reports as done are counted as
+        successful in that case, the others are simply forgotten.
+
+        NOTE: The (slow) checks are done without holding the lock on
+        the history file. Only the results are applied under the
+        lock, to what is in the file by then.
+
+        """
+
+        history = SiteHistory(history_file_name)
+        history.load()
+
+        # Jobs grouped by their output.
+        outputs = {}
+        for (job_name, job) in history.jobs.items():
+            key = (job["output_dir"], job["output_file"])
+            if not outputs.has_key(key):
+                outputs[key] = []
+            outputs[key].append(job_name)
+
+        listings = self.storage_backend(). \
+                   list_many(set([i[0] for i in outputs.keys()]))
+        observations = []
+        for ((output_dir, output_file_name), job_names) in outputs.items():
+            output_arrived = (not listings[output_dir] is None) and \
+                             (output_file_name in listings[output_dir])
+
+            for job_name in job_names:
+                crab_status = self.crab_task_status(job_name)
+
+                event = None
+                if output_arrived:
+                    if len(job_names) == 1 or crab_status == "done":
+                        event = "done"
+                    else:
+                        event = "forgotten"
+                elif crab_status == "aborted":
+                    event = "failed"
+                elif crab_status == "running":
+                    event = "started"
+                elif crab_status == "done":
+                    # Done, but no output.
+                    event = "failed"
+                if not event is None:
+                    observations.append((job_name, event, time.time()))
+
+        history.update(observations)
+
+        site_names = history.sites.keys()
+        site_names.sort()
+        self.logger.info("Site history for %d site(s), " \
+                         "still following %d job(s):" % \
+                         (len(site_names), len(history.jobs)))
+        for site_name in site_names:
+            expected_completion = history.expected_completion(site_name)
+            if expected_completion is None:
+                self.logger.info("  `%s': no jobs done yet" % site_name)
+            else:
+                self.logger.info("  `%s': expecting output after " \
+                                 "%.1f hours" % \
+                                 (site_name, expected_completion / 3600.))
+
+        # End of update_site_history.
+
+    ##########
+
+    def load_site_history(self):
+        """Load the performance history of the sites.
+
+        """
+
+        self.logger.info("Loading site history from `%s'" % \
+                         self.site_history_file_name)
+
+        history = SiteHistory(self.site_history_file_name)
+        try:
+            history.load()
+        except Error, err:
+            self.logger.fatal(err.msg)
+            raise
+        self.site_history = history
+
+        self.logger.info("  history known for %d site(s)" % \
+                         len(history.sites))
+
+        # End of load_site_history.
+
+    ##########
+
+    def reap_hedges(self, manifest_file_name):
+        """Clean up after runs that were submitted to several sites.
+
+        For each hedged run in the manifest, check whether its output
+        has arrived. If so, kill all other CRAB tasks for that run. The
+        other copies of the output would not be used, so there is no
+        need to keep them running.
+
+        NOTE: The output file shows up as soon as the stage-out
+        starts. So it only counts as arrived once it is not empty and
+        CRAB says the task that delivered it is done. That task (or
+        tasks) is of course never killed.
+
+        """
+
+        manifest = HedgeManifest(manifest_file_name)
+        manifest.load()
+
+        output_paths = dict([((i["dataset"], i["run"]),
+                              os.path.join(i["output_dir"],
+                                           i["output_file"])) \
+                             for i in manifest.pending()])
+        stats = self.storage_backend().stat_many(set(output_paths.values()))
+        num_reaped = 0
+        for entry in manifest.pending():
+            output_stat = stats[output_paths[(entry["dataset"],
+                                              entry["run"])]]
+            if output_stat is None or output_stat[2] < 1:
+                continue
+            blocks_done = [i for i in entry["blocks"] \
+                           if self.crab_task_status(i["name"]) == "done"]
+            if len(blocks_done) < 1:
+                self.logger.debug("Output for dataset `%s', run %d " \
+                                  "is still arriving" % \
+                                  (entry["dataset"], entry["run"]))
+                continue
+            self.logger.info("Output for dataset `%s', run %d " \
+                             "has arrived (from site(s) %s)" % \
+                             (entry["dataset"], entry["run"],
+                              ", ".join(["`%s'" % i["site"] \
+                                         for i in blocks_done])))
+            for block in entry["blocks"]:
+                if block in blocks_done:
+                    continue
+                cmd = "crab -kill all -c %s" % block["name"]
+                self.logger.info("  killing task `%s' (at site `%s')" % \
+                                 (block["name"], block["site"]))
+                (status, output) = commands.getstatusoutput(cmd)
+                if status != 0:
+                    self.logger.debug("    (could not kill `%s', " \
+                                      "probably done already)" % \
+                                      block["name"])
+            manifest.mark_done(entry)
+            num_reaped += 1
+
+        manifest.save()
+        self.logger.info("Reaped %d run(s), %d run(s) still pending" % \
+                         (num_reaped, len(manifest.pending())))
+
+        # End of reap_hedges.
+
+    ##########
+
     def write_harvesting_config(self, dataset_name):
         """Write a harvesting job configuration Python file.
 
@@ -5343,6 +11496,67 @@ class CMSHarvester(object):
         self.logger.info("Collecting information for all datasets to process")
         dataset_names = self.datasets_to_use.keys()
         dataset_names.sort()
+
+        # The DBS lookups for the different datasets are independent
+        # of each other, so we fire them all off using a bounded pool
+        # of workers and only afterwards loop over the datasets (in
+        # the usual order) to put everything together. This is done
+        # in two steps: first the runs, CMSSW version, data type and
+        # GlobalTag, then the spread over the sites. The latter needs
+        # the runs to split up the queries for large datasets (see
+        # dbs_spread_queries()).
+        # NOTE: The runs, CMSSW version, data type and GlobalTag are
+        # obtained using as few combined DBS queries as possible. See
+        # DBSQueryPlanner for details.
+        attributes = ["algo.version", "datatype.type"]
+        if self.globaltag is None:
+            attributes.append("dataset.tag")
+        attributes.append("run")
+        run_marks = {}
+        for dataset_name in dataset_names:
+            run_mark = self.incremental_run_mark(dataset_name)
+            if not run_mark is None:
+                run_marks[dataset_name] = run_mark
+        planner = DBSQueryPlanner(self.dataset_patterns, run_marks)
+        query_plans = planner.plan(dataset_names, attributes)
+
+        self.logger.info("  (%d combined DBS lookups using %d worker(s))" % \
+                         (len(query_plans), self.dbs_workers))
+        pool = WorkerPool(self.dbs_workers)
+        lookup_results = pool.map(lambda (dbs_query, tag_names, tmp): \
+                                  self.dbs_query_results(dbs_query, tag_names),
+                                  query_plans)
+
+        metadata = self.dbs_resolve_datasets_metadata(dataset_names,
+                                                      query_plans,
+                                                      lookup_results)
+        for dataset_name in dataset_names:
+            # If the combined queries did not give us anything for
+            # this dataset, fall back to the individual queries.
+            if not metadata.has_key(dataset_name):
+                self.logger.debug("No combined DBS results for `%s' " \
+                                  "--> asking separately" % dataset_name)
+                metadata[dataset_name] = {}
+                metadata[dataset_name]["runs"] = \
+                            self.dbs_resolve_runs(dataset_name)
+                metadata[dataset_name]["cmssw_version"] = \
+                            self.dbs_resolve_cmssw_version(dataset_name)
+                metadata[dataset_name]["datatype"] = \
+                            self.dbs_resolve_datatype(dataset_name)
+                if self.globaltag is None:
+                    metadata[dataset_name]["globaltag"] = \
+                            self.dbs_resolve_globaltag(dataset_name)
+
+        self.logger.info("  (%d spread lookups using %d worker(s))" % \
+                         (len(dataset_names), self.dbs_workers))
+        spread_catalogs = dict(zip(dataset_names,
+                                   pool.map(lambda dataset_name: \
+                                            self.dbs_check_dataset_spread(dataset_name,
+                                                                          metadata[dataset_name]["runs"]),
+                                            dataset_names)))
+        if not self.spread_cache is None:
+            self.save_spread_cache()
+
         for dataset_name in dataset_names:
 
             # Tell the user which dataset: nice with many datasets.
@@ -5351,7 +11565,7 @@ class CMSHarvester(object):
             self.logger.info("  `%s'" % dataset_name)
             self.logger.info(sep_line)
 
-            runs = self.dbs_resolve_runs(dataset_name)
+            runs = metadata[dataset_name]["runs"]
             self.logger.info("    found %d run(s)" % len(runs))
             if len(runs) > 0:
                 self.logger.debug("      run number(s): %s" % \
@@ -5365,11 +11579,11 @@ class CMSHarvester(object):
                        "after DBS checks!"
                 # DEBUG DEBUG DEBUG end
 
-            cmssw_version = self.dbs_resolve_cmssw_version(dataset_name)
+            cmssw_version = metadata[dataset_name]["cmssw_version"]
             self.logger.info("    found CMSSW version `%s'" % cmssw_version)
 
             # Figure out if this is data or MC.
-            datatype = self.dbs_resolve_datatype(dataset_name)
+            datatype = metadata[dataset_name]["datatype"]
             self.logger.info("    sample is data or MC? --> %s" % \
                              datatype)
 
@@ -5377,7 +11591,7 @@ class CMSHarvester(object):
 
             # Try and figure out the GlobalTag to be used.
             if self.globaltag is None:
-                globaltag = self.dbs_resolve_globaltag(dataset_name)
+                globaltag = metadata[dataset_name]["globaltag"]
             else:
                 globaltag = self.globaltag
 
@@ -5396,7 +11610,7 @@ class CMSHarvester(object):
             # DEBUG DEBUG DEBUG
             #tmp = self.dbs_check_dataset_spread_old(dataset_name)
             # DEBUG DEBUG DEBUG end
-            sites_catalog = self.dbs_check_dataset_spread(dataset_name)
+            sites_catalog = spread_catalogs[dataset_name]
 
             # Extract the total event counts.
             num_events = {}
@@ -5463,6 +11677,8 @@ class CMSHarvester(object):
                 self.logger.debug("      %s" % path_name)
             self.datasets_information[dataset_name]["castor_path"] = \
                                                                    castor_paths
+            self.datasets_information[dataset_name]["castor_path_common"] = \
+                                                                          castor_path_common
 
         # End of build_datasets_information.
 
@@ -5544,6 +11760,20 @@ class CMSHarvester(object):
                 # and if all is fine setup the Python side.
                 self.setup_dbs()
 
+                # If we are running incrementally, find out what we
+                # have already seen before.
+                if not self.incremental_state_file_name is None:
+                    self.load_incremental_state()
+                # The same for the spread of the datasets
+                if not self.spread_cache_file_name is None:
+                    self.load_spread_cache()
+                # and for the CMSSW versions at each site
+                if not self.site_version_cache_file_name is None:
+                    self.load_site_version_cache()
+                # and for how well each site did.
+                if not self.site_history_file_name is None:
+                    self.load_site_history()
+
                 # Fill our dictionary with all the required info we
                 # need to understand harvesting jobs. This needs to be
                 # done after the CMSSW version is known.
@@ -5569,6 +11799,22 @@ class CMSHarvester(object):
                 # like run numbers and GlobalTags.
                 self.build_datasets_information()
 
+                if not self.dbs_cache is None:
+                    self.logger.info("DBS cache: %d hit(s), " \
+                                     "%d miss(es)" % \
+                                     (self.dbs_cache.num_hits,
+                                      self.dbs_cache.num_misses))
+                if self.dbs_single_flight.num_shared > 0:
+                    self.logger.info("DBS queries: %d distinct, " \
+                                     "%d shared" % \
+                                     (self.dbs_single_flight.num_calls,
+                                      self.dbs_single_flight.num_shared))
+                if self.dbs_client.num_retries > 0:
+                    self.logger.info("DBS client: %d quer(y/ies), " \
+                                     "%d retr(y/ies)" % \
+                                     (self.dbs_client.num_queries,
+                                      self.dbs_client.num_retries))
+
                 if self.use_ref_hists and \
                        self.ref_hist_mappings_needed():
                     # Load the dataset name to reference histogram
@@ -5683,6 +11929,11 @@ class CMSHarvester(object):
                     # Explain the user what to do now.
                     self.show_exit_message()
 
+                # Only once everything went well do we move the
+                # incremental high-water marks forward.
+                if not self.incremental_state is None:
+                    self.update_incremental_state()
+
             except Usage, err:
                 # self.logger.fatal(err.msg)
                 # self.option_parser.print_help()
@@ -5729,6 +11980,16 @@ class CMSHarvester(object):
         # have a consistent book keeping file.
         finally:
 
+            self.report_dbs_telemetry()
+            if not self.dbs_replay_server is None:
+                self.dbs_replay_server.stop()
+            if not self.storage is None:
+                self.logger.debug("Output area cache: %d hit(s), " \
+                                  "%d miss(es)" % \
+                                  (self.storage.num_hits,
+                                   self.storage.num_misses))
+            if not self.site_version_cache is None:
+                self.save_site_version_cache()
             self.cleanup()
 
         ###